@@ -12,6 +12,7 @@ gettext.textdomain(PACKAGE)
 
 from gi.repository import GLib, GObject, GtkClutter, Gtk, Gdk, Gio
 from os.path import basename, abspath
+from collections import deque
 from gettext import gettext as _
 
 # If I have seen a little further it is by standing on the shoulders of Giants.
@@ -24,13 +25,15 @@ if not GLib.get_application_name():
 GtkClutter.init([])
 
 from gg.camera import Camera
-from gg.xmlfiles import TrackFile
-from gg.gpsmath import Coordinates
+from gg.gpsmath import Coordinates, update_derived_properties
+from gg.gpsmath import restore_geocache, save_geocache
 from gg.widgets import Widgets, MapView
+from gg.xmlfiles import TrackFile
+from gg.filetypes import sniff, find_files
 from gg.actor import CoordLabel, animate_in
-from gg.photos import Photograph, fetch_thumbnail
 from gg.navigation import go_back, move_by_arrow_keys
-from gg.common import Gst, Binding, selected, modified
+from gg.photos import Photograph, fetch_thumbnail, decode_photo
+from gg.common import Gst, Binding, selected, modified, background
 
 from gg.drag import DragController
 from gg.search import SearchController
@@ -38,6 +41,109 @@ from gg.search import SearchController
 # Handy names for GtkListStore column numbers.
 PATH, SUMMARY, THUMB, TIMESTAMP = range(4)
 
+# Let the interface catch up after committing this many files in a row.
+BATCH_SIZE = 50
+
+# Decode up to this many files ahead of the one being committed.
+AHEAD = 2 * BATCH_SIZE
+
+
+def decode(filename):
+    """Do the slow work of opening a file, in a worker thread.
+
+    Returns the function that finishes loading the file on the main thread,
+    along with the decoded data that it needs. Raises OSError if the file
+    is neither a photo nor a GPS track. The file's contents decide which
+    loader it goes to, so GPS tracks are never decoded as photos.
+    """
+    kind = sniff(filename)
+    if kind == 'photo':
+        return Photograph.load_from_file, decode_photo(filename)
+    return TrackFile.load_from_file, (TrackFile.parse_file(filename, kind),)
+
+
+def decode_ahead(files):
+    """Decode files in the worker threads, a few ahead of the consumer.
+
+    Directories are searched as the results are consumed, so loading starts
+    before the search is finished. Yields each filename with its decoding
+    job, and the number of files that have been discovered so far.
+    """
+    jobs = deque()
+    discovered = 0
+    for name in find_files(files):
+        jobs.append((name, background.submit(decode, name)))
+        discovered += 1
+        if len(jobs) >= AHEAD:
+            yield jobs.popleft() + (discovered,)
+    while jobs:
+        yield jobs.popleft() + (discovered,)
+
+
+class Importer:
+    """Commit decoded files to the interface, from the main loop.
+
+    Files are committed in their original order, in batches, as soon as the
+    workers have finished them. Directories are searched recursively, but
+    only the files that were named explicitly get reported when they can't
+    be opened. Any other error ends the import early, but still tidies up.
+    """
+
+    def __init__(self, files, then=None):
+        self.named = set(files)
+        self.then = then
+        self.loaded, self.failed = [], []
+        self.results = decode_ahead(files)
+        self.waiting = None
+        GLib.idle_add(self.commit)
+
+    def commit(self):
+        """Commit the finished files, stopping at the first busy one."""
+        for i in range(BATCH_SIZE):
+            self.waiting = self.waiting or next(self.results, None)
+            if self.waiting is None:
+                self.finish()
+                return False
+            name, job, discovered = self.waiting
+            ready = job.done()
+            if not ready:
+                job.add_done_callback(lambda job: GLib.idle_add(self.commit))
+                break
+            self.waiting = None
+            try:
+                load, decoded = job.result()
+                load(name, *decoded)
+                self.loaded.append(name)
+            except OSError:
+                self.failed.append(name)
+            except Exception:
+                self.finish()
+                raise
+        count = len(self.loaded) + len(self.failed)
+        Widgets.progressbar.set_fraction(count / discovered)
+        Widgets.progressbar.set_text(_('{} of {}: {}').format(
+            count, discovered, basename(name)))
+        return ready
+
+    def finish(self):
+        """Tidy up once every file has been committed."""
+        invalid = [basename(name) for name in self.failed
+                   if name in self.named]
+        if invalid:
+            Widgets.status_message(_('Could not open: ') + ', '.join(invalid))
+
+        # Ensure camera has found correct timezone regardless of the order
+        # that the GPX/KML files were loaded in.
+        likely_zone = TrackFile.query_all_timezones()
+        if likely_zone:
+            Camera.set_all_found_timezone(likely_zone)
+        Camera.timezone_handler_all()
+        Widgets.progressbar.hide()
+        Widgets.button_sensitivity()
+        if self.then is not None:
+            self.then(self.loaded)
+
+
 # Just pretend these functions are actually GottenGeography() instance methods.
 # The 'self' argument gets passed in by GtkApplication instead of Python.
 
@@ -55,6 +161,7 @@ def command_line(self, commands):
 
 def startup(self):
     """Display the primary window and connect some signals."""
+    background.submit(restore_geocache)
     self.quit_message = Widgets.quit.get_property('secondary-text')
 
     self.drag   = DragController(self.open_files)
@@ -146,41 +253,29 @@ class GottenGeography(Gtk.Application):
         self.connect('activate', lambda *ignore: Widgets.main.present())
         self.connect('command-line', command_line)
         self.connect('startup', startup)
+        self.connect('shutdown', lambda *ignore: save_geocache())
 
         self.do_fade_in = do_fade_in
 
-    def open_files(self, files):
-        """Attempt to load all of the specified files.
+    def open_files(self, files, then=None):
+        """Attempt to load all of the specified files and directories.
+
+        Every file is decoded by a pool of worker threads, and committed to
+        the interface from the main loop by an Importer. Once everything is
+        loaded, then() is called with the files that were loaded.
 
         >>> len(Photograph.instances)
         0
+        >>> loop = GLib.MainLoop()
         >>> GottenGeography().open_files(
-        ...     ['demo/IMG_2411.JPG', 'demo/IMG_2412.JPG'])
+        ...     ['demo/IMG_2411.JPG', 'demo/IMG_2412.JPG'],
+        ...     lambda loaded: loop.quit())
+        >>> loop.run()
         >>> len(Photograph.instances)
         2
         """
         Widgets.progressbar.show()
-        invalid, total = [], len(files)
-        for i, name in enumerate(files, 1):
-            Widgets.redraw_interface(i / total, basename(name))
-            try:
-                try:
-                    Photograph.load_from_file(name)
-                except OSError:
-                    TrackFile.load_from_file(name)
-            except OSError:
-                invalid.append(basename(name))
-        if invalid:
-            Widgets.status_message(_('Could not open: ') + ', '.join(invalid))
-
-        # Ensure camera has found correct timezone regardless of the order
-        # that the GPX/KML files were loaded in.
-        likely_zone = TrackFile.query_all_timezones()
-        if likely_zone:
-            Camera.set_all_found_timezone(likely_zone)
-        Camera.timezone_handler_all()
-        Widgets.progressbar.hide()
-        Widgets.button_sensitivity()
+        Importer(files, then)
 
     def apply_selected_photos(self, button):
         """Manually apply map center coordinates to selected photos."""
@@ -193,6 +288,7 @@ class GottenGeography(Gtk.Application):
     def save_all_files(self, *ignore):
         """Ensure all loaded files are saved."""
         Widgets.progressbar.show()
+        update_derived_properties(modified, wait=True)
         total = len(modified)
         for i, photo in enumerate(list(modified), 1):
             Widgets.redraw_interface(i / total, basename(photo.filename))
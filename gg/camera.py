@@ -28,7 +28,8 @@ from os import environ
 
 from gg.common import staticmethod
 from gg.widgets import Builder, Widgets
-from gg.common import GSettings, Binding, memoize
+from gg.common import GSettings, Binding, memoize, points
+from gg.gpsmath import update_derived_properties
 from gg.territories import tz_regions, get_timezone
 
 
@@ -151,11 +152,25 @@ class Camera(GObject.GObject):
         self.timezone_method = 'offset'
 
     def offset_handler(self, *ignore):
-        """When the offset is changed, update the loaded photos."""
-        for i, photo in enumerate(self.photos):
-            if not i % 10:
-                Widgets.redraw_interface()
-            photo.calculate_timestamp(self.offset)
+        """When the offset is changed, update the loaded photos.
+
+        All the timestamps are recalculated first, and then every photo that
+        wasn't positioned manually is interpolated along the GPS tracks in a
+        single batch and then geocoded in a single batch, which keeps the
+        offset slider responsive even with thousands of photos loaded.
+        """
+        photos = list(self.photos)
+        for photo in photos:
+            photo.calculate_timestamp(self.offset, False)
+
+        automatic = [photo for photo in photos if not photo.manual]
+        if not automatic or len(points) < 2:
+            return
+
+        positions = points.interpolate([p.timestamp for p in automatic])
+        for photo, lat, lon, ele in zip(automatic, *positions):
+            photo.set_location(lat, lon, ele)
+        update_derived_properties(automatic)
 
     def add_photo(self, photo):
         """Adds photo to the list of photos taken by this camera."""
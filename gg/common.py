@@ -6,21 +6,200 @@
 The `selected` and `modified` set()s contain Photograph() instances, and
 are frequently used for iteration and membership testing throughout the app.
 
-The `points` dict maps epoch seconds to ChamplainCoordinate() instances. This
-is used to place photos on the map by looking up their timestamps.
+The `points` TrackPoints maps epoch seconds to the latitude, longitude, and
+elevation of every loaded GPS track point. This is used to place photos on
+the map by looking up their timestamps. The points are kept in arrays sorted
+by time, so that the points surrounding any given timestamp can be found with
+a binary search instead of a linear scan.
 """
 
 
 from gi.repository import GObject, Gio, GLib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+from os.path import join
 from functools import wraps
+from os import makedirs
+from collections import namedtuple, OrderedDict
+from bisect import bisect_left, bisect_right
+from weakref import KeyedRef
+from threading import RLock
+from array import array
 
 from gg.version import PACKAGE
 
 
+TrackPoint = namedtuple('TrackPoint', 'lat lon ele')
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions size maxsize')
+
+
+class TrackPoints:
+    """Map epoch seconds to track points, stored as parallel sorted arrays.
+
+    Rather than keeping an object around for every single point, the times,
+    latitudes, longitudes, and elevations each live in their own contiguous
+    array of doubles, sorted by time. Individual TrackPoint tuples are only
+    created on demand.
+
+    >>> pts = TrackPoints([30, 10, 20], [3, 1, 2], [6, 2, 4], [9, 3, 6])
+    >>> list(pts)
+    [10.0, 20.0, 30.0]
+    >>> pts[20]
+    TrackPoint(lat=2.0, lon=4.0, ele=6.0)
+    >>> pts.bracket(25)
+    (20.0, 30.0)
+    >>> pts.prune(TrackPoints([20], [2], [4], [6]))
+    >>> pts.bracket(25)
+    (10.0, 30.0)
+    >>> pts.clear()
+    >>> len(pts)
+    0
+    """
+
+    def __init__(self, times=(), lats=(), lons=(), eles=()):
+        # Keep only the last of any duplicated timestamps, like a dict would.
+        order = sorted(range(len(times)), key=times.__getitem__)
+        keep = [i for i, j in zip(order, order[1:]) if times[i] != times[j]]
+        keep.extend(order[-1:])
+
+        self.timeline = array('d', [times[i] for i in keep])
+        self.lats = array('d', [lats[i] for i in keep])
+        self.lons = array('d', [lons[i] for i in keep])
+        self.eles = array('d', [eles[i] for i in keep])
+
+    def __len__(self):
+        return len(self.timeline)
+
+    def __iter__(self):
+        return iter(self.timeline)
+
+    def __contains__(self, timestamp):
+        timeline = self.timeline
+        i = bisect_left(timeline, timestamp)
+        return i < len(timeline) and timeline[i] == timestamp
+
+    def __getitem__(self, timestamp):
+        """Look up the TrackPoint at the given time."""
+        i = bisect_left(self.timeline, timestamp)
+        if i == len(self.timeline) or self.timeline[i] != timestamp:
+            raise KeyError(timestamp)
+        return TrackPoint(self.lats[i], self.lons[i], self.eles[i])
+
+    def get(self, timestamp, default=None):
+        """Look up the TrackPoint at the given time, if there is one."""
+        try:
+            return self[timestamp]
+        except KeyError:
+            return default
+
+    def columns(self):
+        """Return the parallel arrays of time, lat, lon, and ele."""
+        return self.timeline, self.lats, self.lons, self.eles
+
+    def set_columns(self, timeline, lats, lons, eles):
+        """Replace all of the points with already sorted, unique columns."""
+        self.timeline, self.lats, self.lons, self.eles = \
+            timeline, lats, lons, eles
+
+    def update(self, other, replace=True):
+        """Merge another TrackPoints into this one.
+
+        Points from the other TrackPoints win any timestamp collisions,
+        unless replace is False. Sorting two concatenated sorted runs is
+        linear, so this is much cheaper than inserting points one at a time.
+        """
+        if not len(other):
+            return
+        first, second = (self, other) if replace else (other, self)
+        columns = [array('d', column) for column in first.columns()]
+        for column, extra in zip(columns, second.columns()):
+            column.extend(extra)
+        self.set_columns(*TrackPoints(*columns).columns())
+
+    def between(self, start, end):
+        """Select the points from start to end, inclusive."""
+        lo = bisect_left(self.timeline, start)
+        hi = bisect_right(self.timeline, end)
+        selection = TrackPoints()
+        selection.set_columns(*[column[lo:hi] for column in self.columns()])
+        return selection
+
+    def prune(self, other):
+        """Remove the given points, unless they've been replaced since."""
+        ours, theirs = self.columns(), other.columns()
+        keep = []
+        j, count = 0, len(other)
+        for i, timestamp in enumerate(self.timeline):
+            j = bisect_left(theirs[0], timestamp, j)
+            if j == count or timestamp != theirs[0][j] or \
+                    any(mine[i] != yours[j]
+                        for mine, yours in zip(ours, theirs)):
+                keep.append(i)
+        self.set_columns(*[array('d', [column[i] for i in keep])
+                           for column in ours])
+
+    def clear(self):
+        """Forget everything."""
+        self.set_columns(*TrackPoints().columns())
+
+    def bracket(self, timestamp):
+        """Find the two timestamps on either side of the given one.
+
+        The timestamp must lie strictly within the range of the timeline.
+        """
+        timeline = self.timeline
+        i = bisect_left(timeline, timestamp)
+        return timeline[i - 1], timeline[i]
+
+    def interpolate(self, timestamps):
+        """Calculate the positions at many timestamps in a single pass.
+
+        Timestamps are clamped within the range of the timeline, and any that
+        fall between two points are linearly interpolated. Returns arrays of
+        latitudes, longitudes, and elevations in the order that the timestamps
+        were given.
+
+        >>> pts = TrackPoints([10, 20], [1, 2], [2, 4], [3, 6])
+        >>> [list(column) for column in pts.interpolate([25, 15, 10, 0])]
+        [[2.0, 1.5, 1.0, 1.0], [4.0, 3.0, 2.0, 2.0], [6.0, 4.5, 3.0, 3.0]]
+        """
+        times, lats, lons, eles = self.columns()
+        first, last = times[0], times[-1]
+        count = len(timestamps)
+        lat_out, lon_out, ele_out = [array('d', [0.0]) * count
+                                     for column in range(3)]
+
+        # Visiting the timestamps in sorted order means that each search
+        # only has to look beyond wherever the previous one left off.
+        hi = 0
+        for i in sorted(range(count), key=timestamps.__getitem__):
+            stamp = min(max(timestamps[i], first), last)
+            hi = bisect_left(times, stamp, hi)
+            if times[hi] == stamp:
+                lat_out[i], lon_out[i], ele_out[i] = \
+                    lats[hi], lons[hi], eles[hi]
+                continue
+
+            # Proportional amount of time between each point & the photo.
+            lo = hi - 1
+            span = times[hi] - times[lo]
+            hi_ratio = (stamp - times[lo]) / span
+            lo_ratio = (times[hi] - stamp) / span
+            lat_out[i] = lats[lo] * lo_ratio + lats[hi] * hi_ratio
+            lon_out[i] = lons[lo] * lo_ratio + lons[hi] * hi_ratio
+            ele_out[i] = eles[lo] * lo_ratio + eles[hi] * hi_ratio
+
+        return lat_out, lon_out, ele_out
+
+
 # These variables are used for sharing data between classes
 selected = set()
 modified = set()
-points   = {}
+points   = TrackPoints()
+
+# Worker threads for slow jobs that must not block the GTK main loop.
+# Jobs submitted here must never touch any widgets.
+background = ThreadPoolExecutor(max_workers=cpu_count())
 
 
 try:
@@ -46,6 +225,16 @@ except ImportError:
             pass
 
 
+def get_cache_dir(name):
+    """Locate one of our directories within the XDG cache directory.
+
+    The directory is created if it doesn't already exist.
+    """
+    path = join(GLib.get_user_cache_dir(), PACKAGE, name)
+    makedirs(path, exist_ok=True)
+    return path
+
+
 def singleton(cls):
     """Decorate a class with @singleton when There Can Be Only One.
 
@@ -62,7 +251,145 @@ def singleton(cls):
     return single()
 
 
-def memoize(obj):
+class Cache:
+    """A thread-safe dictionary that can limit how much it remembers.
+
+    With a maxsize, the least recently used entries are evicted to make room
+    for new ones. With weak=True, entries are evicted as soon as nothing else
+    refers to their values. Hits, misses, and evictions are counted so that
+    the effectiveness of the cache can be measured.
+
+    >>> cache = Cache(maxsize=2)
+    >>> cache['a'], cache['b'] = 1, 2
+    >>> cache['a']
+    1
+    >>> cache['c'] = 3
+    >>> sorted(cache.values())
+    [1, 3]
+    >>> 'b' in cache
+    False
+    >>> cache.get('b', 'Missing')
+    'Missing'
+    >>> cache.info()
+    CacheInfo(hits=1, misses=1, evictions=1, size=2, maxsize=2)
+    """
+
+    def __init__(self, maxsize=None, weak=False):
+        self.maxsize = maxsize
+        self.weak = weak
+        self.data = OrderedDict()
+        self.lock = RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        with self.lock:
+            try:
+                value = self.fetch(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = (
+                KeyedRef(value, self.expire, key) if self.weak else value)
+            if self.maxsize is not None:
+                self.data.move_to_end(key)
+                while len(self.data) > self.maxsize:
+                    self.data.popitem(last=False)
+                    self.evictions += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def fetch(self, key):
+        """Look up a key without counting it as a hit or a miss."""
+        with self.lock:
+            value = self.data[key]
+            if self.weak:
+                value = value()
+                if value is None:
+                    raise KeyError(key)
+            if self.maxsize is not None:
+                self.data.move_to_end(key)
+            return value
+
+    def expire(self, ref):
+        """Forget values that have been garbage collected."""
+        with self.lock:
+            if self.data.get(ref.key) is ref:
+                del self.data[ref.key]
+                self.evictions += 1
+
+    def get(self, key, default=None):
+        """Look up a key, returning the default if it is missing."""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, default=None):
+        """Forget a key, returning its value or the default if missing."""
+        with self.lock:
+            try:
+                value = self.fetch(key)
+            except KeyError:
+                value = default
+            self.data.pop(key, None)
+            return value
+
+    def setdefault(self, key, value):
+        """Insert value unless some other thread got there first."""
+        with self.lock:
+            try:
+                return self.fetch(key)
+            except KeyError:
+                self[key] = value
+                return value
+
+    def values(self):
+        """List the values that are currently cached."""
+        with self.lock:
+            values = list(self.data.values())
+        if self.weak:
+            values = [value for value in (ref() for ref in values)
+                      if value is not None]
+        return values
+
+    def clear(self):
+        """Forget everything, but keep counting."""
+        with self.lock:
+            self.data.clear()
+
+    def info(self):
+        """Report on how effective the cache has been."""
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         len(self.data), self.maxsize)
+
+
+class CachedValues:
+    """A live view of the values in a Cache, as used by memoize."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __iter__(self):
+        return iter(self.cache.values())
+
+    def __len__(self):
+        return len(self.cache)
+
+
+def memoize(obj=None, **options):
     """General-purpose cache for classes, methods, and functions.
 
     Functions are cached by their arguments:
@@ -111,17 +438,36 @@ def memoize(obj):
     False
     >>> len(Memorable.instances)
     2
+
+    By default nothing is ever forgotten, but the maxsize and weak options of
+    Cache can be passed in to bound the memory used:
+
+    >>> @memoize(maxsize=1)
+    ... def tripler(foo):
+    ...     print('performing expensive calculation...')
+    ...     return foo * 3
+    >>> tripler(1), tripler(2), tripler(1)
+    performing expensive calculation...
+    performing expensive calculation...
+    performing expensive calculation...
+    (3, 6, 3)
+    >>> tripler.cache.info()
+    CacheInfo(hits=0, misses=3, evictions=2, size=1, maxsize=1)
     """
-    cache = obj.cache = {}
-    obj.instances = cache.values()
+    if obj is None:
+        return lambda obj: memoize(obj, **options)
+
+    cache = obj.cache = Cache(**options)
+    obj.instances = CachedValues(cache)
 
     @wraps(obj)
     def memoizer(*args, **kwargs):
         """Do cache lookups and populate the cache in the case of misses."""
-        key = args[0] if len(args) is 1 else args
-        if key not in cache:
-            cache[key] = obj(*args, **kwargs)
-        return cache[key]
+        key = args[0] if len(args) == 1 else args
+        try:
+            return cache[key]
+        except KeyError:
+            return cache.setdefault(key, obj(*args, **kwargs))
     return memoizer
 
 
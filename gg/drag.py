@@ -68,7 +68,8 @@ class DragController(object):
         """Respond to drops and position photos accordingly.
 
         This method allows photos to be dropped in from the photo
-        pane or any other drag source, such as the file browser.
+        pane or any other drag source, such as the file browser. Dropped
+        directories are searched for photos, which get positioned too.
         """
         if not data.get_text():
             return
@@ -78,15 +79,19 @@ class DragController(object):
         files = [unquote(urlparse(s).path.strip()) for s in
                  data.get_text().split('\n') if s]
 
-        if self.external_drag:
-            self.open_files(files)
-        self.external_drag = True
+        def position(files):
+            """Place the dropped photos where they were dropped."""
+            if on_map:
+                for filename in files:
+                    photo = Photograph.cache.get(filename)
+                    if photo is not None:
+                        photo.manual = True
+                        photo.set_location(lat, lon)
 
-        if on_map:
-            for filename in files:
-                photo = Photograph.cache.get(filename)
-                if photo is not None:
-                    photo.manual = True
-                    photo.set_location(lat, lon)
+            self.selection.emit('changed')
 
-        self.selection.emit('changed')
+        if self.external_drag:
+            self.open_files(files, position)
+        else:
+            position(files)
+        self.external_drag = True
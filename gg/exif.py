@@ -0,0 +1,283 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2010
+# Copyright: See COPYING file included with this distribution.
+
+"""Read photo metadata without reading the whole photo.
+
+GExiv2 reads the entire file, which adds up when scanning a large archive
+over a network share. JPEG files keep their EXIF and XMP in APP1 segments
+ahead of the image data, and TIFF-based raw files keep their EXIF in the
+first few IFDs, so only those few kilobytes are read here. The tags are
+named the way GExiv2 names them, so that the results can be used in its
+place. The location of the small JPEG thumbnail in IFD1 is recorded as an
+offset from the start of the file, so that it can be read directly too.
+GExiv2 is still used for writing metadata.
+"""
+
+from struct import Struct, error as StructError
+from re import compile as re_compile
+
+
+# The tags we need from each IFD, named the way GExiv2 names them.
+TIFF_TAGS = {
+    'Image': {
+        0x010F: 'Exif.Image.Make',
+        0x0110: 'Exif.Image.Model',
+        0x0112: 'Exif.Image.Orientation',
+        0x0132: 'Exif.Image.DateTime',
+        0x9003: 'Exif.Image.DateTimeOriginal',
+        0xC62F: 'Exif.Image.CameraSerialNumber',
+    },
+    'Photo': {
+        0x0132: 'Exif.Photo.DateTime',
+        0x9003: 'Exif.Photo.DateTimeOriginal',
+        0xA431: 'Exif.Photo.BodySerialNumber',
+    },
+    'Thumbnail': {
+        0x0201: 'Exif.Thumbnail.JPEGInterchangeFormat',
+        0x0202: 'Exif.Thumbnail.JPEGInterchangeFormatLength',
+    },
+    'GPSInfo': {
+        0x0001: 'Exif.GPSInfo.GPSLatitudeRef',
+        0x0002: 'Exif.GPSInfo.GPSLatitude',
+        0x0003: 'Exif.GPSInfo.GPSLongitudeRef',
+        0x0004: 'Exif.GPSInfo.GPSLongitude',
+        0x0005: 'Exif.GPSInfo.GPSAltitudeRef',
+        0x0006: 'Exif.GPSInfo.GPSAltitude',
+    },
+}
+
+# IFD0 tags that point at the other IFDs we need.
+POINTERS = {0x8769: 'Photo', 0x8825: 'GPSInfo'}
+
+# Where IFD1 says the thumbnail is, relative to the TIFF header.
+THUMBNAIL = 'Exif.Thumbnail.JPEGInterchangeFormat'
+
+# The struct format and size of each TIFF field type that we understand.
+TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4),
+         5: ('II', 8), 7: ('s', 1), 9: ('i', 4), 10: ('ii', 8)}
+
+# The TIFF magic numbers, including the ones used by Olympus and Panasonic.
+ENDIAN = {b'II': '<', b'MM': '>'}
+MAGIC = (42, 0x4F52, 0x5352, 0x55)
+
+# Don't bother with any values bigger than this.
+MAX_VALUE = 4096
+
+# The headers of the APP1 segments that hold EXIF and XMP.
+EXIF_ID = b'Exif\0\0'
+XMP_ID = b'http://ns.adobe.com/xap/1.0/\0'
+
+# The XMP properties we need, and the EXIF tags they stand in for.
+XMP_TAGS = {
+    'exif:DateTimeOriginal': 'Exif.Photo.DateTimeOriginal',
+    'tiff:DateTime': 'Exif.Image.DateTime',
+    'tiff:Make': 'Exif.Image.Make',
+    'tiff:Model': 'Exif.Image.Model',
+    'tiff:Orientation': 'Exif.Image.Orientation',
+    'exif:GPSLatitude': 'Exif.GPSInfo.GPSLatitude',
+    'exif:GPSLongitude': 'Exif.GPSInfo.GPSLongitude',
+    'exif:GPSAltitudeRef': 'Exif.GPSInfo.GPSAltitudeRef',
+    'exif:GPSAltitude': 'Exif.GPSInfo.GPSAltitude',
+}
+XMP_FIELD = re_compile(r'((?:exif|tiff):\w+)(?:="([^"]*)"|>([^<]*)<)')
+XMP_COORD = re_compile(r'(\d+),(\d+(?:\.\d*)?)(?:,(\d+(?:\.\d*)?))?([NSEW])')
+
+SEGMENT = Struct('>BBH')
+
+
+class Tags(dict):
+    """The tags read from a photo, keyed the way GExiv2 names them.
+
+    >>> tags = Tags({'Exif.GPSInfo.GPSLatitude': (49.0, 53.0, 0.0),
+    ...              'Exif.GPSInfo.GPSLatitudeRef': 'N',
+    ...              'Exif.GPSInfo.GPSLongitude': (97.0, 9.0, 0.0),
+    ...              'Exif.GPSInfo.GPSLongitudeRef': 'W',
+    ...              'Exif.GPSInfo.GPSAltitude': 230.0})
+    >>> ['{:.5f}'.format(value) for value in tags.get_gps_info()]
+    ['-97.15000', '49.88333', '230.00000']
+    """
+
+    def degrees(self, key, negative):
+        """Combine the degrees, minutes, and seconds of a coordinate."""
+        try:
+            degrees, minutes, seconds = self[key]
+        except (KeyError, TypeError, ValueError):
+            return 0.0
+        value = degrees + minutes / 60 + seconds / 3600
+        return -value if self.get(key + 'Ref') == negative else value
+
+    def get_gps_info(self):
+        """Return the longitude, latitude, and altitude, like GExiv2 does."""
+        altitude = self.get('Exif.GPSInfo.GPSAltitude', 0.0)
+        if not isinstance(altitude, float):
+            altitude = 0.0
+        if self.get('Exif.GPSInfo.GPSAltitudeRef') == 1:
+            altitude = -altitude
+        return (self.degrees('Exif.GPSInfo.GPSLongitude', 'W'),
+                self.degrees('Exif.GPSInfo.GPSLatitude', 'S'),
+                altitude)
+
+
+def decode(order, kind, count, data):
+    """Convert the raw bytes of a TIFF field into a python value."""
+    code, size = TYPES[kind]
+    if code == 's':
+        return str(data[:count].split(b'\0')[0], 'utf-8', 'replace').strip()
+    values = Struct(order + code * count).unpack_from(data)
+    if size == 8:
+        values = tuple(top / bottom if bottom else 0.0
+                       for top, bottom in zip(values[::2], values[1::2]))
+    return values[0] if count == 1 else values
+
+
+def read_tiff(fetch, tags, base=0):
+    """Read the tags we need from TIFF data.
+
+    fetch(offset, size) returns the bytes at that offset from the start of
+    the TIFF header, so that nothing else needs to be read. The TIFF header
+    starts base bytes into the file.
+    """
+    order = ENDIAN.get(fetch(0, 2))
+    if order is None:
+        raise ValueError('Not TIFF data.')
+    short, long = Struct(order + 'H'), Struct(order + 'I')
+    entry = Struct(order + 'HHI')
+    if short.unpack(fetch(2, 2))[0] not in MAGIC:
+        raise ValueError('Not TIFF data.')
+
+    ifds = [('Image', long.unpack(fetch(4, 4))[0])]
+    seen = set()
+    following = None
+
+    def read_ifd(group, offset, tags):
+        """Read one IFD, returning where its pointer to the next one is."""
+        count, = short.unpack(fetch(offset, 2))
+        entries = fetch(offset + 2, 12 * count)
+        names = TIFF_TAGS[group]
+        for i in range(0, 12 * count, 12):
+            tag, kind, number = entry.unpack_from(entries, i)
+            if group == 'Image' and tag in POINTERS:
+                pointer, = long.unpack_from(entries, i + 8)
+                ifds.append((POINTERS[tag], pointer))
+                continue
+            if tag not in names or kind not in TYPES:
+                continue
+            length = TYPES[kind][1] * number
+            if not number or length > MAX_VALUE:
+                continue
+            data = entries[i + 8:i + 12]
+            if length > 4:
+                data = fetch(long.unpack(data)[0], length)
+            tags[names[tag]] = decode(order, kind, number, data)
+        return offset + 2 + 12 * count
+
+    while ifds:
+        group, offset = ifds.pop()
+        if not offset or offset in seen:
+            continue
+        seen.add(offset)
+        end = read_ifd(group, offset, tags)
+        if group == 'Image':
+            following = end
+
+    # IFD1 holds the thumbnail, which is nice to have but not essential.
+    thumbnail = {}
+    try:
+        offset, = long.unpack(fetch(following, 4))
+        if offset and offset not in seen:
+            read_ifd('Thumbnail', offset, thumbnail)
+    except (StructError, ValueError, TypeError):
+        pass
+    if len(thumbnail) == 2:
+        thumbnail[THUMBNAIL] += base
+        tags.update(thumbnail)
+
+
+def read_xmp(packet, tags):
+    """Read the properties we need from an XMP packet."""
+    for name, attribute, element in XMP_FIELD.findall(
+            str(packet, 'utf-8', 'replace')):
+        key = XMP_TAGS.get(name)
+        value = (attribute or element).strip()
+        if key is None or not value:
+            continue
+        if 'DateTime' in key:
+            # 2010-10-16T14:12:28-06:00 becomes 2010:10:16 14:12:28
+            value = value[:19].replace('-', ':', 2).replace('T', ' ')
+        elif key.endswith(('Latitude', 'Longitude')):
+            match = XMP_COORD.match(value)
+            if match is None:
+                continue
+            degrees, minutes, seconds, ref = match.groups()
+            tags[key + 'Ref'] = ref
+            value = (float(degrees), float(minutes), float(seconds or 0))
+        elif key.endswith('Altitude'):
+            top, slash, bottom = value.partition('/')
+            value = float(top) / float(bottom or 1)
+        elif key.endswith(('Orientation', 'Ref')):
+            value = int(value)
+        tags[key] = value
+
+
+def read_jpeg(photo, tags, xmp):
+    """Read the APP1 segments that come before the image data of a JPEG."""
+    while True:
+        header = photo.read(SEGMENT.size)
+        if len(header) < SEGMENT.size:
+            return
+        mark, kind, length = SEGMENT.unpack(header)
+        if mark != 0xFF or kind in (0xD9, 0xDA) or length < 2:
+            return
+        if kind != 0xE1:
+            photo.seek(length - 2, 1)
+            continue
+        base = photo.tell() + len(EXIF_ID)
+        data = photo.read(length - 2)
+        if data.startswith(EXIF_ID):
+            data = memoryview(data)[len(EXIF_ID):]
+            read_tiff(lambda offset, size: fetch(data, offset, size), tags,
+                      base)
+        elif data.startswith(XMP_ID):
+            read_xmp(data[len(XMP_ID):], xmp)
+
+
+def fetch(data, offset, size):
+    """Slice some bytes, insisting that they are all there."""
+    chunk = data[offset:offset + size]
+    if len(chunk) != size:
+        raise ValueError('Truncated data.')
+    return bytes(chunk)
+
+
+def read_header(filename):
+    """Read the metadata of a JPEG or TIFF-based raw photo.
+
+    EXIF tags take precedence over XMP ones. Raises OSError if the file is
+    some other kind of file, or if its metadata can't be understood.
+
+    >>> tags = read_header('demo/IMG_2411.JPG')
+    >>> tags['Exif.Image.Model']
+    'Canon PowerShot A590 IS'
+    >>> tags['Exif.Photo.DateTimeOriginal']
+    '2010:10:16 14:12:28'
+    >>> read_header('gg/exif.py')
+    Traceback (most recent call last):
+    OSError: gg/exif.py: No metadata found.
+    """
+    tags, xmp = Tags(), {}
+    try:
+        with open(filename, 'rb') as photo:
+            start = photo.read(2)
+            if start == b'\xff\xd8':
+                read_jpeg(photo, tags, xmp)
+            else:
+                def read(offset, size):
+                    """Read only the requested bytes of the file."""
+                    photo.seek(offset)
+                    return fetch(photo.read(size), 0, size)
+                read_tiff(read, tags)
+    except (StructError, ValueError, KeyError):
+        raise OSError('{}: No metadata found.'.format(filename))
+    for key, value in xmp.items():
+        tags.setdefault(key, value)
+    return tags
@@ -0,0 +1,152 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2010
+# Copyright: See COPYING file included with this distribution.
+
+"""Identify files by what's in them, rather than what they're called.
+
+Only the first few kilobytes of each file are read, so that every file can
+be sent straight to the right loader, and GPS tracks never get decoded as
+images. Gzipped tracks and KMZ archives are opened transparently. Whole
+directory trees can be searched for files, too.
+"""
+
+from xml.parsers.expat import ParserCreate, ExpatError
+from zipfile import ZipFile, BadZipFile
+from zlib import error as ZlibError
+from gzip import open as gunzip
+from io import TextIOWrapper
+from os.path import isdir
+from os import scandir
+
+# How much of each file to look at.
+HEAD = 4096
+
+GZIP = b'\x1f\x8b'
+ZIP = b'PK\x03\x04'
+UTF16 = (b'\xff\xfe', b'\xfe\xff')
+
+# The root element of each XML track format.
+ROOTS = {'gpx': 'gpx', 'TrainingCenterDatabase': 'tcx', 'kml': 'kml'}
+
+
+class Found(Exception):
+    """Stop parsing once the root element has been found."""
+
+
+def root_element(head):
+    """Find the name of the root element of some XML, without namespaces.
+
+    >>> root_element(b'<?xml version="1.0"?><!-- hi --><gpx version="1.1">')
+    'gpx'
+    >>> root_element(b'<kml:kml xmlns:kml="http://www.opengis.net/kml/2.2">')
+    'kml'
+    >>> root_element(b'"Segment","Latitude (deg)"') is None
+    True
+    """
+    def found(name, attributes):
+        """Report the first element."""
+        raise Found(name.rpartition(':')[2])
+
+    parser = ParserCreate()
+    parser.StartElementHandler = found
+    try:
+        parser.Parse(head, False)
+    except Found as root:
+        return root.args[0]
+    except ExpatError:
+        pass
+
+
+def kml_member(archive):
+    """Find the KML document inside of a KMZ archive."""
+    names = [name for name in archive.namelist()
+             if name.lower().endswith('.kml')]
+    if not names:
+        raise OSError('{}: No KML found.'.format(archive.filename))
+    return 'doc.kml' if 'doc.kml' in names else names[0]
+
+
+def open_track(filename):
+    """Open a GPS track for reading bytes, decompressing it if necessary."""
+    with open(filename, 'rb') as track:
+        magic = track.read(len(ZIP))
+    try:
+        if magic.startswith(GZIP):
+            return gunzip(filename)
+        if magic == ZIP:
+            with ZipFile(filename) as archive:
+                return archive.open(kml_member(archive))
+    except BadZipFile:
+        raise OSError('{}: Bad KMZ file.'.format(filename))
+    return open(filename, 'rb')
+
+
+def open_text(filename):
+    """Open a GPS track for reading lines of text."""
+    return TextIOWrapper(open_track(filename))
+
+
+def find_files(paths):
+    """Generate the given files, and all the files in the given directories.
+
+    Directories are searched one at a time, as the files are consumed, so the
+    first files are found right away even in huge trees. Hidden files are
+    skipped, and symlinks to directories aren't followed, to avoid loops.
+
+    >>> list(find_files(['demo']))
+    ['demo/2010 10 16.gpx', 'demo/IMG_2411.JPG', 'demo/IMG_2421.JPG']
+    """
+    for path in paths:
+        if not isdir(path):
+            yield path
+            continue
+        stack = [path]
+        while stack:
+            try:
+                with scandir(stack.pop()) as entries:
+                    entries = sorted((entry for entry in entries
+                                      if not entry.name.startswith('.')),
+                                     key=lambda entry: entry.name)
+            except OSError:
+                continue
+            directories = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                yield entry.path
+            stack.extend(reversed(directories))
+
+
+def sniff(filename):
+    """Determine what kind of file this is.
+
+    Returns 'gpx', 'tcx', 'kml', or 'csv' for GPS tracks, and 'photo' for
+    anything else that isn't text. Raises OSError for unreadable files, and
+    for text files that aren't GPS tracks.
+
+    >>> sniff('demo/IMG_2411.JPG')
+    'photo'
+    >>> sniff('demo/2010 10 16.gpx')
+    'gpx'
+    >>> sniff('gg/widgets.py')
+    Traceback (most recent call last):
+    OSError: gg/widgets.py: Unknown file type.
+    """
+    try:
+        with open_track(filename) as track:
+            head = track.read(HEAD)
+    except (EOFError, ValueError, ZlibError):
+        raise OSError('{}: Bad compressed file.'.format(filename))
+
+    root = root_element(head)
+    if root is not None:
+        if root in ROOTS:
+            return ROOTS[root]
+    elif b'\0' in head and not head.startswith(UTF16):
+        return 'photo'
+    elif b'"Latitude (deg)"' in head or filename.lower().endswith('.csv'):
+        return 'csv'
+    raise OSError('{}: Unknown file type.'.format(filename))
@@ -0,0 +1,360 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2010
+# Copyright: See COPYING file included with this distribution.
+
+"""Find cities by location or by name, using the geonames.org data.
+
+tools/update_cities.py boils the geonames.org dump down into cities.txt, and
+then compiles that into cities.db, a binary database that is memory-mapped
+at runtime so that no text needs to be parsed before the first lookup, and
+so that the pages can be shared between processes. This module has no
+dependencies beyond the standard library so that the tool can use it.
+
+The database starts with a header and a table of sections, each of which is
+a little-endian array that is 8-byte aligned within the file:
+
+    lats, lons                       Coordinates of each city.
+    populations                      Population of each city.
+    names, states, countries, zones  String ids for each city.
+    keys                             String id of each city's folded name.
+    text, offsets                    UTF-8 blob, where string N spans from
+                                     offsets[N] to offsets[N+1].
+    grid, cells                      Cities in each one degree grid cell,
+                                     found at cells[grid[N]:grid[N+1]].
+    trigrams, starts, postings       Sorted string ids of every three letter
+                                     sequence in the folded city names,
+                                     with the cities containing trigram N at
+                                     postings[starts[N]:starts[N+1]].
+"""
+
+from unicodedata import combining, normalize
+from struct import Struct, error as StructError
+from collections import defaultdict
+from tempfile import mkstemp
+from os.path import dirname
+from os import fdopen, chmod, replace
+from heapq import nlargest
+from mmap import mmap, ACCESS_READ
+from bisect import bisect_left
+from itertools import count
+from sys import byteorder
+from array import array
+from math import floor
+
+
+MAGIC = b'GGCITIES'
+VERSION = 3
+HEADER = Struct('<8sII')
+SECTION = Struct('<QQ')
+SECTIONS = (
+    ('lats', 'd'), ('lons', 'd'), ('populations', 'I'),
+    ('names', 'I'), ('states', 'I'), ('countries', 'I'), ('zones', 'I'),
+    ('keys', 'I'),
+    ('text', 'B'), ('offsets', 'I'),
+    ('grid', 'I'), ('cells', 'I'),
+    ('trigrams', 'I'), ('starts', 'I'), ('postings', 'I'),
+)
+
+# The grid covers every whole degree of latitude and longitude, inclusive.
+ROWS, COLS = 181, 361
+
+
+def fold(name):
+    """Strip the accents and case from a name, so that it can be searched.
+
+    >>> fold('São Paulo')
+    'sao paulo'
+    >>> fold('ZÜRICH')
+    'zurich'
+    >>> fold('Großenhain')
+    'grossenhain'
+    """
+    return ''.join(char for char in normalize('NFKD', name)
+                   if not combining(char)).casefold()
+
+
+def trigrams(key):
+    """Find every three letter sequence in a folded city name.
+
+    >>> sorted(trigrams(fold('Regina')))
+    ['egi', 'gin', 'ina', 'reg']
+    """
+    return set(key[i:i + 3] for i in range(len(key) - 2))
+
+
+class CityIndex:
+    """Find the nearest city without scanning every city.
+
+    Cities are bucketed into a grid of one degree cells, and queries search
+    outwards from the cell containing the query point, one ring of cells at a
+    time, stopping once no unsearched cell could hold anything nearer. The
+    distance is measured in squared degrees, and ties go to whichever city
+    came first in the file, so the results are identical to a linear scan.
+
+    Each line holds the name, latitude, longitude, country code, admin code,
+    timezone, and optionally the population of a city.
+
+    >>> index = CityIndex(['Here\\t10\\t10\\tAA\\t01\\tZone/Here\\n',
+    ...                    'There\\t-10.5\\t20\\tBB\\t02\\tZone/There\\n'])
+    >>> index.nearest(9, 12)
+    ('Here', '01', 'AA', 'Zone/Here')
+    >>> index.nearest(-80, 170)
+    ('There', '02', 'BB', 'Zone/There')
+    """
+    size = 1.0
+    rings = int(360 / size) + 1
+
+    def __init__(self, lines):
+        self.lats = array('d')
+        self.lons = array('d')
+        self.populations = array('I')
+        self.places = []
+        self.grid = defaultdict(list)
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            name, lat, lon, country, state, tz = fields[:6]
+            lat, lon = float(lat), float(lon)
+            self.grid[self.cell(lat, lon)].append(len(self.places))
+            self.lats.append(lat)
+            self.lons.append(lon)
+            self.populations.append(int(fields[6] or 0)
+                                    if len(fields) > 6 else 0)
+            self.places.append((name, state, country, tz))
+        self.grid = dict(self.grid)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def place(self, city):
+        """Return the name, state, country, and timezone of a city."""
+        return self.places[city]
+
+    def cell(self, lat, lon):
+        """Identify the grid cell that contains the given point."""
+        return floor(lat / self.size), floor(lon / self.size)
+
+    @staticmethod
+    def perimeter(row, col, radius):
+        """List the cells that are radius cells away from the given cell."""
+        if not radius:
+            return [(row, col)]
+        top, bottom = row - radius, row + radius
+        cells = [(top, col + i) for i in range(-radius, radius + 1)]
+        cells += [(bottom, col + i) for i in range(-radius, radius + 1)]
+        for i in range(top + 1, bottom):
+            cells += [(i, col - radius), (i, col + radius)]
+        return cells
+
+    def ring(self, row, col, radius):
+        """Generate the occupied cells that are radius cells away."""
+        grid = self.grid
+        for cell in self.perimeter(row, col, radius):
+            if cell in grid:
+                yield grid[cell]
+
+    def nearest(self, lat, lon):
+        """Return the name, state, country, and timezone of the nearest city.
+        """
+        lats, lons = self.lats, self.lons
+        row, col = self.cell(lat, lon)
+        near, dist = None, float('inf')
+        for radius in count():
+            # Everything outside the searched rings is at least this far away.
+            reach = (radius - 1) * self.size
+            if radius > self.rings or (reach > 0 and dist < reach * reach):
+                break
+            for cities in self.ring(row, col, radius):
+                for city in cities:
+                    x = lons[city] - lon
+                    y = lats[city] - lat
+                    delta = x * x + y * y
+                    if delta < dist or (delta == dist and city < near):
+                        dist = delta
+                        near = city
+        if near is not None:
+            return self.place(near)
+
+
+class Strings:
+    """Present a column of string ids as the strings themselves."""
+
+    def __init__(self, db, ids):
+        self.db = db
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.db.string(self.ids[i])
+
+
+def section(view, code):
+    """Interpret part of the database as an array of the given type."""
+    if code == 'B':
+        return view
+    if byteorder == 'little':
+        return view.cast(code)
+    values = array(code, view.tobytes())
+    values.byteswap()
+    return values
+
+
+class GeoNames(CityIndex):
+    """Memory-map a cities.db file built by write_database()."""
+
+    def __init__(self, filename):
+        try:
+            with open(filename, 'rb') as db:
+                self.data = mmap(db.fileno(), 0, access=ACCESS_READ)
+            view = memoryview(self.data)
+            magic, version, cities = HEADER.unpack_from(view)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError
+            offset = HEADER.size
+            for name, code in SECTIONS:
+                start, length = SECTION.unpack_from(view, offset)
+                offset += SECTION.size
+                if start + length > len(view):
+                    raise ValueError
+                setattr(self, name, section(view[start:start + length], code))
+            if len(self.lats) != cities:
+                raise ValueError
+        except (StructError, ValueError, TypeError):
+            raise OSError('{}: Not a city database.'.format(filename))
+
+    def string(self, number):
+        """Decode one of the strings from the string table."""
+        return str(self.text[self.offsets[number]:self.offsets[number + 1]],
+                   'utf-8')
+
+    def place(self, city):
+        """Return the name, state, country, and timezone of a city."""
+        return tuple(self.string(column[city]) for column in
+                     (self.names, self.states, self.countries, self.zones))
+
+    def ring(self, row, col, radius):
+        """Generate the occupied cells that are radius cells away."""
+        grid = self.grid
+        for row, col in self.perimeter(row, col, radius):
+            if -90 <= row <= 90 and -180 <= col <= 180:
+                cell = (row + 90) * COLS + col + 180
+                start, end = grid[cell], grid[cell + 1]
+                if start != end:
+                    yield self.cells[start:end]
+
+    def containing(self, trigram):
+        """Return every city whose folded name contains the trigram."""
+        keys = Strings(self, self.trigrams)
+        i = bisect_left(keys, trigram)
+        if i < len(keys) and keys[i] == trigram:
+            return self.postings[self.starts[i]:self.starts[i + 1]]
+        return ()
+
+    def search(self, query, limit=100):
+        """Return the best limit cities whose names contain the query.
+
+        Names and queries are compared with their accents and case folded
+        away, and the folded names are stored in the database. Only the cities
+        containing the rarest trigram of the query need to have their names
+        checked against the whole query. Exact matches rank
+        above names that start with the query, which rank above names with a
+        word that starts with it, and then everything else. Cities that match
+        equally well are ranked by population.
+        """
+        query = fold(query)
+        candidates = min((self.containing(trigram)
+                          for trigram in trigrams(query)), key=len, default=())
+        keys, populations = self.keys, self.populations
+
+        def ranked():
+            """Score the candidates that actually match."""
+            for city in candidates:
+                name = self.string(keys[city])
+                where = name.find(query)
+                if where < 0:
+                    continue
+                if name == query:
+                    quality = 3
+                elif not where:
+                    quality = 2
+                elif not name[where - 1].isalnum():
+                    quality = 1
+                else:
+                    quality = 0
+                yield quality, populations[city], -city
+
+        return [-city for quality, population, city in
+                nlargest(limit, ranked())]
+
+
+def write_database(lines, output):
+    """Compile the lines of cities.txt into a cities.db file."""
+    index = CityIndex(lines)
+
+    strings = {}
+
+    def intern(string):
+        """Store each distinct string only once."""
+        return strings.setdefault(string, len(strings))
+
+    columns = [array('I') for i in range(5)]
+    postings = defaultdict(list)
+    for city, place in enumerate(index.places):
+        key = fold(place[0])
+        for column, string in zip(columns, place + (key,)):
+            column.append(intern(string))
+        for trigram in trigrams(key):
+            postings[trigram].append(city)
+
+    grid, cells = array('I'), array('I')
+    for row in range(ROWS):
+        for col in range(COLS):
+            grid.append(len(cells))
+            cells.extend(index.grid.get((row - 90, col - 180), ()))
+    grid.append(len(cells))
+
+    keys, starts, flat = array('I'), array('I'), array('I')
+    for trigram in sorted(postings):
+        keys.append(intern(trigram))
+        starts.append(len(flat))
+        flat.extend(postings[trigram])
+    starts.append(len(flat))
+
+    text, offsets = bytearray(), array('I')
+    for string in sorted(strings, key=strings.get):
+        offsets.append(len(text))
+        text += string.encode('utf-8')
+    offsets.append(len(text))
+
+    sections = [index.lats, index.lons, index.populations, *columns,
+                text, offsets, grid, cells, keys, starts, flat]
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for i, values in enumerate(sections):
+        if byteorder != 'little' and isinstance(values, array):
+            values = array(values.typecode, values)
+            values.byteswap()
+        sections[i] = values = memoryview(values).cast('B')
+        offset += -offset % 8
+        table.append((offset, len(values)))
+        offset += len(values)
+
+    output.write(HEADER.pack(MAGIC, VERSION, len(index)))
+    for start, length in table:
+        output.write(SECTION.pack(start, length))
+    position = HEADER.size + SECTION.size * len(sections)
+    for (start, length), values in zip(table, sections):
+        output.write(bytes(start - position))
+        output.write(values)
+        position = start + length
+
+
+def compile_database(source, target):
+    """Compile a cities.txt file into a cities.db file, atomically."""
+    with open(source, encoding='utf-8') as lines:
+        fd, temp = mkstemp(dir=dirname(target) or '.', suffix='.tmp')
+        with fdopen(fd, 'wb') as output:
+            write_database(lines, output)
+    chmod(temp, 0o644)
+    replace(temp, target)
@@ -6,12 +6,16 @@
 
 from gi.repository import GLib, GObject
 from time import strftime, localtime
+from tempfile import mkstemp
+from os import stat, replace, fdopen
 from gettext import gettext as _
 from os.path import join
+import json
 
 from gg.territories import get_state, get_country
+from gg.geonames import GeoNames, compile_database
 from gg.build_info import PKG_DATA_DIR
-from gg.common import memoize
+from gg.common import memoize, ignored, get_cache_dir, background
 
 
 def valid_coords(lat, lon):
@@ -30,26 +34,158 @@ def valid_coords(lat, lon):
 
 
 @memoize
+def load_cities():
+    """Memory-map cities.db, just once.
+
+    If the installed cities.db is missing, or was built for another version
+    of the format, cities.txt is compiled into the cache directory instead.
+    That only happens again when cities.txt changes.
+    """
+    with ignored(OSError):
+        return GeoNames(join(PKG_DATA_DIR, 'cities.db'))
+    source = join(PKG_DATA_DIR, 'cities.txt')
+    filename = join(get_cache_dir('geonames'), 'cities.db')
+    with ignored(OSError):
+        cities = GeoNames(filename)
+        if stat(filename).st_mtime_ns >= stat(source).st_mtime_ns:
+            return cities
+    compile_database(source, filename)
+    return GeoNames(filename)
+
+
+@memoize(maxsize=10000)
 def do_cached_lookup(key):
-    """Scan cities.txt for the nearest town.
+    """Find the nearest town in cities.db.
 
     >>> do_cached_lookup(GeoCacheKey(43.646424, -79.333426))
-    ('Toronto', '08', 'CA', 'America/Toronto\\n')
+    ('Toronto', '08', 'CA', 'America/Toronto')
     >>> do_cached_lookup(GeoCacheKey(48.440257, -89.204443))
-    ('Thunder Bay', '08', 'CA', 'America/Thunder_Bay\\n')
+    ('Thunder Bay', '08', 'CA', 'America/Thunder_Bay')
+    """
+    return load_cities().nearest(key.lat, key.lon)
+
+
+def geocache_stamp():
+    """Identify the installed city data, so stale geocoding can be discarded.
     """
-    near, dist = None, float('inf')
-    lat1, lon1 = key.lat, key.lon
-    with open(join(PKG_DATA_DIR, 'cities.txt')) as cities:
-        for city in cities:
-            name, lat2, lon2, country, state, tz = city.split('\t')
-            x = (float(lon2) - lon1)
-            y = (float(lat2) - lat1)
-            delta = x * x + y * y
-            if delta < dist:
-                dist = delta
-                near = (name, state, country, tz)
-    return near
+    stamp = []
+    for name in ('cities.db', 'cities.txt'):
+        with ignored(OSError):
+            filename = join(PKG_DATA_DIR, name)
+            info = stat(filename)
+            stamp.append([filename, info.st_size, info.st_mtime_ns])
+    return stamp
+
+
+def restore_geocache():
+    """Reload the geocoding results that were saved by the last session."""
+    with ignored(OSError, ValueError, TypeError, KeyError):
+        filename = join(get_cache_dir('geonames'), 'places.json')
+        with open(filename, encoding='utf-8') as cache:
+            saved = json.load(cache)
+        if saved['stamp'] != geocache_stamp():
+            return
+        for key, place in saved['places'].items():
+            lat, lon = key.split(',')
+            city, state, code, tz = place
+            do_cached_lookup.cache[GeoCacheKey(float(lat), float(lon))] = (
+                city, state, code, tz)
+
+
+def save_geocache():
+    """Keep the geocoding results for the next session."""
+    places = {}
+    with do_cached_lookup.cache.lock:
+        for key, place in do_cached_lookup.cache.data.items():
+            places[str(key)] = place
+    with ignored(OSError):
+        directory = get_cache_dir('geonames')
+        fd, temp = mkstemp(dir=directory, suffix='.tmp')
+        with fdopen(fd, 'w', encoding='utf-8') as cache:
+            json.dump(dict(stamp=geocache_stamp(), places=places), cache)
+        replace(temp, join(directory, 'places.json'))
+
+
+def geocode(lats, lons):
+    """Reverse geocode many points at once.
+
+    Points are grouped by the cells used as GeoCacheKeys, so each distinct
+    cell is looked up only once, no matter how many points fall within it.
+    Returns the city, state, country, and timezone for each point.
+
+    >>> geocode([53.5444, 53.5445], [-113.4909, -113.4908])
+    [('Edmonton', 'Alberta', 'Canada', 'America/Edmonton'), \
+('Edmonton', 'Alberta', 'Canada', 'America/Edmonton')]
+    """
+    cells = {}
+    places = []
+    for lat, lon in zip(lats, lons):
+        # Rounds the same way as the string formatting in GeoCacheKey.
+        cell = (round(lat, 2), round(lon, 2))
+        try:
+            places.append(cells[cell])
+        except KeyError:
+            city, state, code, tz = do_cached_lookup(GeoCacheKey(lat, lon))
+            place = cells[cell] = (
+                city, get_state(code, state), get_country(code), tz.strip())
+            places.append(place)
+    return places
+
+
+def update_derived_properties(coordinates, wait=False):
+    """Do all the pending geodata lookups for many Coordinates in one batch.
+
+    This is much faster than letting every one of them time out separately.
+    With wait=True, the geodata is current by the time this returns, such as
+    is needed before saving, so any lookups still in the worker threads, or
+    not yet delivered to the main loop, are redone right away.
+    """
+    pending = [coord for coord in coordinates if coord.modified_timeout or
+               (wait and coord.delivered != coord.generation)]
+    for coord in pending:
+        if coord.modified_timeout:
+            GLib.source_remove(coord.modified_timeout)
+            coord.modified_timeout = None
+            coord.notify('positioned')
+        if coord.geocoding is not None:
+            coord.geocoding.cancel()
+            coord.geocoding = None
+
+    return resolve_geodata([c for c in pending if c.positioned], wait)
+
+
+def resolve_geodata(coordinates, wait=False):
+    """Geocode some Coordinates in a worker thread.
+
+    The results are delivered on the main loop, except for any Coordinates
+    that have since requested another lookup, since they have moved again.
+    Returns the worker's future, unless told to wait for the results.
+    """
+    generations = []
+    for coord in coordinates:
+        coord.generation += 1
+        generations.append(coord.generation)
+    lats = [coord.latitude for coord in coordinates]
+    lons = [coord.longitude for coord in coordinates]
+
+    if wait:
+        deliver_geodata(coordinates, generations, geocode(lats, lons))
+        return
+
+    job = background.submit(geocode, lats, lons)
+    job.add_done_callback(lambda job: job.cancelled() or GLib.idle_add(
+        lambda: deliver_geodata(coordinates, generations, job.result())))
+    return job
+
+
+def deliver_geodata(coordinates, generations, places):
+    """Apply geocoding results, skipping any that are no longer wanted."""
+    for coord, generation, place in zip(coordinates, generations, places):
+        if coord.generation == generation:
+            coord.geocoding = None
+            coord.delivered = generation
+            coord.set_geodata(*place)
+    return False
 
 
 class GeoCacheKey:
@@ -127,6 +263,9 @@ class Coordinates(GObject.GObject):
     'Stanley, Falkland Islands'
     """
     modified_timeout = None
+    geocoding = None
+    generation = 0
+    delivered = 0
     timeout_seconds = 0
     geotimezone = ''
     names = (None, None, None)
@@ -218,11 +357,13 @@ class Coordinates(GObject.GObject):
         if not self.positioned:
             return
 
+        return self.set_geodata(*geocode([self.latitude], [self.longitude])[0])
+
+    def set_geodata(self, city, state, country, tz):
+        """Store the results of geocoding, and notify of any changes."""
         old_geoname = self.geoname
-        city, state, code, tz = do_cached_lookup(
-            GeoCacheKey(self.latitude, self.longitude))
-        self.names = (city, get_state(code, state), get_country(code))
-        self.geotimezone = tz.strip()
+        self.names = (city, state, country)
+        self.geotimezone = tz
         if self.geoname != old_geoname:
             self.notify('geoname')
 
@@ -245,7 +386,10 @@ class Coordinates(GObject.GObject):
                 self.timeout_seconds, self.update_derived_properties)
 
     def update_derived_properties(self):
-        """Do expensive geodata lookups after the timeout.
+        """Start the expensive geodata lookups after the timeout.
+
+        The lookup happens in a worker thread, and a lookup that is still
+        waiting for a worker is cancelled if this moves again before then.
 
         >>> coord = Coordinates()
         >>> coord.latitude = 10
@@ -255,12 +399,23 @@ class Coordinates(GObject.GObject):
         False
         >>> type(coord.modified_timeout)
         <class 'NoneType'>
-        >>> coord.geoname
-        'Yendi, Northern, Ghana'
+        >>> coord.geocoding.result()
+        [('Yendi', 'Northern', 'Ghana', 'Africa/Accra')]
         """
         if self.modified_timeout:
             self.notify('positioned')
+            self.cancel_geodata()
+            if self.positioned:
+                self.geocoding = resolve_geodata([self])
+        return False
+
+    def cancel_geodata(self):
+        """Forget any pending geodata lookups, so that none get delivered."""
+        if self.modified_timeout:
             GLib.source_remove(self.modified_timeout)
-            self.lookup_geodata()
             self.modified_timeout = None
-        return False
+        if self.geocoding is not None:
+            self.geocoding.cancel()
+            self.geocoding = None
+        self.generation += 1
+        self.delivered = self.generation
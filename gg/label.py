@@ -76,7 +76,11 @@ class Label(Champlain.Label):
                 self.raise_top()
 
     def destroy(self):
-        """Remove from map and unload."""
+        """Remove from map and unload, along with the photo's bindings."""
         del Label.cache[self.photo]
+        for key in ((self.photo, 'latitude', self),
+                    (self.photo, 'longitude', self),
+                    (self.photo, 'positioned', self, 'visible')):
+            Binding.cache.pop(key)
         self.unmap()
         Champlain.Label.destroy(self)
@@ -8,23 +8,49 @@ from gi.repository import GtkClutter
 GtkClutter.init([])
 
 from gi.repository import Gdk, GdkPixbuf, GExiv2
-from gi.repository import Gio, GObject
+from gi.repository import Gio, GLib, GObject
+from tempfile import mkstemp
+from os import stat, utime, chmod, makedirs, replace, close
+from os.path import basename, abspath, dirname, join
+from collections import namedtuple
 from datetime import datetime
-from os.path import basename
+from hashlib import md5
 from time import mktime
-from os import stat, utime
 
 from gg.label import Label
+from gg.exif import read_header
 from gg.widgets import Widgets
 from gg.xmlfiles import TrackFile
 from gg.gpsmath import Coordinates
 from gg.camera import Camera, CameraView
 from gg.common import Gst, memoize, staticmethod, ignored, points, modified
+from gg.common import background
 
 
 # Prefixes for common EXIF keys.
 IPTC = 'Iptc.Application2.'
 
+inf = float('inf')
+
+# The tags that might hold the time a photo was taken, best first.
+TIME_TAGS = ('Exif.Photo.DateTimeOriginal',
+             'Exif.Image.DateTimeOriginal',
+             'Exif.Photo.DateTime',
+             'Exif.Image.DateTime')
+
+# The tags that identify the camera, and where they go in camera_info.
+CAMERA_TAGS = (('Make', 'Exif.Image.Make'),
+               ('Model', 'Exif.Image.Model'),
+               ('CameraSerialNumber', 'Exif.Image.CameraSerialNumber'),
+               ('BodySerialNumber', 'Exif.Photo.BodySerialNumber'))
+
+# Where gg.exif finds the small JPEG thumbnail in a photo's EXIF header.
+THUMBNAIL = 'Exif.Thumbnail.JPEGInterchangeFormat'
+
+# Everything we need to know about a photo, read from its metadata at once.
+Metadata = namedtuple('Metadata',
+                      'exif orientation orig_time gps camera_info thumbnail')
+
 
 # This defines the transformations used by the Exif.Image.Orientation tag.
 ROTATIONS = {
@@ -54,71 +80,291 @@ ROTATIONS = {
 # This function is the embodiment of my applications core logic.
 # Everything else is just implementation details.
 def auto_timestamp_comparison(photo):
-    """Use GPX data to calculate photo coordinates and elevation."""
+    """Use GPX data to calculate photo coordinates and elevation.
+
+    The timestamp is clamped within the range of available GPX points, and
+    interpolated between the two points nearest (in time) to the photo.
+    See TrackPoints.interpolate for positioning many photos at once.
+    """
     if photo.manual or len(TrackFile.range) < 2:
         return
 
-    # Clamp the timestamp within the range of available GPX points.
-    # The result is in epoch seconds, just like the keys of the 'points' dict.
-    stamp = sorted(TrackFile.range + [photo.timestamp])[1]
+    lats, lons, eles = points.interpolate([photo.timestamp])
+    photo.set_location(lats[0], lons[0], eles[0])
+
+
+def longest(thumb):
+    """Return the length of the longest side of a thumbnail."""
+    return max(thumb.get_width(), thumb.get_height())
+
+
+def shrink(thumb, size):
+    """Scale a thumbnail down to fit within a square of the given size."""
+    width, height = thumb.get_width(), thumb.get_height()
+    side = longest(thumb)
+    if side <= size:
+        return thumb
+    return thumb.scale_simple(max(1, width * size // side),
+                              max(1, height * size // side),
+                              GdkPixbuf.InterpType.BILINEAR)
+
+
+class Mipmap:
+    """Rescale a photo's thumbnail in memory, growing it in the background.
+
+    The biggest thumbnail fetched so far is kept, and every smaller size is
+    scaled straight from it. Growing past it fetches a bigger one in a
+    worker thread, which is usually a hit in the thumbnail cache, and the
+    smaller thumbnail is shown until that arrives.
+    """
+    job = None
+
+    def __init__(self, filename, thumb, size):
+        self.filename = filename
+        self.fetched(thumb, size)
+
+    def fetched(self, thumb, size):
+        """Keep a thumbnail that was fetched at the given size."""
+        self.source = thumb
+        # Photos smaller than the size asked for can't get any bigger.
+        self.limit = size if longest(thumb) >= size else inf
+
+    def scale(self, size, then):
+        """Return the thumbnail scaled to fit within the given size.
+
+        If a bigger thumbnail is needed, it's fetched in a worker thread, and
+        then() is called with it, on the main thread, once it's ready.
+        """
+        self.cancel()
+        if size > self.limit:
+            self.job = job = background.submit(
+                fetch_thumbnail, self.filename, size)
+            job.add_done_callback(lambda job: job.cancelled() or (
+                GLib.idle_add(self.grown, job, size, then)))
+        return shrink(self.source, size)
+
+    def grown(self, job, size, then):
+        """Show the bigger thumbnail, unless another size was asked for."""
+        if job is self.job:
+            self.job = None
+            with ignored(OSError):
+                self.fetched(job.result(), size)
+                then(shrink(self.source, size))
+
+    def cancel(self):
+        """Forget about any bigger thumbnail that's still being fetched."""
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+
+class ThumbnailCache:
+    """Share thumbnails with other programs, as per the freedesktop.org spec.
+
+    Thumbnails are PNG files named for the MD5 of the photo's URI, kept in
+    a directory for each of the standard sizes. Each one records the URI and
+    mtime of the photo it was made from, so that stale ones are ignored.
+    """
+    sizes = ((128, 'normal'), (256, 'large'),
+             (512, 'x-large'), (1024, 'xx-large'))
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def limit(self, size):
+        """Return the standard size that thumbnails of this size come from.
+
+        >>> ThumbnailCache().limit(200)
+        256
+        >>> ThumbnailCache().limit(2000)
+        2000
+        """
+        for limit, flavor in self.sizes:
+            if size <= limit:
+                return limit
+        return size
+
+    def locate(self, filename, size):
+        """Determine where the thumbnail lives and how to validate it."""
+        if self.directory is None:
+            self.directory = join(GLib.get_user_cache_dir(), 'thumbnails')
+        flavor = dict(self.sizes)[self.limit(size)]
+        filename = abspath(filename)
+        uri = GLib.filename_to_uri(filename, None)
+        mtime = str(int(stat(filename).st_mtime))
+        name = md5(uri.encode('utf-8')).hexdigest() + '.png'
+        return join(self.directory, flavor, name), uri, mtime
+
+    def load(self, filename, size):
+        """Return the cached thumbnail scaled to size, or None if stale."""
+        try:
+            path, uri, mtime = self.locate(filename, size)
+            thumb = GdkPixbuf.Pixbuf.new_from_file(path)
+        except (OSError, KeyError, GObject.GError):
+            return None
+        if (thumb.get_option('tEXt::Thumb::URI'),
+                thumb.get_option('tEXt::Thumb::MTime')) != (uri, mtime):
+            return None
+        return shrink(thumb, size)
+
+    def save(self, filename, thumb, size):
+        """Write a thumbnail of one of the standard sizes to disk."""
+        with ignored(OSError, KeyError, GObject.GError):
+            path, uri, mtime = self.locate(filename, size)
+            makedirs(dirname(path), mode=0o700, exist_ok=True)
+            fd, temp = mkstemp(dir=dirname(path), suffix='.tmp')
+            close(fd)
+            thumb.savev(temp, 'png',
+                        ['tEXt::Thumb::URI', 'tEXt::Thumb::MTime'],
+                        [uri, mtime])
+            chmod(temp, 0o600)
+            replace(temp, path)
+
+
+thumbnail_cache = ThumbnailCache()
+
+
+def sorted_previews(exif):
+    """List the previews embedded in a photo, smallest first."""
+    return sorted(exif.get_preview_properties(),
+                  key=lambda p: max(p.get_width(), p.get_height()))
+
+
+def decode_preview(exif, preview, size):
+    """Decode one of the previews embedded in a photo."""
+    data = exif.get_preview_image(preview).get_data()
+    return GdkPixbuf.Pixbuf.new_from_stream_at_scale(
+        Gio.MemoryInputStream.new_from_data(data, None),
+        size, size, True, None)
+
+
+def decode_thumbnail(filename, offset, length):
+    """Decode the small JPEG thumbnail found in the EXIF header by gg.exif.
+    """
+    with open(filename, 'rb') as photo:
+        photo.seek(offset)
+        data = photo.read(length)
+    return GdkPixbuf.Pixbuf.new_from_stream(
+        Gio.MemoryInputStream.new_from_data(data, None), None)
+
 
+def read_metadata(filename):
+    """Parse a photo's metadata once, for both the thumbnail and Photograph.
+
+    JPEG and TIFF-based raw photos only have their metadata headers read, by
+    gg.exif, which also says where to find the EXIF thumbnail. Anything else
+    is read by GExiv2, in which case the GExiv2.Metadata is kept in the
+    record so it can be reused for fetching previews and writing changes.
+
+    >>> read_metadata('gg/widgets.py')
+    Traceback (most recent call last):
+    OSError: gg/widgets.py: No metadata found.
+    >>> read_metadata('demo/IMG_2411.JPG').camera_info['Model']
+    'Canon PowerShot A590 IS'
+    """
     try:
-        point = points[stamp]  # Try to use an exact match,
-        lat = point.lat        # if such a thing were to exist.
-        lon = point.lon        # It's more likely than you think. 50%
-        ele = point.ele        # of the included demo data matches here.
-
-    except KeyError:
-        # Find the two points that are nearest (in time) to the photo.
-        hi = min([p for p in points if p > stamp])
-        lo = max([p for p in points if p < stamp])
-        hi_point = points[hi]
-        lo_point = points[lo]
-        hi_ratio = (stamp - lo) / (hi - lo)  # Proportional amount of time
-        lo_ratio = (hi - stamp) / (hi - lo)  # between each point & the photo.
-
-        # Find intermediate values using the proportional ratios.
-        lat = ((lo_point.lat * lo_ratio) +
-               (hi_point.lat * hi_ratio))
-        lon = ((lo_point.lon * lo_ratio) +
-               (hi_point.lon * hi_ratio))
-        ele = ((lo_point.ele * lo_ratio) +
-               (hi_point.ele * hi_ratio))
-
-    photo.set_location(lat, lon, ele)
-
-
-def fetch_thumbnail(filename, size=Gst.get_int('thumbnail-size'), orient=1):
+        exif, tags = None, read_header(filename)
+    except OSError:
+        try:
+            exif = tags = GExiv2.Metadata(filename)
+        except GObject.GError:
+            raise OSError('{}: No metadata found.'.format(filename))
+
+    orientation = 1
+    with ignored(KeyError, ValueError):
+        orientation = int(tags['Exif.Image.Orientation'])
+
+    orig_time = None
+    for tag in TIME_TAGS:
+        with ignored(TypeError, AttributeError, ValueError):
+            orig_time = datetime.strptime(
+                tags.get(tag), '%Y:%m:%d %H:%M:%S').timetuple()
+            break
+
+    camera_info = {'Make': '', 'Model': ''}
+    for key, tag in CAMERA_TAGS:
+        with ignored(KeyError):
+            camera_info[key] = tags[tag]
+
+    thumbnail = None
+    if exif is None and THUMBNAIL in tags:
+        thumbnail = tags[THUMBNAIL], tags[THUMBNAIL + 'Length']
+
+    return Metadata(exif, orientation, orig_time, tags.get_gps_info(),
+                    camera_info, thumbnail)
+
+
+def fetch_thumbnail(filename, size=Gst.get_int('thumbnail-size'),
+                    metadata=None):
     """Load a photo's thumbnail from disk
 
+    Thumbnails are decoded at the next standard thumbnail size and shared
+    through the thumbnail cache, so previously seen photos only cost a PNG
+    read. When the use-embedded-previews GSetting is on, the smallest preview
+    embedded in the photo that's big enough is decoded instead of the whole
+    photo. The metadata is only read if it wasn't given, and only when the
+    thumbnail isn't cached. If only the header was read, only the EXIF
+    thumbnail is considered, and GExiv2 is only opened as a last resort.
+
     >>> fetch_thumbnail('gg/widgets.py')
     Traceback (most recent call last):
     OSError: gg/widgets.py: No thumbnail found.
     >>> type(fetch_thumbnail('demo/IMG_2411.JPG'))
     <class 'gi.repository.GdkPixbuf.Pixbuf'>
     """
-    try:
-        exif = GExiv2.Metadata(filename)
-    except GObject.GError:
-        raise OSError('{}: No thumbnail found.'.format(filename))
-
-    with ignored(KeyError, ValueError):
-        orient = int(exif['Exif.Image.Orientation'])
+    thumb = thumbnail_cache.load(filename, size)
+    if thumb is not None:
+        return thumb
 
-    try:
-        thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, size, size)
-    except GObject.GError:
+    if metadata is None:
         try:
-            preview = exif.get_preview_properties()
-            data = exif.get_preview_image(preview[0]).get_data()
-        except (IndexError, GObject.GError):
+            metadata = read_metadata(filename)
+        except OSError:
             raise OSError('{}: No thumbnail found.'.format(filename))
 
-        return GdkPixbuf.Pixbuf.new_from_stream_at_scale(
-            Gio.MemoryInputStream.new_from_data(data, None),
-            size, size, True, None)
-
-    return ROTATIONS.get(orient, lambda x: x)(thumb)
+    exif = metadata.exif
+    limit = thumbnail_cache.limit(size)
+    thumb = None
+    if Gst.get_boolean('use-embedded-previews'):
+        if exif is not None:
+            for preview in sorted_previews(exif):
+                if max(preview.get_width(), preview.get_height()) >= limit:
+                    with ignored(GObject.GError):
+                        thumb = decode_preview(exif, preview, limit)
+                    break
+        elif metadata.thumbnail is not None:
+            with ignored(OSError, GObject.GError):
+                embedded = decode_thumbnail(filename, *metadata.thumbnail)
+                if longest(embedded) >= limit:
+                    thumb = shrink(embedded, limit)
+
+    if thumb is None:
+        try:
+            thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                filename, limit, limit)
+        except GObject.GError:
+            try:
+                exif = exif or GExiv2.Metadata(filename)
+                thumb = decode_preview(exif, sorted_previews(exif)[-1], limit)
+            except (IndexError, GObject.GError):
+                raise OSError('{}: No thumbnail found.'.format(filename))
+
+    thumb = ROTATIONS.get(metadata.orientation, lambda x: x)(thumb)
+    thumbnail_cache.save(filename, thumb, limit)
+    return shrink(thumb, size)
+
+
+def decode_photo(filename):
+    """Do the slow parts of loading a photo, without touching any widgets.
+
+    This is safe to call from a worker thread. Returns the thumbnail, at the
+    size the photo pane is showing, and the Metadata, or raises OSError if
+    the file isn't a photo. The metadata is only parsed once, no matter
+    where the thumbnail comes from.
+    """
+    metadata = read_metadata(filename)
+    thumb = fetch_thumbnail(filename, Gst.get_int('thumbnail-size'), metadata)
+    return thumb, metadata
 
 
 @memoize
@@ -159,28 +405,30 @@ class Photograph(Coordinates):
 
     @staticmethod
     def resize_all_photos(gst, key):
-        """Reload all the thumbnails when the GSetting changes."""
+        """Rescale all the thumbnails when the GSetting changes.
+
+        Shrinking them never needs to touch the disk, and bigger ones are
+        fetched in the background.
+        """
         # TODO: There's probably a more GObjecty way to do this with properties
-        # TODO: Is it necessary to reload every time? Probably could just load
-        # the max size to start and then scale it down to the requested size on
-        # the fly. But this works for now.
         size = gst.get_int(key)
         for photo in Photograph.instances:
-            photo.thumb = fetch_thumbnail(photo.filename, size)
-            Widgets.loaded_photos.set_value(photo.iter, 2, photo.thumb)
+            photo.show_thumbnail(
+                photo.mipmap.scale(size, photo.show_thumbnail))
 
     @staticmethod
-    def load_from_file(uri):
+    def load_from_file(uri, thumb=None, metadata=None):
         """Coordinates instantiation of various classes.
 
         Ensures that related Photograph, Camera, CameraView, and Label are all
-        instantiated together.
+        instantiated together. The thumbnail and metadata are loaded from
+        disk, unless they've already been decoded (eg, by decode_photo).
         """
-        photo = Photograph(uri)
+        photo = Photograph(uri, thumb=thumb)
 
         Label(photo)
 
-        photo.read()
+        photo.read(metadata)
 
         Widgets.empty_camera_list.hide()
 
@@ -200,14 +448,17 @@ class Photograph(Coordinates):
 
         return photo
 
-    def __init__(self, filename):
+    def __init__(self, filename, thumb=None):
         """Raises OSError for invalid file types.
 
         This MUST be the case in order to avoid the @memoize cache getting
         filled up with invalid Photograph instances.
         """
         Coordinates.__init__(self)
-        self.thumb = fetch_thumbnail(filename)
+        size = Gst.get_int('thumbnail-size')
+        self.mipmap = Mipmap(
+            filename, thumb or fetch_thumbnail(filename, size), size)
+        self.thumb = self.mipmap.scale(size, self.show_thumbnail)
         self.filename = filename
 
         self.connect('notify::geoname', self.update_liststore_summary)
@@ -220,9 +471,10 @@ class Photograph(Coordinates):
             'style="italic" size="smaller"', Coordinates.__str__(self))
         return '<b>{}</b>'.format(summary) if self in modified else summary
 
-    def read(self):
+    def read(self, metadata=None):
         """Discard all state and (re)initialize from disk."""
-        self.exif = GExiv2.Metadata(self.filename)
+        metadata = metadata or read_metadata(self.filename)
+        self.exif = metadata.exif
         self.manual = False
         self.modified_timeout = None
         self.latitude = 0.0
@@ -233,17 +485,8 @@ class Photograph(Coordinates):
         self.names = (None, None, None)
         self.geotimezone = ''
 
-        for tag in ('Exif.Photo.DateTimeOriginal',
-                    'Exif.Image.DateTimeOriginal',
-                    'Exif.Photo.DateTime',
-                    'Exif.Image.DateTime'):
-            with ignored(TypeError, AttributeError, ValueError):
-                self.orig_time = datetime.strptime(
-                    self.exif.get(tag),
-                    '%Y:%m:%d %H:%M:%S').timetuple()
-                break
-
-        self.longitude, self.latitude, self.altitude = self.exif.get_gps_info()
+        self.orig_time = metadata.orig_time
+        self.longitude, self.latitude, self.altitude = metadata.gps
 
         modified.discard(self)
         self.calculate_timestamp()
@@ -255,33 +498,32 @@ class Photograph(Coordinates):
                                                   self.thumb,
                                                   self.timestamp])
 
-        # Get the camera info
-        self.camera_info = {'Make': '', 'Model': ''}
-        keys = ['Exif.Image.' + key for key in list(self.camera_info.keys()) +
-                ['CameraSerialNumber']] + ['Exif.Photo.BodySerialNumber']
-        for key in keys:
-            with ignored(KeyError):
-                self.camera_info.update(
-                    {key.split('.')[-1]: self.exif[key]})
+        self.camera_info = dict(metadata.camera_info)
 
-    def calculate_timestamp(self, offset=0):
+    def calculate_timestamp(self, offset=0, interpolate=True):
         """Determine the timestamp based on the currently selected timezone.
 
         This method relies on the TZ environment variable to be set before
         it is called. If you don't set TZ before calling this method, then it
         implicitely assumes that the camera and the computer are set to the
         same timezone.
+
+        Pass interpolate=False if you intend to position many photos at once
+        with TrackPoints.interpolate.
         """
         try:
             self.timestamp = int(mktime(self.orig_time))
         except TypeError:
             self.timestamp = int(stat(self.filename).st_mtime)
         self.timestamp += offset
-        auto_timestamp_comparison(self)
+        if interpolate:
+            auto_timestamp_comparison(self)
 
     def write(self):
         """Save exif data to photo file on disk."""
         times = stat(self.filename)
+        if self.exif is None:
+            self.exif = GExiv2.Metadata(self.filename)
         self.exif.set_gps_info(self.longitude, self.latitude, self.altitude)
         self.exif[IPTC + 'City'] = self.names[0] or ''
         self.exif[IPTC + 'ProvinceState'] = self.names[1] or ''
@@ -321,9 +563,16 @@ class Photograph(Coordinates):
         if self.camera and self.camera.found_timezone is not self.geotimezone:
             self.camera.found_timezone = self.geotimezone
 
+    def show_thumbnail(self, thumb):
+        """Display a new thumbnail in the photo pane."""
+        self.thumb = thumb
+        if self.iter is not None:
+            Widgets.loaded_photos.set_value(self.iter, 2, thumb)
+
     def destroy(self):
         """Agony!"""
-        self.update_derived_properties()  # To clear any callback...
+        self.cancel_geodata()
+        self.mipmap.cancel()
         # TODO: Disconnect this from here
         if self in Label.cache:
             Label(self).destroy()
@@ -4,83 +4,125 @@
 """Control how the map is searched."""
 
 
-from gi.repository import Gtk, GtkClutter
+from gi.repository import GLib, Gtk, GtkClutter
 GtkClutter.init([])
 
-from os.path import join
-
 from gg.territories import get_state, get_country
 from gg.widgets import Widgets, MapView
-from gg.build_info import PKG_DATA_DIR
+from gg.gpsmath import load_cities
+from gg.common import background
 
 
 # ListStore column names
 LOCATION, LATITUDE, LONGITUDE = range(3)
 
+# How many search results to offer at once.
+LIMIT = 100
+
+# How many milliseconds of quiet to wait for before searching.
+DELAY = 150
+
+
+def find_places(query):
+    """Search for cities, returning the rows for the search results."""
+    cities = load_cities()
+    rows = []
+    for match in cities.search(query, LIMIT):
+        city, state, country, tz = cities.place(match)
+        rows.append((
+            ', '.join([s for s in (
+                city,
+                get_state(country, state),
+                get_country(country),
+            ) if s]),
+            cities.lats[match],
+            cities.lons[match]))
+    return rows
+
 
 class SearchController(object):
     """Controls the behavior for searching the map."""
     last_search = None
+    timeout = None
+    job = None
 
     def __init__(self):
         """Make the search box and insert it into the window."""
         self.search = None
         self.results = Gtk.ListStore.new([str, float, float])
-        search = Gtk.EntryCompletion.new()
+        self.completion = search = Gtk.EntryCompletion.new()
         search.set_model(self.results)
         search.set_minimum_key_length(3)
         search.set_text_column(LOCATION)
         search.set_inline_completion(True)
-        search.set_match_func(
-            lambda c, s, itr, get: (get(itr, LOCATION) or '').lower().find(
-                self.search) > -1,
-            self.results.get_value)
+        # The model only ever contains results that match the current text.
+        search.set_match_func(lambda *ignore: True, None)
         search.connect('match-selected', self.search_completed)
         entry = Widgets.search_box
         entry.set_completion(search)
-        entry.connect('changed', self.load_results, self.results.append)
+        entry.connect('changed', self.load_results)
         entry.connect('icon-release', lambda entry, i, e: entry.set_text(''))
         entry.connect('icon-release', lambda *ignore: entry.emit('grab_focus'))
-        entry.connect('activate', self.repeat_last_search, self.results)
+        entry.connect('activate', self.repeat_last_search)
 
-    def load_results(self, entry, append, searched=set()):
-        """Load a few search results based on what's been typed.
+    def load_results(self, entry):
+        """Search for the text once the user stops typing.
 
-        Requires at least three letters typed, and is careful not to load
-        duplicate results.
+        Requires at least three letters typed. Any search for older text is
+        abandoned, whether it is still waiting or already running.
+        """
+        self.search = entry.get_text()
+        if self.timeout is not None:
+            GLib.source_remove(self.timeout)
+            self.timeout = None
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+        if len(self.search) >= 3:
+            self.timeout = GLib.timeout_add(DELAY, self.start_search,
+                                            self.search)
+
+    def start_search(self, query):
+        """Search for the query in a worker thread."""
+        self.timeout = None
+        self.job = job = background.submit(find_places, query)
+        job.add_done_callback(lambda job: job.cancelled() or GLib.idle_add(
+            lambda: self.show_results(query, job.result())))
+        return False
 
-        The searched argument persists across calls to this method, and should
-        not be passed as an argument unless your intention is to trigger the
-        loading of duplicate results.
+    def show_results(self, query, rows):
+        """Replace the search results, unless the text has since changed.
+
+        A new model is built for every query, so the results never
+        accumulate, and it is only shown once it has been filled. The popup
+        is opened again, because GtkEntryCompletion only checks for matches
+        right after a keystroke, long before the results arrive.
         """
-        self.search = entry.get_text().lower()
-        three = self.search[0:3]
-        if len(three) == 3 and three not in searched:
-            searched.add(three)
-            cityfile = join(PKG_DATA_DIR, 'cities.txt')
-            with open(cityfile, encoding='utf-8') as cities:
-                for line in cities:
-                    city, lat, lon, country, state = line.split('\t')[0:5]
-                    if city.lower().find(three) > -1:
-                        append((
-                            ', '.join([s for s in (
-                                city,
-                                get_state(country, state),
-                                get_country(country),
-                            ) if s]),
-                            float(lat),
-                            float(lon)))
+        if query != self.search:
+            return False
+        self.job = None
+        results = Gtk.ListStore.new([str, float, float])
+        for row in rows:
+            results.append(row)
+        self.results = results
+        self.completion.set_model(results)
+        self.completion.complete()
+        return False
 
     def search_completed(self, entry, model, itr):
         """Go to the selected location."""
-        self.last_search = itr.copy()
+        self.last_search = model.get(itr, LATITUDE, LONGITUDE)
+        self.go_to(*self.last_search)
+
+    def go_to(self, lat, lon):
+        """Center the map on the given location."""
         MapView.emit('realize')
         MapView.set_zoom_level(MapView.get_max_zoom_level())
         Widgets.redraw_interface()
-        MapView.center_on(*model.get(itr, LATITUDE, LONGITUDE))
+        MapView.center_on(lat, lon)
         MapView.set_zoom_level(11)
 
-    def repeat_last_search(self, entry, model):
+    def repeat_last_search(self, entry):
         """Snap back to the last-searched location when user hits enter key."""
         if self.last_search is not None:
-            self.search_completed(entry, model, self.last_search)
+            self.go_to(*self.last_search)
@@ -42,7 +42,7 @@ class Builder(Gtk.Builder):
         self.set_translation_domain(PACKAGE)
         self.add_from_file(join(PKG_DATA_DIR, filename + '.ui'))
 
-    @memoize
+    @memoize(maxsize=1000)
     def __getattr__(self, widget):
         """Make calls to Gtk.Builder().get_object() more pythonic.
 
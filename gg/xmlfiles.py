@@ -8,25 +8,37 @@ from gi.repository import GtkClutter
 GtkClutter.init([])
 
 from xml.parsers.expat import ParserCreate, ExpatError
-from gi.repository import Champlain, Clutter, Gtk, Gdk
+from struct import Struct as Packer, error as PackError
+from mmap import mmap, ACCESS_READ
+from gi.repository import GLib, Champlain, Clutter, Gtk, Gdk
 from dateutil.parser import parse as parse_date
 from collections import defaultdict, deque
 from re import compile as re_compile
+from os.path import basename, abspath, join
+from tempfile import mkstemp
+from os import stat, replace, fdopen
 from gettext import gettext as _
-from os.path import basename
 from calendar import timegm
+from math import hypot
+from hashlib import sha1
+from sys import byteorder
+from array import array
 from time import clock
 
 from gg.camera import Camera
+from gg.filetypes import sniff, open_track, open_text
 from gg.gpsmath import Coordinates
 from gg.common import staticmethod
 from gg.widgets import Widgets, Builder, MapView
-from gg.common import GSettings, Gst, Struct, memoize, points
+from gg.common import GSettings, Gst, Struct, memoize, points, ignored
+from gg.common import TrackPoints, background, get_cache_dir
 
 
 BOTTOM = Gtk.PositionType.BOTTOM
 RIGHT = Gtk.PositionType.RIGHT
 
+inf = float('inf')
+
 
 def make_clutter_color(color):
     """Generate a Clutter.Color from the currently chosen color.
@@ -49,34 +61,237 @@ def track_color_changed(selection, polys):
         polygon.set_stroke_color(two if i % 2 else one)
 
 
+class Segment:
+    """Collect the points of a single track segment as columns of doubles.
+
+    >>> segment = Segment()
+    >>> segment.append_point(1287259751, 49.899754, -97.137494, None)
+    >>> segment.append_point(1287259753, 53.529201, -113.499324, 1000)
+    >>> list(segment.lats), list(segment.lons), list(segment.eles)
+    ([49.899754, 53.529201], [-97.137494, -113.499324], [0.0, 1000.0])
+    """
+
+    def __init__(self, times=None, lats=None, lons=None, eles=None,
+                 detail=None):
+        self.times = array('d') if times is None else times
+        self.lats = array('d') if lats is None else lats
+        self.lons = array('d') if lons is None else lons
+        self.eles = array('d') if eles is None else eles
+        self.detail = detail
+
+    def append_point(self, timestamp, latitude, longitude, elevation):
+        """Simplify appending a point onto a segment."""
+        try:
+            elevation = float(elevation)
+        except (ValueError, TypeError):
+            elevation = 0.0
+        self.times.append(timestamp)
+        self.lats.append(latitude)
+        self.lons.append(longitude)
+        self.eles.append(elevation)
+
+    def columns(self):
+        """Return the parallel arrays of time, lat, lon, and ele."""
+        return self.times, self.lats, self.lons, self.eles
+
+    def simplify(self):
+        """Rank every point by how much it contributes to the segment's shape.
+
+        This runs Douglas-Peucker once with no tolerance, recording the
+        distance (in degrees) at which each point was kept. Any point with a
+        detail greater than some tolerance is exactly the set of points that
+        Douglas-Peucker would have kept at that tolerance.
+
+        >>> segment = Segment()
+        >>> for lat, lon in ((0, 0), (1, 0.5), (0, 1), (0.125, 2), (0, 3)):
+        ...     segment.append_point(0, lat, lon, 0)
+        >>> segment.simplify()
+        >>> [round(detail, 3) for detail in segment.detail]
+        [inf, 1.0, 0.743, 0.125, inf]
+        """
+        lats, lons = self.lats, self.lons
+        count = len(lats)
+        detail = self.detail = array('d', [0.0]) * count
+        if not count:
+            return
+        detail[0] = detail[-1] = inf
+        stack = [(0, count - 1, inf)]
+        while stack:
+            first, last, ceiling = stack.pop()
+            if last - first < 2:
+                continue
+            lat, lon = lats[first], lons[first]
+            rise, run = lats[last] - lat, lons[last] - lon
+            length = hypot(rise, run)
+            furthest, distance = first + 1, -1.0
+            for i in range(first + 1, last):
+                if length:
+                    cross = run * (lats[i] - lat) - rise * (lons[i] - lon)
+                    span = abs(cross) / length
+                else:
+                    span = hypot(lats[i] - lat, lons[i] - lon)
+                if span > distance:
+                    furthest, distance = i, span
+            # A point can never be more detailed than the one that split it.
+            distance = min(distance, ceiling)
+            detail[furthest] = distance
+            stack.append((first, furthest, distance))
+            stack.append((furthest, last, distance))
+
+
 class Polygon(Champlain.PathLayer):
-    """Extend a Champlain.PathLayer to automate appending points.
-
-    >>> poly = Polygon()
-    >>> coord = poly.append_point(49.899754, -97.137494, None)
-    >>> (coord.lat, coord.lon, coord.ele)
-    (49.899754, -97.137494, 0.0)
-    >>> coord = poly.append_point(53.529201, -113.499324, 1000)
-    >>> (coord.lat, coord.lon, coord.ele)
-    (53.529201, -113.499324, 1000.0)
+    """Extend a Champlain.PathLayer to display a Segment.
+
+    Only the points that are at least a pixel away from the simplified line
+    are drawn, so the number of nodes depends on the zoom level. Only the
+    Champlain.Coordinates for the nodes being drawn are kept, and the ones
+    that are still visible after zooming are reused rather than created
+    again, so there is never more than one per point.
     """
 
-    def __init__(self):
+    def __init__(self, segment):
         Champlain.PathLayer.__init__(self)
         self.set_stroke_width(4)
         MapView.add_layer(self)
+        self.segment = segment
+        self.drawn = {}
+        self.zoom = None
+
+    def nodes(self, zoom):
+        """Return the Champlain.Coordinates that are visible at this zoom."""
+        segment = self.segment
+        if segment.detail is None:
+            segment.simplify()
+        # One pixel, in degrees of longitude, for 256px tiles.
+        tolerance = 360 / (256 << zoom)
+        new = Champlain.Coordinate.new_full
+        drawn = self.drawn
+        self.drawn = {
+            i: drawn[i] if i in drawn else new(lat, lon)
+            for i, (lat, lon, detail) in enumerate(
+                zip(segment.lats, segment.lons, segment.detail))
+            if detail > tolerance}
+        return list(self.drawn.values())
+
+    def draw(self, zoom=None):
+        """Display the nodes appropriate to the current zoom level."""
+        if zoom is None:
+            zoom = MapView.get_zoom_level()
+        if zoom == self.zoom:
+            return
+        first, count = self.zoom is None, len(self.drawn)
+        self.zoom = zoom
+        nodes = self.nodes(zoom)
+        # Fewer points are kept at each zoom level than the one above it,
+        # so the same number of nodes means they're the same nodes.
+        if not first and len(nodes) == count:
+            return
+        self.remove_all()
+        for node in nodes:
+            self.add_node(node)
+
+    def get_bounding_box(self):
+        """Measure every point in the segment, not just the drawn nodes."""
+        bounds = Champlain.BoundingBox.new()
+        segment = self.segment
+        if len(segment.lats):
+            bounds.extend(min(segment.lats), min(segment.lons))
+            bounds.extend(max(segment.lats), max(segment.lons))
+        return bounds
+
 
-    def append_point(self, latitude, longitude, elevation):
-        """Simplify appending a point onto a polygon."""
-        coord = Champlain.Coordinate.new_full(latitude, longitude)
-        coord.lat = latitude
-        coord.lon = longitude
+class TrackCache:
+    """Keep parsed track files on disk, so they never need parsing again.
+
+    Each file holds the sorted TrackPoints columns followed by the columns
+    of every Segment (including the detail computed by Segment.simplify), as
+    raw doubles which are memory-mapped when loaded.
+    The entries are validated against the absolute path, size, and mtime
+    of the track file, along with the parser that was used to read it.
+    """
+    magic = b'GGTRACKS'
+    count = Packer('<Q')
+
+    # Bump this whenever the parsers change how they interpret track files.
+    version = 3
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def locate(self, filename, parser):
+        """Determine where the cache entry lives and how to validate it."""
+        if self.directory is None:
+            self.directory = get_cache_dir('tracks')
+        filename = abspath(filename)
+        info = stat(filename)
+        key = '\0'.join(str(part) for part in (
+            filename, info.st_size, info.st_mtime_ns,
+            parser, self.version, byteorder)).encode('utf-8')
+        name = sha1('\0'.join((filename, parser)).encode('utf-8'))
+        return join(self.directory, name.hexdigest()), key
+
+    def load(self, filename, parser):
+        """Return the cached TrackPoints and Segments, or None if stale."""
         try:
-            coord.ele = float(elevation)
-        except (ValueError, TypeError):
-            coord.ele = 0.0
-        self.add_node(coord)
-        return coord
+            path, key = self.locate(filename, parser)
+            with open(path, 'rb') as cache:
+                data = mmap(cache.fileno(), 0, access=ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        view = memoryview(data)
+        try:
+            if view[:8] != self.magic:
+                return None
+            offset = 8 + self.count.size
+            end = offset + self.count.unpack_from(data, 8)[0]
+            if view[offset:end] != key:
+                return None
+            offset = end + -end % 8
+            count, = self.count.unpack_from(data, offset)
+            offset += self.count.size
+            lengths = Packer('<{}Q'.format(count)).unpack_from(data, offset)
+            offset += self.count.size * count
+
+            groups = []
+            for length in lengths:
+                columns = []
+                for column in range(5 if groups else 4):
+                    end = offset + 8 * length
+                    columns.append(view[offset:end].cast('d'))
+                    offset = end
+                groups.append(columns)
+        except (PackError, ValueError, TypeError):
+            return None
+
+        if offset != len(view):
+            return None
+
+        tracks = TrackPoints()
+        tracks.set_columns(*groups[0])
+        return tracks, [Segment(*columns) for columns in groups[1:]]
+
+    def save(self, filename, parser, tracks, segments):
+        """Write the parsed TrackPoints and Segments to disk."""
+        with ignored(OSError):
+            path, key = self.locate(filename, parser)
+            groups = [tracks.columns()] + [
+                segment.columns() + (segment.detail,) for segment in segments]
+            fd, temp = mkstemp(dir=self.directory, suffix='.tmp')
+            with fdopen(fd, 'wb') as cache:
+                cache.write(self.magic)
+                cache.write(self.count.pack(len(key)))
+                cache.write(key + bytes(-len(key) % 8))
+                cache.write(self.count.pack(len(groups)))
+                for columns in groups:
+                    cache.write(self.count.pack(len(columns[0])))
+                for columns in groups:
+                    for column in columns:
+                        cache.write(memoryview(column).cast('B'))
+            replace(temp, path)
+
+
+track_cache = TrackCache()
 
 
 class XMLSimpleParser:
@@ -95,7 +310,7 @@ class XMLSimpleParser:
         self.parser.StartElementHandler = self.element_root
 
         try:
-            with open(filename, 'rb') as xml:
+            with open_track(filename) as xml:
                 self.parser.ParseFile(xml)
         except ExpatError:
             raise OSError
@@ -146,10 +361,15 @@ class TrackFile():
     """Parent class for all types of GPS track files.
 
     Subclasses must implement at least element_end.
+
+    The subclasses are memoized weakly, since it is this instances set that
+    keeps the loaded files alive; files that were parsed but never displayed
+    are simply forgotten.
     """
     range = []
     parse = XMLSimpleParser
     instances = set()
+    widgets = None
 
     @staticmethod
     def update_range():
@@ -160,7 +380,7 @@ class TrackFile():
             Widgets.empty_trackfile_list.show()
         else:
             Widgets.empty_trackfile_list.hide()
-            TrackFile.range.extend([min(points), max(points)])
+            TrackFile.range.extend([points.timeline[0], points.timeline[-1]])
 
     @staticmethod
     def get_bounding_box():
@@ -194,18 +414,42 @@ class TrackFile():
         points.clear()
 
     @staticmethod
-    def load_from_file(uri):
+    def parse_file(uri, kind=None):
         """Determine the correct subclass to instantiate.
 
-        Also time everything and report how long it took. Raises OSError if
-        the file extension is unknown, or no track points were found.
+        This is safe to call from a worker thread. Raises OSError if the file
+        isn't a GPS track, or no track points were found. The kind of file is
+        sniffed from its contents, unless it has already been determined.
         """
-        start_time = clock()
-
         try:
-            gpx = globals()[uri[-3:].upper() + 'File'](uri)
+            subclass = globals()[(kind or sniff(uri)).upper() + 'File']
         except KeyError:
-            raise OSError
+            raise OSError('{}: Not a GPS track.'.format(uri))
+        return subclass(uri)
+
+    @staticmethod
+    def load_from_file(uri, gpx=None, start_time=None):
+        """Display the track file on the map.
+
+        Unless the already parsed file is passed in, the file is parsed in
+        a worker thread first, and displayed from the main loop once it's
+        done. Also time everything and report how long it took. Files that
+        can't be parsed are reported in the statusbar.
+        """
+        start_time = start_time or clock()
+
+        if gpx is None:
+            def parsed(job):
+                """Display the parsed file, back on the main thread."""
+                try:
+                    TrackFile.load_from_file(uri, job.result(), start_time)
+                except OSError as error:
+                    Widgets.status_message(str(error))
+
+            job = background.submit(TrackFile.parse_file, uri)
+            job.add_done_callback(
+                lambda job: job.cancelled() or GLib.idle_add(parsed, job))
+            return
 
         Widgets.status_message(
             _('%d points loaded in %.2fs.') %
@@ -214,7 +458,9 @@ class TrackFile():
         if len(gpx.tracks) < 2:
             return
 
+        gpx.display()
         TrackFile.instances.add(gpx)
+        points.update(gpx.tracks)
         MapView.emit('realize')
         MapView.set_zoom_level(MapView.get_max_zoom_level())
         MapView.ensure_visible(TrackFile.get_bounding_box(), False)
@@ -223,15 +469,53 @@ class TrackFile():
         Camera.set_all_found_timezone(gpx.start.geotimezone)
 
     def __init__(self, filename, root, watch):
+        """Parse the file into Segments.
+
+        This runs in a worker thread, so it must not touch any widgets.
+        """
         self.watchlist = watch
         self.filename = filename
-        self.progress = Widgets.progressbar
+        self.segments = []
         self.polygons = set()
-        self.widgets = Builder('trackfile')
         self.append = None
-        self.tracks = {}
         self.clock = clock()
 
+        parser = type(self).__name__
+        cached = track_cache.load(filename, parser)
+        if cached is not None:
+            self.tracks, self.segments = cached
+        else:
+            self.parse(
+                filename, root, watch, self.element_start, self.element_end)
+
+            columns = array('d'), array('d'), array('d'), array('d')
+            for segment in self.segments:
+                for column, values in zip(columns, segment.columns()):
+                    column.extend(values)
+            self.tracks = TrackPoints(*columns)
+
+            for segment in self.segments:
+                segment.simplify()
+
+            if self.tracks:
+                track_cache.save(filename, parser, self.tracks, self.segments)
+
+        if not self.tracks:
+            raise OSError('No points found')
+
+        self.alpha = self.tracks.timeline[0]
+        self.omega = self.tracks.timeline[-1]
+
+    def display(self):
+        """Draw the parsed Segments on the map and show the settings widgets.
+
+        This has to happen on the main thread, after the parsing is done.
+        """
+        if self.widgets is not None:
+            return
+
+        filename = self.filename
+        self.widgets = Builder('trackfile')
         self.gst = GSettings('trackfile', basename(filename))
         if self.gst.get_string('start-timezone') is '':
             # Then this is the first time this file has been loaded
@@ -257,15 +541,12 @@ class TrackFile():
         Widgets.trackfile_colors_group.add_widget(self.widgets.colorpicker)
         Widgets.trackfiles_group.add_widget(self.widgets.trackfile_label)
 
-        self.parse(filename, root, watch, self.element_start, self.element_end)
-
-        if not self.tracks:
-            raise OSError('No points found')
+        for segment in self.segments:
+            polygon = Polygon(segment)
+            polygon.draw()
+            self.polygons.add(polygon)
+        self.widgets.colorpicker.emit('color-set')
 
-        points.update(self.tracks)
-        keys = self.tracks.keys()
-        self.alpha = min(keys)
-        self.omega = max(keys)
         self.start = Coordinates(
             latitude=self.tracks[self.alpha].lat,
             longitude=self.tracks[self.alpha].lon)
@@ -275,21 +556,18 @@ class TrackFile():
         Widgets.trackfiles_view.add(self.widgets.trackfile_settings)
 
     def element_start(self, name, attributes=None):
-        """Determine when new tracks start and create a new Polygon."""
+        """Determine when new tracks start and create a new Segment."""
         if name == self.watchlist[0]:
-            polygon = Polygon()
-            self.polygons.add(polygon)
-            self.append = polygon.append_point
-            self.widgets.colorpicker.emit('color-set')
+            segment = Segment()
+            self.segments.append(segment)
+            self.append = segment.append_point
             return False
         return True
 
     def element_end(self, name=None, state=None):
-        """Occasionally redraw the screen so the user can see activity."""
+        """Occasionally report progress so the user can see activity."""
         if clock() - self.clock > .2:
-            self.progress.pulse()
-            while Gtk.events_pending():
-                Gtk.main_iteration()
+            GLib.idle_add(Widgets.progressbar.pulse)
             self.clock = clock()
 
     def destroy(self, button=None):
@@ -298,20 +576,74 @@ class TrackFile():
             MapView.remove_layer(polygon)
         self.polygons.clear()
         self.widgets.trackfile_settings.destroy()
-        del self.cache[self.filename]
+        self.cache.pop(self.filename, None)
         TrackFile.instances.discard(self)
-        points.clear()
+        points.prune(self.tracks)
+
+        # Restore any overlapping points that this file had clobbered.
         for trackfile in TrackFile.instances:
-            points.update(trackfile.tracks)
+            points.update(
+                trackfile.tracks.between(self.alpha, self.omega), False)
         TrackFile.update_range()
 
 
-# GPX files use ISO 8601 dates, which look like 2010-10-16T20:09:13Z.
-# This regex splits that up into a list like 2010, 10, 16, 20, 09, 13.
-split = re_compile(r'[:T.Z-]').split
+def level_of_detail(view, *ignore):
+    """Swap in the polygon nodes that suit the new zoom level."""
+    zoom = view.get_zoom_level()
+    for trackfile in TrackFile.instances:
+        for polygon in trackfile.polygons:
+            polygon.draw(zoom)
+
+
+MapView.connect('notify::zoom-level', level_of_detail)
+
+
+# GPS tracks almost always use ISO 8601 dates, which look like
+# 2010-10-16T20:09:13Z, with optional fractional seconds and UTC offset.
+iso8601 = re_compile(
+    r'(\d{4}-\d\d-\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,]\d*)?'
+    r'(?:Z|([+-])(\d\d):?(\d\d))?$').match
+
+
+@memoize(maxsize=1000)
+def midnight(date):
+    """Convert a YYYY-MM-DD date into epoch seconds at midnight UTC.
+
+    Tracks contain thousands of points per day, so this is well worth caching.
+
+    >>> midnight('2010-10-16')
+    1287187200
+    """
+    return timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0))
+
+
+def parse_timestamp(text):
+    """Convert a date string into integer epoch seconds.
+
+    There is a fast path for ISO 8601 dates, and anything else is left up to
+    dateutil. Raises ValueError if the string isn't a date at all.
+
+    >>> parse_timestamp('2010-10-16T20:09:13Z')
+    1287259753
+    >>> parse_timestamp('2012-05-05T12:48:05.723-07:00')
+    1336247285
+    >>> parse_timestamp('Sat Oct 16 20:09:13 UTC 2010')
+    1287259753
+    """
+    match = iso8601(text.strip())
+    if match is None:
+        return timegm(parse_date(text).utctimetuple())
+
+    date, hours, minutes, seconds, sign, tz_hours, tz_minutes = match.groups()
+    timestamp = midnight(date) + int(seconds)
+    timestamp += int(hours) * 3600 + int(minutes) * 60
+    if sign is not None:
+        offset = int(tz_hours) * 3600 + int(tz_minutes) * 60
+        timestamp += -offset if sign == '+' else offset
+    return timestamp
 
 
-@memoize
+@memoize(weak=True)
 class GPXFile(TrackFile):
     """Support for the open GPS eXchange format."""
 
@@ -321,19 +653,19 @@ class GPXFile(TrackFile):
     def element_end(self, name, state):
         """Collect and use all the parsed data."""
         try:
-            timestamp = timegm(list(map(int, split(state['time'])[0:6])))
+            timestamp = parse_timestamp(state['time'])
             lat = float(state['lat'])
             lon = float(state['lon'])
         except Exception as error:
             print(error)
             return
 
-        self.tracks[timestamp] = self.append(lat, lon, state.get('ele'))
+        self.append(timestamp, lat, lon, state.get('ele'))
 
         TrackFile.element_end(self)
 
 
-@memoize
+@memoize(weak=True)
 class TCXFile(TrackFile):
     """Support for Garmin's Training Center XML."""
 
@@ -344,20 +676,19 @@ class TCXFile(TrackFile):
     def element_end(self, name, state):
         """Collect and use all the parsed data."""
         try:
-            timestamp = timegm(list(map(int, split(state['Time'])[0:6])))
+            timestamp = parse_timestamp(state['Time'])
             lat = float(state['LatitudeDegrees'])
             lon = float(state['LongitudeDegrees'])
         except Exception as error:
             print(error)
             return
 
-        self.tracks[timestamp] = self.append(
-            lat, lon, state.get('AltitudeMeters'))
+        self.append(timestamp, lat, lon, state.get('AltitudeMeters'))
 
         TrackFile.element_end(self)
 
 
-@memoize
+@memoize(weak=True)
 class KMLFile(TrackFile):
     """Support for Google's Keyhole Markup Language.
 
@@ -390,7 +721,7 @@ class KMLFile(TrackFile):
         """
         if name == 'when':
             try:
-                timestamp = timegm(parse_date(state['when']).utctimetuple())
+                timestamp = parse_timestamp(state['when'])
             except Exception as error:
                 print(error)
                 return
@@ -409,15 +740,13 @@ class KMLFile(TrackFile):
 
         whens = self.whens
         coords = self.coords
-        tracks = self.tracks
         append = self.append
 
         while whens and coords:
             when = whens.popleft()
             coord = coords.popleft()
             try:
-                tracks[when] = append(
-                    float(coord[1]), float(coord[0]), coord[2])
+                append(when, float(coord[1]), float(coord[0]), coord[2])
             except TypeError:
                 TrackFile.element_start(self, 'gx:Track')
                 append = self.append
@@ -425,7 +754,7 @@ class KMLFile(TrackFile):
                 TrackFile.element_end(self)
 
 
-@memoize
+@memoize(weak=True)
 class CSVFile(TrackFile):
     """Support for Google's MyTracks' Comma Separated Values format.
 
@@ -443,7 +772,7 @@ class CSVFile(TrackFile):
 
     def parse(self, filename, root, watch, start, end):
         """Call the appropriate handler for each line of the file."""
-        with open(filename) as lines:
+        with open_text(filename) as lines:
             parse_line = re_compile(r'"([^"]*)",?').findall
             for line in lines:
                 self.parse_header(parse_line(line), self.columns)
@@ -464,17 +793,17 @@ class CSVFile(TrackFile):
     def parse_row(self, state, col):
         """All subsequent lines contain one track point each."""
         try:
-            if int(state[col.segment]) > len(self.polygons):
+            if int(state[col.segment]) > len(self.segments):
                 self.element_start('Segment')
 
-            timestamp = timegm(list(map(int, split(state[col.time])[0:6])))
+            timestamp = parse_timestamp(state[col.time])
             lat = float(state[col.latitude])
             lon = float(state[col.longitude])
         except Exception as error:
             print(error)
             return
 
-        self.tracks[timestamp] = self.append(
-            lat, lon, state[col.alt] if col.alt >= 0 else 0.0)
+        self.append(
+            timestamp, lat, lon, state[col.alt] if col.alt >= 0 else 0.0)
 
         TrackFile.element_end(self)
@@ -3,6 +3,7 @@
 from sys import argv
 from os.path import join
 from distutils.core import setup
+from distutils.dep_util import newer
 from subprocess import Popen, PIPE
 
 from DistUtilsExtra.command import build_extra, build_i18n, build_help
@@ -11,6 +12,7 @@ from distutils.command.build_py import build_py as _build_py
 from distutils.command.install import install
 
 from gg.version import PACKAGE, VERSION, AUTHOR, EMAIL
+from gg.geonames import compile_database
 
 
 root = '--root' in ' '.join(argv)
@@ -21,7 +23,8 @@ data_files = [
     ('/usr/share/glib-2.0/schemas', ['data/ca.{}.gschema.xml'.format(PACKAGE)]),
     ('/usr/share/applications', ['data/{}.desktop'.format(PACKAGE)]),
     ('share/doc/' + PACKAGE, ['README.md', 'AUTHORS', 'THANKS']),
-    ('share/' + PACKAGE, ['data/cities.txt', 'data/trackfile.ui', 'data/camera.ui',
+    ('share/' + PACKAGE, ['data/cities.txt', 'data/cities.db',
+        'data/trackfile.ui', 'data/camera.ui',
         'data/{}.ui'.format(PACKAGE), 'data/{}.svg'.format(PACKAGE)])
 ]
 
@@ -56,6 +59,13 @@ class build_py(_build_py):
 
         _build_py.build_module(self, module, module_file, package)
 
+    def run(self):
+        """Compile cities.txt into the cities.db that gets installed."""
+        if newer('data/cities.txt', 'data/cities.db'):
+            print('compiling data/cities.txt -> data/cities.db')
+            compile_database('data/cities.txt', 'data/cities.db')
+        _build_py.run(self)
+
 
 # If the --root option has been specified, then most likely we are installing
 # to a fakeroot, eg, when a debian package is being made. In this case, don't
@@ -49,6 +49,7 @@ class BaseTestCase(unittest.TestCase):
         giMock.Champlain.PathLayer = null
         giMock.Champlain.PathLayer.set_stroke_width = Mock()
         giMock.Champlain.PathLayer.add_node = Mock()
+        giMock.Champlain.PathLayer.remove_all = Mock()
         giMock.Gio.Settings = null
         giMock.Gio.Settings.__init__ = Mock()
         giMock.Gio.Settings.__getitem__ = Mock()
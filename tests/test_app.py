@@ -1,6 +1,6 @@
 """Test the classes and functions defined by gg/app.py"""
 
-from mock import Mock
+from mock import Mock, call
 from os.path import abspath
 
 from tests import BaseTestCase
@@ -35,3 +35,142 @@ class AppTestCase(BaseTestCase):
         self.assertEqual(self.mod.command_line(app, commands), 0)
         app.activate.assert_called_once_with()
         app.open_files.assert_called_once_with([abspath(f) for f in args[1:]])
+
+    def test_decode_photo(self):
+        """Ensure we decode photos in the worker threads."""
+        self.mod.decode_photo = Mock()
+        self.mod.sniff = Mock(return_value='photo')
+        self.assertEqual(
+            self.mod.decode('pic.jpg'),
+            (self.mod.Photograph.load_from_file,
+             self.mod.decode_photo.return_value))
+        self.mod.decode_photo.assert_called_once_with('pic.jpg')
+
+    def test_decode_track(self):
+        """Ensure we parse GPS tracks in the worker threads."""
+        self.mod.decode_photo = Mock()
+        self.mod.sniff = Mock(return_value='gpx')
+        self.mod.TrackFile = Mock()
+        self.assertEqual(
+            self.mod.decode('gps.xml'),
+            (self.mod.TrackFile.load_from_file,
+             (self.mod.TrackFile.parse_file.return_value,)))
+        self.mod.sniff.assert_called_once_with('gps.xml')
+        self.mod.TrackFile.parse_file.assert_called_once_with('gps.xml', 'gpx')
+        self.assertEqual(self.mod.decode_photo.mock_calls, [])
+
+    def test_decode_invalid(self):
+        """Ensure we report files that can't be decoded."""
+        self.mod.decode_photo = Mock()
+        self.mod.TrackFile = Mock()
+        self.mod.sniff = Mock(side_effect=OSError)
+        with self.assertRaises(OSError):
+            self.mod.decode('foo.txt')
+        self.assertEqual(self.mod.decode_photo.mock_calls, [])
+        self.assertEqual(self.mod.TrackFile.parse_file.mock_calls, [])
+
+    def test_decode_ahead(self):
+        """Ensure files are decoded as they are found, a few at a time."""
+        found = []
+
+        def find_files(files):
+            for i in range(self.mod.AHEAD + 5):
+                found.append('{}.jpg'.format(i))
+                yield found[-1]
+
+        self.mod.find_files = find_files
+        self.mod.background = Mock()
+        results = self.mod.decode_ahead(['photos'])
+        name, job, discovered = next(results)
+        self.assertEqual(name, '0.jpg')
+        self.assertEqual(job, self.mod.background.submit.return_value)
+        self.assertEqual(discovered, self.mod.AHEAD)
+        self.assertEqual(len(found), self.mod.AHEAD)
+        self.mod.background.submit.assert_called_with(
+            self.mod.decode, found[-1])
+        rest = list(results)
+        self.assertEqual([name for name, job, discovered in rest], found[1:])
+        self.assertEqual(rest[-1][2], self.mod.AHEAD + 5)
+
+    def importer(self, *results):
+        """Start an Importer over the given decoding results."""
+        self.mod.decode_ahead = Mock(return_value=iter(results))
+        self.mod.Widgets = Mock()
+        self.mod.Camera = Mock()
+        self.mod.TrackFile = Mock()
+        self.then = Mock()
+        importer = self.mod.Importer(['a.jpg', 'b.gpx', 'dir'], self.then)
+        self.mod.GLib.idle_add.assert_called_once_with(importer.commit)
+        return importer
+
+    def job(self, load, done=True, error=None):
+        """Mock a finished decoding job."""
+        job = Mock()
+        job.done.return_value = done
+        job.result.return_value = (load, (1,))
+        job.result.side_effect = error
+        return job
+
+    def test_importer(self):
+        """Ensure files are committed in order, as the workers finish."""
+        load = Mock()
+        busy = self.job(load, done=False)
+        importer = self.importer(
+            ('a.jpg', self.job(load), 4),
+            ('b.gpx', busy, 4),
+            ('dir/c.txt', self.job(load, error=OSError), 4),
+            ('dir/d.jpg', self.job(load), 4))
+
+        # Stop at the first file that isn't decoded yet.
+        self.assertFalse(importer.commit())
+        load.assert_called_once_with('a.jpg', 1)
+        self.mod.Widgets.progressbar.set_fraction.assert_called_with(1 / 4)
+        self.mod.Widgets.progressbar.set_text.assert_called_with(
+            '1 of 4: b.gpx')
+        self.assertEqual(self.then.mock_calls, [])
+
+        # Carry on once it's done.
+        busy.done.return_value = True
+        busy.add_done_callback.call_args[0][0](busy)
+        self.assertEqual(self.mod.GLib.idle_add.call_args[0][0],
+                         importer.commit)
+        self.assertFalse(importer.commit())
+        self.assertEqual(load.mock_calls, [
+            call('a.jpg', 1), call('b.gpx', 1), call('dir/d.jpg', 1)])
+        self.then.assert_called_once_with(['a.jpg', 'b.gpx', 'dir/d.jpg'])
+        # Files found in directories aren't reported.
+        self.assertEqual(self.mod.Widgets.status_message.mock_calls, [])
+        self.mod.Widgets.progressbar.hide.assert_called_once_with()
+        self.mod.Camera.timezone_handler_all.assert_called_once_with()
+
+    def test_importer_batches(self):
+        """Ensure the interface gets a chance to catch up between batches."""
+        load = Mock()
+        importer = self.importer(*[
+            ('{}.jpg'.format(i), self.job(load), self.mod.BATCH_SIZE + 1)
+            for i in range(self.mod.BATCH_SIZE + 1)])
+        self.assertTrue(importer.commit())
+        self.assertEqual(load.call_count, self.mod.BATCH_SIZE)
+        self.assertEqual(self.then.mock_calls, [])
+        self.assertFalse(importer.commit())
+        self.assertEqual(len(self.then.call_args[0][0]),
+                         self.mod.BATCH_SIZE + 1)
+
+    def test_importer_invalid(self):
+        """Ensure named files that can't be opened are reported."""
+        importer = self.importer(
+            ('a.jpg', self.job(Mock(), error=OSError), 2),
+            ('dir/c.txt', self.job(Mock(), error=OSError), 2))
+        self.assertFalse(importer.commit())
+        self.mod.Widgets.status_message.assert_called_once_with(
+            'Could not open: a.jpg')
+        self.then.assert_called_once_with([])
+
+    def test_importer_error(self):
+        """Ensure unexpected errors don't leave the progressbar showing."""
+        load = Mock(side_effect=ValueError)
+        importer = self.importer(('a.jpg', self.job(load), 1))
+        with self.assertRaises(ValueError):
+            importer.commit()
+        self.mod.Widgets.progressbar.hide.assert_called_once_with()
+        self.then.assert_called_once_with([])
@@ -1,5 +1,7 @@
 """Test the classes and functions defined by gg/camera.py"""
 
+from mock import Mock, call
+
 from tests import BaseTestCase
 
 
@@ -8,3 +10,29 @@ class CameraTestCase(BaseTestCase):
 
     def setUp(self):
         super().setUp()
+        self.mod.update_derived_properties = Mock()
+
+    def test_camera_offset_handler(self):
+        """Ensure we can position all of a camera's photos in one batch."""
+        auto = Mock(manual=False, timestamp=15)
+        manual = Mock(manual=True, timestamp=12)
+        camera = Mock(offset=30, photos=[auto, manual])
+        self.mod.points = type(self.mod.points)(
+            [10, 20], [0, 10], [0, 20], [0, 40])
+        self.mod.Camera.offset_handler(camera)
+        auto.calculate_timestamp.assert_called_once_with(30, False)
+        manual.calculate_timestamp.assert_called_once_with(30, False)
+        auto.set_location.assert_called_once_with(5, 10, 20)
+        self.assertEqual(manual.set_location.mock_calls, [])
+        self.mod.update_derived_properties.assert_called_once_with([auto])
+
+    def test_camera_offset_handler_no_points(self):
+        """Ensure photos aren't moved when there's no GPS data."""
+        auto = Mock(manual=False, timestamp=15)
+        camera = Mock(offset=0, photos=[auto])
+        self.mod.points = type(self.mod.points)()
+        self.mod.Camera.offset_handler(camera)
+        self.assertEqual(
+            auto.calculate_timestamp.mock_calls, [call(0, False)])
+        self.assertEqual(auto.set_location.mock_calls, [])
+        self.assertEqual(self.mod.update_derived_properties.mock_calls, [])
@@ -1,6 +1,9 @@
 """Test the classes and functions defined by gg/common.py"""
 
 from mock import Mock
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import isdir, join
 
 from tests import BaseTestCase
 
@@ -14,6 +17,16 @@ class CommonTestCase(BaseTestCase):
         super().setUp()
         print_.reset_mock()
 
+    def test_get_cache_dir(self):
+        """Ensure our cache directories are created on demand."""
+        root = mkdtemp()
+        self.addCleanup(rmtree, root)
+        self.mod.GLib.get_user_cache_dir.return_value = root
+        path = self.mod.get_cache_dir('tracks')
+        self.assertEqual(path, join(root, 'gottengeography', 'tracks'))
+        self.assertTrue(isdir(path))
+        self.assertEqual(self.mod.get_cache_dir('tracks'), path)
+
     def test_singleton(self):
         """Ensure we can define classes that have only one instance."""
         @self.mod.singleton
@@ -44,6 +57,90 @@ class CommonTestCase(BaseTestCase):
         self.assertEqual(len(Memorable.instances), 2)
         self.assertEqual(print_.call_count, 2)
 
+    def test_cache_lru(self):
+        """Ensure bounded caches evict the least recently used entries."""
+        cache = self.mod.Cache(maxsize=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        with self.assertRaises(KeyError):
+            cache['b']
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'gone'), 'gone')
+        del cache['c']
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.info(), (1, 1, 1, 0, 2))
+
+    def test_cache_weak(self):
+        """Ensure weak caches forget values nobody else is using."""
+        class Value:
+            pass
+        cache = self.mod.Cache(weak=True)
+        kept = Value()
+        cache['kept'] = kept
+        cache['lost'] = Value()
+        self.assertEqual(cache.values(), [kept])
+        self.assertIs(cache.get('kept'), kept)
+        self.assertIsNone(cache.get('lost'))
+        self.assertNotIn('lost', cache)
+        self.assertEqual(cache.info(), (1, 1, 1, 1, None))
+
+    def test_cache_threads(self):
+        """Ensure concurrent misses still produce a single instance."""
+        @self.mod.memoize(maxsize=50)
+        class Memorable:
+            def __init__(self, foo):
+                pass
+        jobs = [self.mod.background.submit(Memorable, i % 10)
+                for i in range(200)]
+        results = [job.result() for job in jobs]
+        self.assertEqual(len(set(map(id, results))), 10)
+        for i, result in enumerate(results):
+            self.assertIs(result, Memorable(i % 10))
+        info = Memorable.cache.info()
+        self.assertEqual(info.size, 10)
+        self.assertEqual(info.evictions, 0)
+
+    def test_trackpoints(self):
+        """Ensure the track points stay sorted by timestamp."""
+        points = self.mod.TrackPoints(
+            [50, 10, 30, 10], [5, 9, 3, 1], [50, 90, 30, 10], [0, 0, 0, 0])
+        self.assertEqual(list(points), [10, 30, 50])
+        self.assertEqual(points[10], (1, 10, 0))
+        self.assertEqual(points[10].lon, 10)
+        self.assertIn(30, points)
+        self.assertNotIn(20, points)
+        self.assertIsNone(points.get(20))
+        with self.assertRaises(KeyError):
+            points[60]
+        self.assertEqual(points.bracket(35), (30, 50))
+        points.update(self.mod.TrackPoints([20, 30], [2, 7], [20, 70], [0, 0]))
+        self.assertEqual(list(points), [10, 20, 30, 50])
+        self.assertEqual(points[30].lat, 7)
+        points.update(self.mod.TrackPoints([30, 60], [8, 6], [0, 0], [0, 0]),
+                      replace=False)
+        self.assertEqual(list(points), [10, 20, 30, 50, 60])
+        self.assertEqual(points[30].lat, 7)
+        self.assertEqual(list(points.between(20, 50)), [20, 30, 50])
+        points.prune(self.mod.TrackPoints([10, 30], [1, 3], [10, 30], [0, 0]))
+        self.assertEqual(list(points), [20, 30, 50, 60])
+        self.assertEqual(points[30].lat, 7)
+        points.clear()
+        self.assertEqual(list(points), [])
+        self.assertEqual(len(points), 0)
+
+    def test_trackpoints_interpolate(self):
+        """Ensure we can interpolate many timestamps at once."""
+        points = self.mod.TrackPoints(
+            [10, 20, 40], [1, 2, 4], [10, 20, 40], [100, 200, 400])
+        lats, lons, eles = points.interpolate([30, 5, 20, 99, 15])
+        self.assertEqual(list(lats), [3, 1, 2, 4, 1.5])
+        self.assertEqual(list(lons), [30, 10, 20, 40, 15])
+        self.assertEqual(list(eles), [300, 100, 200, 400, 150])
+
     def test_binding(self):
         """Ensure we can bind GObject properties to GSettings keys."""
         m = self.mod.GObject.Binding.__init__ = Mock()
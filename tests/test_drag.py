@@ -65,7 +65,12 @@ class DragTestCase(BaseTestCase):
         drag.photo_drag_end(None, None, x, y, data, None, None, True)
         self.mod.MapView.y_to_latitude.assert_called_once_with(y)
         self.mod.MapView.x_to_longitude.assert_called_once_with(x)
-        open_files.assert_called_once_with(['a.jpg', 'b.jpg', 'c.jpg'])
+        files, position = open_files.call_args[0]
+        self.assertEqual(files, ['a.jpg', 'b.jpg', 'c.jpg'])
+        self.assertEqual(photo.set_location.mock_calls, [])
+
+        # Photos are positioned once they're loaded.
+        position(files)
         expected = [
             call(self.mod.MapView.y_to_latitude.return_value,
                  self.mod.MapView.x_to_longitude.return_value),
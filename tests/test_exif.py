@@ -0,0 +1,211 @@
+"""Test the classes and functions defined by gg/exif.py"""
+
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from struct import pack
+
+from tests import BaseTestCase
+
+
+def ascii(text):
+    """Describe an ASCII TIFF field."""
+    return 2, len(text) + 1, text.encode('utf-8') + b'\0'
+
+
+def short(order, value):
+    """Describe a SHORT TIFF field."""
+    return 3, 1, pack(order + 'H', value)
+
+
+def rationals(order, *values):
+    """Describe a RATIONAL TIFF field."""
+    data = b''.join(pack(order + 'II', int(value * 100), 100)
+                    for value in values)
+    return 5, len(values), data
+
+
+def ifd(order, offset, entries, following=0):
+    """Lay out an IFD at the given offset, followed by its big values."""
+    entries = sorted(entries.items())
+    head = pack(order + 'H', len(entries))
+    tail = b''
+    extra = offset + 2 + 12 * len(entries) + 4
+    for tag, (kind, count, payload) in entries:
+        if len(payload) <= 4:
+            value = payload.ljust(4, b'\0')
+        else:
+            value = pack(order + 'I', extra + len(tail))
+            tail += payload
+        head += pack(order + 'HHI', tag, kind, count) + value
+    return head + pack(order + 'I', following) + tail
+
+
+def tiff(order, image, photo=None, gps=None, thumbnail=None):
+    """Build TIFF data, with the EXIF and GPS IFDs ahead of IFD0.
+
+    A thumbnail goes in IFD1, after IFD0, and is followed by its data.
+    """
+    data = (b'II' if order == '<' else b'MM') + pack(order + 'H', 42)
+    data += bytes(4)
+    for tag, entries in ((0x8769, photo), (0x8825, gps)):
+        if entries is not None:
+            image[tag] = (4, 1, pack(order + 'I', len(data)))
+            data += ifd(order, len(data), entries)
+    data = data[:4] + pack(order + 'I', len(data)) + data[8:]
+    if thumbnail is None:
+        return data + ifd(order, len(data), image)
+    following = len(data) + len(ifd(order, len(data), image))
+    data += ifd(order, len(data), image, following)
+    start = following + len(ifd(order, following, {0x0201: (4, 1, b''),
+                                                   0x0202: (4, 1, b'')}))
+    return data + ifd(order, following, {
+        0x0201: (4, 1, pack(order + 'I', start)),
+        0x0202: (4, 1, pack(order + 'I', len(thumbnail))),
+    }) + thumbnail
+
+
+def segment(kind, data):
+    """Wrap some data in a JPEG segment."""
+    return pack('>BBH', 0xFF, kind, len(data) + 2) + data
+
+
+class ExifTestCase(BaseTestCase):
+    filename = 'exif'
+
+    def setUp(self):
+        super().setUp()
+        self.data = mkdtemp()
+        self.addCleanup(rmtree, self.data)
+
+    def write(self, data, name='photo'):
+        """Write a photo file and return its name."""
+        filename = join(self.data, name)
+        with open(filename, 'wb') as photo:
+            photo.write(data)
+        return filename
+
+    def test_read_header_tiff(self):
+        """Ensure the tags are read straight out of TIFF-based raw files."""
+        for order in '<>':
+            data = tiff(order, {
+                0x010F: ascii('Nikon'),
+                0x0110: ascii('D70'),
+                0x0112: short(order, 6),
+                0x0132: ascii('2000:01:01 00:00:00'),
+                0x0100: short(order, 3008),
+            }, photo={
+                0x9003: ascii('2012:02:03 04:05:06'),
+                0xA431: ascii('1234'),
+            }, gps={
+                0x0001: (2, 2, b'S\0'),
+                0x0002: rationals(order, 33, 51, 54),
+                0x0003: (2, 2, b'E\0'),
+                0x0004: rationals(order, 151, 12, 36),
+                0x0005: (1, 1, b'\x01'),
+                0x0006: rationals(order, 2.5),
+            })
+            tags = self.mod.read_header(self.write(data + bytes(100000)))
+            self.assertEqual(tags, {
+                'Exif.Image.Make': 'Nikon',
+                'Exif.Image.Model': 'D70',
+                'Exif.Image.Orientation': 6,
+                'Exif.Image.DateTime': '2000:01:01 00:00:00',
+                'Exif.Photo.DateTimeOriginal': '2012:02:03 04:05:06',
+                'Exif.Photo.BodySerialNumber': '1234',
+                'Exif.GPSInfo.GPSLatitudeRef': 'S',
+                'Exif.GPSInfo.GPSLatitude': (33.0, 51.0, 54.0),
+                'Exif.GPSInfo.GPSLongitudeRef': 'E',
+                'Exif.GPSInfo.GPSLongitude': (151.0, 12.0, 36.0),
+                'Exif.GPSInfo.GPSAltitudeRef': 1,
+                'Exif.GPSInfo.GPSAltitude': 2.5,
+            })
+            lon, lat, ele = tags.get_gps_info()
+            self.assertAlmostEqual(lon, 151.21)
+            self.assertAlmostEqual(lat, -33.865)
+            self.assertEqual(ele, -2.5)
+
+    def test_read_header_jpeg(self):
+        """Ensure only the segments ahead of the image data are read."""
+        exif = tiff('>', {0x0110: ascii('PowerShot')})
+        xmp = (b'<x:xmpmeta><rdf:Description tiff:Model="Ignored" '
+               b'exif:DateTimeOriginal="2010-10-16T14:12:28-06:00" '
+               b'exif:GPSLatitude="49,53.5N" exif:GPSAltitude="2301/10">'
+               b'<exif:GPSLongitude>97,9.0,30W</exif:GPSLongitude>'
+               b'</rdf:Description></x:xmpmeta>')
+        data = b''.join([
+            b'\xff\xd8',
+            segment(0xE0, b'JFIF\0' + bytes(9)),
+            segment(0xE1, b'Exif\0\0' + exif),
+            segment(0xE1, b'http://ns.adobe.com/xap/1.0/\0' + xmp),
+            segment(0xDA, bytes(10)),
+            segment(0xE1, b'Exif\0\0' + tiff('<', {
+                0x010F: ascii('Too late')})),
+        ])
+        tags = self.mod.read_header(self.write(data))
+        self.assertEqual(tags, {
+            'Exif.Image.Model': 'PowerShot',
+            'Exif.Photo.DateTimeOriginal': '2010:10:16 14:12:28',
+            'Exif.GPSInfo.GPSLatitudeRef': 'N',
+            'Exif.GPSInfo.GPSLatitude': (49.0, 53.5, 0.0),
+            'Exif.GPSInfo.GPSLongitudeRef': 'W',
+            'Exif.GPSInfo.GPSLongitude': (97.0, 9.0, 30.0),
+            'Exif.GPSInfo.GPSAltitude': 230.1,
+        })
+        lon, lat, ele = tags.get_gps_info()
+        self.assertAlmostEqual(lon, -97.15833333)
+        self.assertAlmostEqual(lat, 49.89166667)
+        self.assertAlmostEqual(ele, 230.1)
+
+    def test_read_header_thumbnail(self):
+        """Ensure the thumbnail in IFD1 can be found from the file alone."""
+        jpeg = b'\xff\xd8' + bytes(100) + b'\xff\xd9'
+        app0 = segment(0xE0, b'JFIF\0' + bytes(9))
+        for order in '<>':
+            exif = tiff(order, {0x0110: ascii('PowerShot')}, thumbnail=jpeg)
+            for data in (exif, b'\xff\xd8' + app0 + segment(
+                    0xE1, b'Exif\0\0' + exif) + segment(0xDA, bytes(10))):
+                filename = self.write(data)
+                tags = self.mod.read_header(filename)
+                self.assertEqual(tags['Exif.Image.Model'], 'PowerShot')
+                offset = tags['Exif.Thumbnail.JPEGInterchangeFormat']
+                length = tags['Exif.Thumbnail.JPEGInterchangeFormatLength']
+                with open(filename, 'rb') as photo:
+                    photo.seek(offset)
+                    self.assertEqual(photo.read(length), jpeg)
+
+        # A broken IFD1 doesn't spoil the rest of the metadata.
+        tags = self.mod.read_header(self.write(exif[:-120]))
+        self.assertEqual(tags, {'Exif.Image.Model': 'PowerShot'})
+
+    def test_read_header_empty(self):
+        """Ensure photos without any metadata have no tags."""
+        tags = self.mod.read_header(self.write(b'\xff\xd8\xff\xd9'))
+        self.assertEqual(tags, {})
+        self.assertEqual(tags.get_gps_info(), (0.0, 0.0, 0.0))
+
+    def test_read_header_demo(self):
+        """Ensure we can read the demo photos."""
+        tags = self.mod.read_header(join(self.demo_dir, 'IMG_2421.JPG'))
+        self.assertEqual(tags['Exif.Image.Make'], 'Canon')
+        self.assertEqual(tags.get_gps_info(), (0.0, 0.0, 0.0))
+
+    def test_read_header_loop(self):
+        """Ensure IFDs that point at themselves are only read once."""
+        # Append an IFD0 whose EXIF pointer points right back at itself.
+        data = tiff('<', {0x010F: ascii('Loopy')})
+        data += pack('<HHHII', 1, 0x8769, 4, 1, len(data)) + bytes(4)
+        data = data[:4] + pack('<I', len(data) - 18) + data[8:]
+        tags = self.mod.read_header(self.write(data))
+        self.assertEqual(tags, {})
+
+    def test_read_header_invalid(self):
+        """Ensure we refuse files that aren't photos."""
+        exif = tiff('<', {0x010F: ascii('Canon')})
+        for junk in (b'', b'\x89PNG\r\n\x1a\n' + bytes(100),
+                     b'<?xml version="1.0"?><gpx></gpx>',
+                     b'II\x2b\0' + bytes(20),
+                     exif[:-10],
+                     b'\xff\xd8' + segment(0xE1, b'Exif\0\0' + exif[:20])):
+            with self.assertRaisesRegex(OSError, 'No metadata found'):
+                self.mod.read_header(self.write(junk))
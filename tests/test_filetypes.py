@@ -0,0 +1,104 @@
+"""Test the classes and functions defined by gg/filetypes.py"""
+
+from tempfile import mkdtemp
+from shutil import rmtree, copy
+from gzip import open as gzip_open
+from zipfile import ZipFile
+from os.path import join
+from os import makedirs, symlink
+
+from tests import BaseTestCase
+
+
+class FileTypesTestCase(BaseTestCase):
+    filename = 'filetypes'
+
+    def setUp(self):
+        super().setUp()
+        self.data = mkdtemp()
+        self.addCleanup(rmtree, self.data)
+
+    def write(self, name, data):
+        """Write a file and return its name."""
+        filename = join(self.data, name)
+        with open(filename, 'wb') as output:
+            output.write(data)
+        return filename
+
+    def test_sniff(self):
+        """Ensure files are identified by their contents, not their names."""
+        for name, kind in (('minimal.gpx', 'gpx'), ('unusual.gpx', 'gpx'),
+                           ('sample.tcx', 'tcx'), ('normal.kml', 'kml'),
+                           ('mytracks.csv', 'csv'), ('minimal.csv', 'csv')):
+            renamed = join(self.data, 'track.dat')
+            copy(join(self.data_dir, name), renamed)
+            self.assertEqual(self.mod.sniff(renamed), kind)
+        for name in ('IMG_2411.JPG', 'IMG_2421.JPG'):
+            renamed = join(self.data, 'photo.gpx')
+            copy(join(self.demo_dir, name), renamed)
+            self.assertEqual(self.mod.sniff(renamed), 'photo')
+
+    def test_sniff_compressed(self):
+        """Ensure gzipped tracks and KMZ archives are looked inside of."""
+        with open(join(self.data_dir, 'sample.tcx'), 'rb') as tcx:
+            data = tcx.read()
+        gz = join(self.data, 'sample.tcx.gz')
+        with gzip_open(gz, 'wb') as compressed:
+            compressed.write(data)
+        self.assertEqual(self.mod.sniff(gz), 'tcx')
+        with self.mod.open_track(gz) as track:
+            self.assertEqual(track.read(), data)
+
+        kmz = join(self.data, 'sample.kmz')
+        with ZipFile(kmz, 'w') as archive:
+            archive.writestr('images/icon.png', b'\x89PNG\r\n\x1a\n\0')
+            archive.write(join(self.data_dir, 'normal.kml'), 'normal.kml')
+        self.assertEqual(self.mod.sniff(kmz), 'kml')
+
+    def test_sniff_utf16(self):
+        """Ensure XML in UTF-16 isn't mistaken for a photo."""
+        gpx = self.write('utf16.xml', '<?xml version="1.0" encoding="UTF-16"?>'
+                         '<gpx version="1.1"></gpx>'.encode('utf-16'))
+        self.assertEqual(self.mod.sniff(gpx), 'gpx')
+
+    def test_sniff_csv_by_name(self):
+        """Ensure CSV files without the usual header go by their name."""
+        csv = self.write('points.CSV', b'"Segment","Time"\n')
+        self.assertEqual(self.mod.sniff(csv), 'csv')
+
+    def test_sniff_invalid(self):
+        """Ensure files we can't use are refused without being decoded."""
+        for name, data, error in (
+                ('empty.gpx', b'', 'Unknown file type'),
+                ('notes.txt', b'Hello, world!\n', 'Unknown file type'),
+                ('feed.xml', b'<rss></rss>', 'Unknown file type'),
+                ('broken.gpx.gz', b'\x1f\x8b\x08\0' + bytes(20),
+                 'Bad compressed file'),
+                ('broken.kmz', b'PK\x03\x04' + bytes(20), 'Bad KMZ file')):
+            with self.assertRaisesRegex(OSError, error):
+                self.mod.sniff(self.write(name, data))
+
+        kmz = join(self.data, 'empty.kmz')
+        with ZipFile(kmz, 'w') as archive:
+            archive.writestr('readme.txt', 'No tracks here.')
+        with self.assertRaisesRegex(OSError, 'No KML found'):
+            self.mod.sniff(kmz)
+
+        with self.assertRaises(OSError):
+            self.mod.sniff(join(self.data, 'missing.gpx'))
+
+    def test_find_files(self):
+        """Ensure directories are searched recursively, in order."""
+        for name in ('b', 'a/c', 'a/.hidden', '.git'):
+            makedirs(join(self.data, name))
+        for name in ('z.jpg', 'a/y.gpx', 'a/c/x.jpg', 'a/.hidden/w.jpg',
+                     'a/.v.jpg', '.git/config', 'b/u.kml'):
+            self.write(name, b'')
+        symlink(join(self.data, 'a'), join(self.data, 'b', 'loop'))
+        expected = [join(self.data, name) for name in (
+            'z.jpg', 'a/y.gpx', 'a/c/x.jpg', 'b/loop', 'b/u.kml')]
+        self.assertEqual(list(self.mod.find_files([self.data, 'photo.jpg'])),
+                         expected + ['photo.jpg'])
+        self.assertEqual(list(self.mod.find_files([join(self.data, 'b')])),
+                         [join(self.data, 'b', name) for name in (
+                             'loop', 'u.kml')])
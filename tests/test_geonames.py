@@ -0,0 +1,179 @@
+"""Test the classes and functions defined by gg/geonames.py"""
+
+from io import BytesIO
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+
+from tests import BaseTestCase
+
+
+def make_cities(seed=0, number=2000):
+    """Generate some randomly placed cities."""
+    rand = Random(seed)
+    lines = []
+    for i in range(number):
+        lat = round(rand.uniform(-60, 70), 4)
+        lon = round(rand.uniform(-180, 180), 4)
+        lines.append('City {}\t{}\t{}\tC{}\tS{}\tZone/{}\n'.format(
+            i, lat, lon, i % 7, i % 11, i))
+    return lines
+
+
+def linear_scan(lines, lat1, lon1):
+    """Find the nearest city the slow way."""
+    near, dist = None, float('inf')
+    for city in lines:
+        name, lat2, lon2, country, state, tz = city.split('\t')
+        x = (float(lon2) - lon1)
+        y = (float(lat2) - lat1)
+        delta = x * x + y * y
+        if delta < dist:
+            dist = delta
+            near = (name, state, country, tz.strip())
+    return near
+
+
+class GeonamesTestCase(BaseTestCase):
+    filename = 'geonames'
+
+    def setUp(self):
+        super().setUp()
+        self.data = mkdtemp()
+        self.addCleanup(rmtree, self.data)
+
+    def write(self, lines):
+        """Compile some cities into a database and load it."""
+        filename = join(self.data, 'cities.db')
+        with open(filename, 'wb') as db:
+            self.mod.write_database(lines, db)
+        return self.mod.GeoNames(filename)
+
+    def test_city_index_nearest(self):
+        """Ensure the CityIndex agrees with a linear scan."""
+        lines = make_cities()
+        index = self.mod.CityIndex(lines)
+        rand = Random(1)
+        for i in range(500):
+            lat = rand.uniform(-90, 90)
+            lon = rand.uniform(-180, 180)
+            self.assertEqual(index.nearest(lat, lon),
+                             linear_scan(lines, lat, lon))
+
+    def test_city_index_sparse(self):
+        """Ensure the CityIndex searches far away for isolated queries."""
+        lines = make_cities(number=3)
+        index = self.mod.CityIndex(lines)
+        for lat, lon in ((90, 180), (-90, -180), (0, 0), (89.9, -179.9)):
+            self.assertEqual(index.nearest(lat, lon),
+                             linear_scan(lines, lat, lon))
+
+    def test_city_index_ties(self):
+        """Ensure equidistant cities resolve to the first one listed."""
+        lines = ['B\t0\t1\tBB\t02\tZone/B\n', 'A\t0\t-1\tAA\t01\tZone/A\n']
+        index = self.mod.CityIndex(lines)
+        self.assertEqual(index.nearest(0, 0), ('B', '02', 'BB', 'Zone/B'))
+        self.assertEqual(index.nearest(0.1, 0), ('B', '02', 'BB', 'Zone/B'))
+        self.assertEqual(index.nearest(0, -0.1), ('A', '01', 'AA', 'Zone/A'))
+
+    def test_city_index_empty(self):
+        """Ensure an empty CityIndex finds nothing."""
+        self.assertIsNone(self.mod.CityIndex([]).nearest(10, 10))
+
+    def test_geonames_nearest(self):
+        """Ensure the database agrees with a linear scan."""
+        lines = make_cities()
+        lines.append('Pole\t90\t180\tNP\t00\tZone/Pole\n')
+        lines.append('Antipode\t-90\t-180\tSP\t00\tZone/Antipode\n')
+        db = self.write(lines)
+        self.assertEqual(len(db), 2002)
+        rand = Random(2)
+        for i in range(500):
+            lat = rand.uniform(-90, 90)
+            lon = rand.uniform(-180, 180)
+            self.assertEqual(db.nearest(lat, lon),
+                             linear_scan(lines, lat, lon))
+        self.assertEqual(db.nearest(89.5, 179.5)[0], 'Pole')
+        self.assertEqual(db.nearest(-89.5, -179.5)[0], 'Antipode')
+
+    def test_geonames_place(self):
+        """Ensure the database stores unicode strings."""
+        db = self.write(['Zürich\t47.36667\t8.55\tCH\t25\tEurope/Zurich\n',
+                         'Montréal\t45.50884\t-73.58781\tCA\t10\t'
+                         'America/Montreal\n'])
+        self.assertEqual(db.place(0), ('Zürich', '25', 'CH', 'Europe/Zurich'))
+        self.assertEqual(db.place(1),
+                         ('Montréal', '10', 'CA', 'America/Montreal'))
+        self.assertEqual(list(db.lats), [47.36667, 45.50884])
+        self.assertEqual(list(db.lons), [8.55, -73.58781])
+
+    def test_geonames_search(self):
+        """Ensure cities can be found by any three letters of their name."""
+        db = self.write(['Regina\t50.45\t-104.6\tCA\t11\tAmerica/Regina\n',
+                         'Villa Regina\t-39.1\t-67.1\tAR\t16\tZone/A\n',
+                         'Waregem\t50.9\t3.4\tBE\tVLG\tEurope/Brussels\n',
+                         'Edmonton\t53.5\t-113.5\tCA\t01\tAmerica/Edmonton\n'])
+        self.assertEqual(list(db.containing('reg')), [0, 1, 2])
+        self.assertEqual(list(db.containing('gin')), [0, 1])
+        self.assertEqual(list(db.containing('edm')), [3])
+        self.assertEqual(list(db.containing('xyz')), [])
+        self.assertEqual(list(db.containing('aaa')), [])
+        self.assertEqual(list(db.containing('zzz')), [])
+        self.assertEqual(db.search('REG'), [0, 1, 2])
+        self.assertEqual(db.search('regina'), [0, 1])
+        self.assertEqual(db.search('a regi'), [1])
+        self.assertEqual(db.search('ginaw'), [])
+        self.assertEqual(db.search('re'), [])
+        self.assertEqual(db.search('reg', limit=2), [0, 1])
+
+    def test_geonames_search_ranked(self):
+        """Ensure the best matches come first, then the biggest cities."""
+        db = self.write(['Santana\t0\t0\tBR\t01\tZ\t500\n',
+                         'Pisan\t0\t0\tIT\t02\tZ\t90000\n',
+                         'San Jose\t0\t0\tUS\tCA\tZ\t1000000\n',
+                         'El San\t0\t0\tSV\t03\tZ\t20\n',
+                         'San\t0\t0\tML\t04\tZ\t10\n',
+                         'San Juan\t0\t0\tPR\t05\tZ\t\n',
+                         'Sandy\t0\t0\tUS\tUT\tZ\t90000\n'])
+        self.assertEqual(list(db.populations),
+                         [500, 90000, 1000000, 20, 10, 0, 90000])
+        self.assertEqual(db.search('san'), [4, 2, 6, 0, 5, 3, 1])
+        self.assertEqual(db.search('San', limit=3), [4, 2, 6])
+        self.assertEqual(db.search('san j'), [2, 5])
+        self.assertEqual(db.search('san', limit=0), [])
+
+    def test_geonames_search_folded(self):
+        """Ensure searches ignore accents and case."""
+        db = self.write(['Zürich\t47.4\t8.5\tCH\t25\tEurope/Zurich\n',
+                         'São Paulo\t-23.5\t-46.6\tBR\t27\tZone/A\t12000000\n',
+                         'SAO MIGUEL\t37.8\t-25.5\tPT\t20\tZone/B\t50\n',
+                         'Straßburg\t48.6\t7.8\tFR\t44\tEurope/Paris\n'])
+        self.assertEqual(db.search('zurich'), [0])
+        self.assertEqual(db.search('ZÜRICH'), [0])
+        self.assertEqual(db.search('sao paulo'), [1])
+        self.assertEqual(db.search('são'), [1, 2])
+        self.assertEqual(db.search('strassburg'), [3])
+        self.assertEqual(db.string(db.keys[1]), 'sao paulo')
+        self.assertEqual(db.place(1)[0], 'São Paulo')
+
+    def test_geonames_invalid(self):
+        """Ensure we refuse to load things that aren't city databases."""
+        filename = join(self.data, 'cities.db')
+        for junk in (b'', b'GGCITIES', b'NOTCITIES' * 100):
+            with open(filename, 'wb') as db:
+                db.write(junk)
+            with self.assertRaisesRegex(OSError, 'Not a city database'):
+                self.mod.GeoNames(filename)
+
+    def test_write_database_aligned(self):
+        """Ensure every section of the database is 8-byte aligned."""
+        output = BytesIO()
+        self.mod.write_database(make_cities(number=50), output)
+        data = output.getvalue()
+        offset = self.mod.HEADER.size
+        for name, code in self.mod.SECTIONS:
+            start, length = self.mod.SECTION.unpack_from(data, offset)
+            offset += self.mod.SECTION.size
+            self.assertEqual(start % 8, 0)
+            self.assertLessEqual(start + length, len(data))
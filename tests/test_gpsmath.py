@@ -1,5 +1,12 @@
 """Test the classes and functions defined by gg/gpsmath.py"""
 
+from mock import Mock, call
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from os import utime
+
+from gg.geonames import write_database
 from tests import BaseTestCase
 
 
@@ -8,3 +15,209 @@ class GpsmathTestCase(BaseTestCase):
 
     def setUp(self):
         super().setUp()
+        self.data = mkdtemp()
+        self.addCleanup(rmtree, self.data)
+        self.mod.PKG_DATA_DIR = self.data
+        self.mod.get_cache_dir = Mock(return_value=self.data)
+        self.write_cities()
+
+    def write_cities(self, count=10):
+        """Compile a small city database."""
+        with open(join(self.data, 'cities.db'), 'wb') as cities:
+            write_database(['City {0}\t{0}\t{0}\tAA\t01\tZone/{0}\n'.format(i)
+                            for i in range(count)], cities)
+
+    def test_load_cities(self):
+        """Ensure cities.db is only loaded once."""
+        index = self.mod.load_cities()
+        self.assertEqual(len(index), 10)
+        self.assertIs(self.mod.load_cities(), index)
+        key = self.mod.GeoCacheKey(index.lats[3], index.lons[3])
+        self.assertEqual(self.mod.do_cached_lookup(key), index.place(3))
+
+    def test_geocode(self):
+        """Ensure each cache cell is only looked up once."""
+        self.mod.do_cached_lookup = Mock(side_effect=[
+            ('Edmonton', '01', 'CA', 'America/Edmonton\n'),
+            ('Nowhere', '', 'XX', 'UTC'),
+        ])
+        places = self.mod.geocode([53.544, 53.5441, 0, 53.5439],
+                                  [-113.491, -113.4911, 0, -113.4909])
+        edmonton = ('Edmonton', 'Alberta', 'Canada', 'America/Edmonton')
+        self.assertEqual(places, [edmonton, edmonton,
+                                  ('Nowhere', None, None, 'UTC'), edmonton])
+        keys = [str(c[1][0]) for c in self.mod.do_cached_lookup.mock_calls]
+        self.assertEqual(keys, ['53.54,-113.49', '0.00,0.00'])
+
+    def test_geocode_empty(self):
+        """Ensure geocoding nothing does nothing."""
+        self.mod.do_cached_lookup = Mock()
+        self.assertEqual(self.mod.geocode([], []), [])
+        self.assertEqual(self.mod.do_cached_lookup.mock_calls, [])
+
+    def test_update_derived_properties(self):
+        """Ensure pending geodata lookups can be done in one batch."""
+        self.mod.geocode = Mock(return_value=[('A', 'B', 'C', 'D')])
+        waiting = Mock(modified_timeout=5, positioned=True, generation=0,
+                       latitude=10, longitude=20, geocoding=None)
+        unplaced = Mock(modified_timeout=6, positioned=False, geocoding=None)
+        current = Mock(modified_timeout=None, generation=2, delivered=2)
+        self.mod.update_derived_properties(
+            [waiting, unplaced, current], wait=True)
+        self.assertEqual(self.mod.GLib.source_remove.mock_calls,
+                         [call(5), call(6)])
+        self.mod.geocode.assert_called_once_with([10], [20])
+        waiting.set_geodata.assert_called_once_with('A', 'B', 'C', 'D')
+        self.assertEqual(waiting.delivered, waiting.generation)
+        for coord in (waiting, unplaced):
+            self.assertIsNone(coord.modified_timeout)
+            coord.notify.assert_called_once_with('positioned')
+        self.assertEqual(unplaced.set_geodata.mock_calls, [])
+        self.assertEqual(current.mock_calls, [])
+
+    def test_update_derived_properties_in_flight(self):
+        """Ensure saving doesn't miss lookups that haven't been delivered."""
+        self.mod.geocode = Mock(return_value=[('A', 'B', 'C', 'D')])
+        job = Mock()
+        flying = Mock(modified_timeout=None, positioned=True, generation=3,
+                      delivered=2, latitude=10, longitude=20, geocoding=job)
+        self.mod.background = Mock()
+        self.mod.update_derived_properties([flying])
+        self.mod.background.submit.assert_called_once_with(
+            self.mod.geocode, [], [])
+        self.assertEqual(job.cancel.mock_calls, [])
+        self.mod.update_derived_properties([flying], wait=True)
+        job.cancel.assert_called_once_with()
+        self.assertIsNone(flying.geocoding)
+        self.mod.geocode.assert_called_once_with([10], [20])
+        flying.set_geodata.assert_called_once_with('A', 'B', 'C', 'D')
+        self.assertEqual((flying.generation, flying.delivered), (4, 4))
+        self.assertEqual(self.mod.GLib.source_remove.mock_calls, [])
+
+    def test_resolve_geodata(self):
+        """Ensure geocoding happens in a worker, delivered to the main loop."""
+        self.mod.geocode = Mock(return_value=[('A', 'B', 'C', 'D'),
+                                              ('E', 'F', 'G', 'H')])
+        self.mod.background = Mock()
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = False
+        job.result.return_value = self.mod.geocode.return_value
+        moved = Mock(generation=0, latitude=1, longitude=2)
+        still = Mock(generation=0, latitude=3, longitude=4)
+        self.assertIs(self.mod.resolve_geodata([moved, still]), job)
+        self.mod.background.submit.assert_called_once_with(
+            self.mod.geocode, [1, 3], [2, 4])
+        self.assertEqual((moved.generation, still.generation), (1, 1))
+
+        # The first one moved again before the results arrived.
+        moved.generation += 1
+        done = job.add_done_callback.call_args[0][0]
+        done(job)
+        idle = self.mod.GLib.idle_add.call_args[0][0]
+        self.assertFalse(idle())
+        self.assertEqual(moved.set_geodata.mock_calls, [])
+        still.set_geodata.assert_called_once_with('E', 'F', 'G', 'H')
+        self.assertIsNone(still.geocoding)
+
+    def test_resolve_geodata_cancelled(self):
+        """Ensure cancelled lookups deliver nothing."""
+        self.mod.background = Mock()
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = True
+        self.mod.resolve_geodata([Mock(generation=0)])
+        job.add_done_callback.call_args[0][0](job)
+        self.assertEqual(self.mod.GLib.idle_add.mock_calls, [])
+
+    def test_coordinates_update_derived_properties(self):
+        """Ensure a coordinate's pending lookup is replaced when it moves."""
+        self.mod.resolve_geodata = Mock()
+        old = Mock()
+        coord = Mock(modified_timeout=7, positioned=True, generation=3,
+                     geocoding=old)
+        coord.cancel_geodata = lambda: cancel(coord)
+        cancel = self.mod.Coordinates.cancel_geodata
+        update = self.mod.Coordinates.update_derived_properties
+        self.assertFalse(update(coord))
+        old.cancel.assert_called_once_with()
+        self.mod.GLib.source_remove.assert_called_once_with(7)
+        self.mod.resolve_geodata.assert_called_once_with([coord])
+        self.assertIs(coord.geocoding, self.mod.resolve_geodata.return_value)
+        self.assertIsNone(coord.modified_timeout)
+        self.assertEqual(coord.generation, 4)
+
+        # Moving to 0,0 still invalidates any earlier lookup.
+        coord.modified_timeout = 8
+        coord.positioned = False
+        self.assertFalse(update(coord))
+        self.assertIsNone(coord.geocoding)
+        self.assertEqual(coord.generation, 5)
+        self.assertEqual(self.mod.resolve_geodata.call_count, 1)
+
+    def test_geocache_persist(self):
+        """Ensure geocoding results survive into the next session."""
+        key = self.mod.GeoCacheKey(3.001, 3.002)
+        place = self.mod.do_cached_lookup(key)
+        self.assertEqual(place, ('City 3', '01', 'AA', 'Zone/3'))
+        self.mod.save_geocache()
+        self.mod.do_cached_lookup.cache.clear()
+        self.mod.load_cities = Mock()
+        self.mod.restore_geocache()
+        self.assertEqual(self.mod.do_cached_lookup(key), place)
+        self.assertEqual(self.mod.load_cities.mock_calls, [])
+        self.assertEqual(self.mod.do_cached_lookup.cache.info().hits, 1)
+        self.mod.get_cache_dir.assert_called_with('geonames')
+
+    def test_geocache_save_temp(self):
+        """Ensure every save writes its own temporary file."""
+        self.mod.replace = Mock()
+        self.mod.save_geocache()
+        self.mod.save_geocache()
+        (first, target), (second, again) = [
+            args for args, kwargs in self.mod.replace.call_args_list]
+        self.assertNotEqual(first, second)
+        self.assertEqual(target, join(self.data, 'places.json'))
+        self.assertEqual(again, target)
+
+    def test_geocache_stale(self):
+        """Ensure saved geocoding is discarded when cities.db changes."""
+        self.mod.do_cached_lookup(self.mod.GeoCacheKey(3, 3))
+        self.mod.save_geocache()
+        self.mod.do_cached_lookup.cache.clear()
+        self.write_cities(count=5)
+        utime(join(self.data, 'cities.db'), (0, 0))
+        self.mod.restore_geocache()
+        self.assertEqual(len(self.mod.do_cached_lookup.cache), 0)
+
+    def test_geocache_missing(self):
+        """Ensure a missing or damaged cache is ignored."""
+        self.mod.restore_geocache()
+        self.assertEqual(len(self.mod.do_cached_lookup.cache), 0)
+        with open(join(self.data, 'places.json'), 'w') as cache:
+            cache.write('{"stamp": ')
+        self.mod.restore_geocache()
+        self.assertEqual(len(self.mod.do_cached_lookup.cache), 0)
+
+    def test_load_cities_compiled(self):
+        """Ensure cities.txt is compiled when cities.db can't be used."""
+        installed = mkdtemp()
+        self.addCleanup(rmtree, installed)
+        self.mod.PKG_DATA_DIR = installed
+        with open(join(installed, 'cities.txt'), 'w') as cities:
+            cities.write('Here\t10\t10\tAA\t01\tZone/Here\n')
+        with open(join(installed, 'cities.db'), 'wb') as cities:
+            cities.write(b'GGCITIES' + bytes(100))
+        index = self.mod.load_cities()
+        self.assertEqual(index.nearest(9, 9),
+                         ('Here', '01', 'AA', 'Zone/Here'))
+        self.mod.get_cache_dir.assert_called_once_with('geonames')
+
+        # The compiled copy is reused until cities.txt changes.
+        self.mod.load_cities.cache.clear()
+        self.mod.compile_database = Mock()
+        self.assertEqual(len(self.mod.load_cities()), 1)
+        self.assertEqual(self.mod.compile_database.mock_calls, [])
+        utime(join(installed, 'cities.txt'), (2 ** 33, 2 ** 33))
+        self.mod.load_cities.cache.clear()
+        self.mod.load_cities()
+        self.mod.compile_database.assert_called_once_with(
+            join(installed, 'cities.txt'), join(self.data, 'cities.db'))
@@ -109,3 +109,18 @@ class LabelTestCase(BaseTestCase):
         self.assertNotIn(photo, self.mod.Label.cache)
         label.unmap.assert_called_once_with()
         self.mod.Champlain.Label.destroy.assert_called_once_with(label)
+
+    def test_label_destroy_bindings(self):
+        """Ensure loading and unloading a photo leaves no bindings behind."""
+        @self.mod.memoize
+        class Binding:
+            def __init__(self, *args, **kwargs):
+                pass
+
+        self.mod.Binding = Binding
+        Binding(Mock(), 'latitude', Mock())
+        before = dict(Binding.cache.data)
+        label = self.mod.Label(Mock())
+        self.assertEqual(len(Binding.cache), 4)
+        label.destroy()
+        self.assertEqual(Binding.cache.data, before)
@@ -2,6 +2,10 @@
 
 from time import struct_time
 from mock import Mock, call
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join, dirname
+from os import stat
 
 from tests import BaseTestCase
 
@@ -17,6 +21,23 @@ class GError(Exception):
     pass
 
 
+class pixbuf:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.scaled = []
+
+    def get_width(self):
+        return self.width
+
+    def get_height(self):
+        return self.height
+
+    def scale_simple(self, width, height, interp):
+        self.scaled.append(pixbuf(width, height))
+        return self.scaled[-1]
+
+
 class PhotosTestCase(BaseTestCase):
     filename = 'photos'
 
@@ -24,14 +45,33 @@ class PhotosTestCase(BaseTestCase):
         super().setUp()
         self.mod.TrackFile = Mock()
         self.mod.Widgets = Mock()
+        self.mod.GObject.GError = GError
+        self.mod.Gst = Mock()
+        self.mod.Gst.get_boolean.return_value = True
+        exif = self.mod.GExiv2.Metadata.return_value
+        exif.get_preview_properties.return_value = []
+        self.cache_dir = mkdtemp()
+        self.addCleanup(rmtree, self.cache_dir)
+        self.mod.thumbnail_cache = self.mod.ThumbnailCache(self.cache_dir)
+        self.Mipmap = self.mod.Mipmap
+        self.mod.Mipmap = Mock()
+
+    def set_points(self, tracks):
+        """Replace the global track points with the given ones."""
+        stamps = sorted(tracks)
+        self.mod.points = type(self.mod.points)(
+            stamps,
+            [tracks[stamp].lat for stamp in stamps],
+            [tracks[stamp].lon for stamp in stamps],
+            [tracks[stamp].ele for stamp in stamps])
 
     def test_auto_timestamp_comparison_exact(self):
         """Ensure we can find exact matches in GPX/EXIF data."""
-        self.mod.points = {
+        self.set_points({
             1: point(0, 0, 0),
             2: point(1, 1, 1),
             3: point(2, 2, 2),
-        }
+        })
         self.mod.TrackFile.range = [1, 3]
         photo = Mock()
         photo.manual = False
@@ -41,10 +81,10 @@ class PhotosTestCase(BaseTestCase):
 
     def test_auto_timestamp_comparison_interpolate(self):
         """Ensure we can interpolate GPX data (easy numbers)."""
-        self.mod.points = {
+        self.set_points({
             1: point(0, 0, 0),
             4: point(1, 10, 100),
-        }
+        })
         self.mod.TrackFile.range = [1, 4]
         photo = Mock()
         photo.manual = False
@@ -57,10 +97,10 @@ class PhotosTestCase(BaseTestCase):
 
     def test_auto_timestamp_comparison_interpolate_2(self):
         """Ensure we can interpolate GPX data (realistic timestamps)."""
-        self.mod.points = {
+        self.set_points({
             1420254516: point(0, 0, 0),
             1420254518: point(100, 50, 800),
-        }
+        })
         self.mod.TrackFile.range = [1420254516, 1420254518]
         photo = Mock()
         photo.manual = False
@@ -80,15 +120,19 @@ class PhotosTestCase(BaseTestCase):
     def test_fetch_thumbnail(self, orient=1, pixbuf=None, args=None):
         """Ensure we can load thumbnails from photos."""
         new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
-        new_args = ['foo.jpg', 100, 100]
+        new_args = ['foo.jpg', 128, 128]
         pixbuf = pixbuf or new
         args = [new.return_value] + args if args else new_args
+        pixbuf.return_value.get_width.return_value = 128
+        pixbuf.return_value.get_height.return_value = 96
         self.mod.GExiv2.Metadata.return_value.__getitem__ = Mock(
             return_value=orient)
         thumb = self.mod.fetch_thumbnail('foo.jpg', size=100)
         self.mod.GExiv2.Metadata.assert_called_once_with('foo.jpg')
         new.assert_called_once_with(*new_args)
-        self.assertEqual(thumb, pixbuf.return_value)
+        self.assertEqual(thumb, pixbuf.return_value.scale_simple.return_value)
+        pixbuf.return_value.scale_simple.assert_called_once_with(
+            100, 75, self.mod.GdkPixbuf.InterpType.BILINEAR)
         pixbuf.assert_called_once_with(*args)
 
     def test_fetch_thumbnail_orient_2(self):
@@ -136,7 +180,7 @@ class PhotosTestCase(BaseTestCase):
         """Ensure we can handle missing thumbnails in the second attempt."""
         m = self.mod.GExiv2.Metadata.return_value
         m.__getitem__ = Mock(return_value=1)
-        m.get_preview_properties.return_value.__getitem__ = Mock()
+        m.get_preview_properties.return_value = [self.preview(160, 120)]
         m.get_preview_image.side_effect = GError
         self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = GError
         self.mod.GObject.GError = GError
@@ -146,16 +190,338 @@ class PhotosTestCase(BaseTestCase):
     def test_fetch_thumbnail_gerror3(self):
         """Ensure we can handle the third potential thubnail failure."""
         m = self.mod.GExiv2.Metadata.return_value
-        m.__getitem__ = Mock(return_value=1)
-        m.get_preview_properties.return_value.__getitem__ = Mock()
+        m.__getitem__ = Mock(return_value=6)
+        small, big = self.preview(160, 120), self.preview(100, 75)
+        self.mod.Gst.get_boolean.return_value = False
+        m.get_preview_properties.return_value = [small, big]
         self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = GError
         self.mod.GObject.GError = GError
-        thumb = self.mod.fetch_thumbnail('foo.jpg', size=100)
         stream = self.mod.GdkPixbuf.Pixbuf.new_from_stream_at_scale
-        self.assertEqual(thumb, stream.return_value)
+        rotate = self.mod.GdkPixbuf.Pixbuf.rotate_simple
+        rotate.return_value.get_width.return_value = 96
+        rotate.return_value.get_height.return_value = 128
+        thumb = self.mod.fetch_thumbnail('foo.jpg', size=128)
+        self.assertEqual(thumb, rotate.return_value)
+        rotate.assert_called_once_with(
+            stream.return_value, self.mod.GdkPixbuf.PixbufRotation.CLOCKWISE)
+        m.get_preview_image.assert_called_once_with(small)
         stream.assert_called_once_with(
             self.mod.Gio.MemoryInputStream.new_from_data.return_value,
-            100, 100, True, None)
+            128, 128, True, None)
+
+    def preview(self, width, height):
+        """Describe one of the previews embedded in a photo."""
+        preview = Mock()
+        preview.get_width.return_value = width
+        preview.get_height.return_value = height
+        return preview
+
+    def test_fetch_thumbnail_preview(self, enabled=True):
+        """Ensure the smallest embedded preview that's big enough is used."""
+        m = self.mod.GExiv2.Metadata.return_value
+        m.__getitem__ = Mock(return_value=8)
+        self.mod.Gst.get_boolean.return_value = enabled
+        previews = [self.preview(1920, 1280), self.preview(160, 120),
+                    self.preview(300, 200), self.preview(200, 300)]
+        m.get_preview_properties.return_value = previews
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
+        stream = self.mod.GdkPixbuf.Pixbuf.new_from_stream_at_scale
+        rotate = self.mod.GdkPixbuf.Pixbuf.rotate_simple
+        rotate.return_value.get_width.return_value = 171
+        rotate.return_value.get_height.return_value = 256
+        thumb = self.mod.fetch_thumbnail('foo.jpg', size=200)
+        self.mod.Gst.get_boolean.assert_called_once_with(
+            'use-embedded-previews')
+        rotate.assert_called_once_with(
+            stream.return_value if enabled else new.return_value,
+            self.mod.GdkPixbuf.PixbufRotation.COUNTERCLOCKWISE)
+        self.assertEqual(thumb, rotate.return_value.scale_simple.return_value)
+        rotate.return_value.scale_simple.assert_called_once_with(
+            133, 200, self.mod.GdkPixbuf.InterpType.BILINEAR)
+        if enabled:
+            m.get_preview_image.assert_called_once_with(previews[2])
+            self.assertEqual(new.mock_calls, [])
+        else:
+            self.assertEqual(m.get_preview_image.mock_calls, [])
+            new.assert_called_once_with('foo.jpg', 256, 256)
+
+    def test_fetch_thumbnail_preview_disabled(self):
+        """Ensure the whole photo is decoded if previews are turned off."""
+        self.test_fetch_thumbnail_preview(enabled=False)
+
+    def test_fetch_thumbnail_preview_too_small(self):
+        """Ensure small previews are passed over for the whole photo."""
+        m = self.mod.GExiv2.Metadata.return_value
+        m.__getitem__ = Mock(return_value=1)
+        m.get_preview_properties.return_value = [self.preview(160, 120)]
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
+        new.return_value.get_width.return_value = 256
+        new.return_value.get_height.return_value = 192
+        self.mod.fetch_thumbnail('foo.jpg', size=256)
+        new.assert_called_once_with('foo.jpg', 256, 256)
+        self.assertEqual(m.get_preview_image.mock_calls, [])
+
+    def test_fetch_thumbnail_cached(self):
+        """Ensure thumbnails are shared through the freedesktop.org cache."""
+        photo = join(self.demo_dir, 'IMG_2411.JPG')
+        uri = 'file://' + photo
+        mtime = str(int(stat(photo).st_mtime))
+        self.mod.GLib.filename_to_uri.side_effect = lambda f, h: 'file://' + f
+        embedded = self.mod.GdkPixbuf.Pixbuf.new_from_stream.return_value
+        embedded.get_width.return_value = 160
+        embedded.get_height.return_value = 120
+        saved = Mock()
+        saved.get_width.return_value = 256
+        saved.get_height.return_value = 192
+        self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.return_value = saved
+        self.mod.GExiv2.Metadata.return_value.__getitem__ = Mock(
+            return_value=1)
+        self.mod.fetch_thumbnail(photo, size=200)
+        temp = saved.savev.call_args[0][0]
+        self.assertTrue(temp.startswith(join(self.cache_dir, 'large')))
+        saved.savev.assert_called_once_with(
+            temp, 'png', ['tEXt::Thumb::URI', 'tEXt::Thumb::MTime'],
+            [uri, mtime])
+
+        # The next time, the cached PNG is used instead of the photo.
+        self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.reset_mock()
+        self.mod.GExiv2.Metadata.reset_mock()
+        png = self.mod.GdkPixbuf.Pixbuf.new_from_file
+        png.reset_mock()
+        png.return_value.get_option.side_effect = {
+            'tEXt::Thumb::URI': uri, 'tEXt::Thumb::MTime': mtime}.get
+        png.return_value.get_width.return_value = 200
+        png.return_value.get_height.return_value = 150
+        self.assertEqual(self.mod.fetch_thumbnail(photo, size=200),
+                         png.return_value)
+        path = self.mod.thumbnail_cache.locate(photo, 200)[0]
+        self.assertEqual(dirname(temp), dirname(path))
+        self.assertTrue(temp.endswith('.tmp'))
+        png.assert_called_once_with(path)
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+        self.assertEqual(
+            self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.mock_calls, [])
+
+    def test_thumbnail_cache_save_temp(self):
+        """Ensure every save writes its own temporary file."""
+        photo = join(self.demo_dir, 'IMG_2411.JPG')
+        self.mod.GLib.filename_to_uri.side_effect = lambda f, h: 'file://' + f
+        self.mod.replace = Mock()
+        thumb = Mock()
+        for i in range(2):
+            self.mod.thumbnail_cache.save(photo, thumb, 256)
+        first, second = [args[0] for args, kwargs in
+                         self.mod.replace.call_args_list]
+        self.assertNotEqual(first, second)
+        self.assertEqual(
+            [args[0] for args, kwargs in thumb.savev.call_args_list],
+            [first, second])
+
+    def test_thumbnail_cache_stale(self):
+        """Ensure thumbnails of older versions of the photo are ignored."""
+        photo = join(self.demo_dir, 'IMG_2411.JPG')
+        self.mod.GLib.filename_to_uri.side_effect = lambda f, h: 'file://' + f
+        png = self.mod.GdkPixbuf.Pixbuf.new_from_file
+        png.return_value.get_option.side_effect = {
+            'tEXt::Thumb::URI': 'file://' + photo,
+            'tEXt::Thumb::MTime': '1'}.get
+        self.assertIsNone(self.mod.thumbnail_cache.load(photo, 128))
+        png.assert_called_once_with(
+            join(self.cache_dir, 'normal', self.mod.md5(
+                ('file://' + photo).encode('utf-8')).hexdigest() + '.png'))
+        self.assertIsNone(self.mod.thumbnail_cache.load('missing.jpg', 128))
+
+    def test_read_metadata(self):
+        """Ensure everything we need is read from the metadata at once."""
+        exif = self.mod.GExiv2.Metadata.return_value
+        exif.__getitem__ = Mock(side_effect={
+            'Exif.Image.Orientation': '6',
+            'Exif.Image.Make': 'Nikon',
+            'Exif.Photo.BodySerialNumber': '1234'}.__getitem__)
+        exif.get.side_effect = {
+            'Exif.Photo.DateTime': '2015:01:03 12:13:14',
+            'Exif.Image.DateTime': '1999:01:01 00:00:00'}.get
+        exif.get_gps_info.return_value = (3, 5, 8)
+        metadata = self.mod.read_metadata('foo.jpg')
+        self.mod.GExiv2.Metadata.assert_called_once_with('foo.jpg')
+        self.assertEqual(metadata, self.mod.Metadata(
+            exif, 6, struct_time([2015, 1, 3, 12, 13, 14, 5, 3, -1]),
+            (3, 5, 8), dict(Make='Nikon', Model='', BodySerialNumber='1234'),
+            None))
+
+    def test_read_metadata_header(self):
+        """Ensure JPEG metadata is read without GExiv2."""
+        metadata = self.mod.read_metadata(join(self.demo_dir, 'IMG_2411.JPG'))
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+        self.assertEqual(metadata, self.mod.Metadata(
+            None, 1, struct_time([2010, 10, 16, 14, 12, 28, 5, 289, -1]),
+            (0.0, 0.0, 0.0),
+            dict(Make='Canon', Model='Canon PowerShot A590 IS'),
+            (5120, 5129)))
+
+    def test_read_metadata_defaults(self):
+        """Ensure photos without much metadata can still be read."""
+        exif = self.mod.GExiv2.Metadata.return_value
+        exif.__getitem__ = Mock(side_effect=KeyError)
+        exif.get.return_value = None
+        metadata = self.mod.read_metadata('foo.jpg')
+        self.assertEqual(metadata.orientation, 1)
+        self.assertIsNone(metadata.orig_time)
+        self.assertEqual(metadata.camera_info, dict(Make='', Model=''))
+
+    def test_decode_photo(self):
+        """Ensure we can decode photos without touching the interface."""
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.read_metadata = Mock()
+        self.mod.Gst.get_int.return_value = 150
+        thumb, metadata = self.mod.decode_photo('foo.jpg')
+        self.mod.read_metadata.assert_called_once_with('foo.jpg')
+        self.assertEqual(metadata, self.mod.read_metadata.return_value)
+        self.mod.fetch_thumbnail.assert_called_once_with(
+            'foo.jpg', 150, metadata)
+        self.assertEqual(thumb, self.mod.fetch_thumbnail.return_value)
+        self.assertEqual(self.mod.Widgets.mock_calls, [])
+
+    def test_fetch_thumbnail_metadata(self):
+        """Ensure metadata that was already read isn't read again."""
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
+        new.return_value.get_width.return_value = 256
+        new.return_value.get_height.return_value = 192
+        metadata = self.mod.Metadata(Mock(), 1, None, (0, 0, 0), {}, None)
+        metadata.exif.get_preview_properties.return_value = []
+        thumb = self.mod.fetch_thumbnail('foo.jpg', 256, metadata)
+        self.assertEqual(thumb, new.return_value)
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+
+        # When only the header was read, GExiv2 isn't needed at all.
+        metadata = metadata._replace(exif=None)
+        for enabled in (True, False):
+            self.mod.Gst.get_boolean.return_value = enabled
+            self.mod.fetch_thumbnail('foo.jpg', 256, metadata)
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+
+        # Unless the photo can't be decoded any other way.
+        new.side_effect = GError
+        self.mod.GExiv2.Metadata.return_value.get_preview_properties\
+            .return_value = [self.preview(160, 120)]
+        stream = self.mod.GdkPixbuf.Pixbuf.new_from_stream_at_scale
+        stream.return_value.get_width.return_value = 256
+        stream.return_value.get_height.return_value = 192
+        self.assertEqual(self.mod.fetch_thumbnail('foo.jpg', 256, metadata),
+                         stream.return_value)
+        self.mod.GExiv2.Metadata.assert_called_once_with('foo.jpg')
+
+    def test_fetch_thumbnail_header(self):
+        """Ensure the EXIF thumbnail is read without GExiv2."""
+        photo = join(self.demo_dir, 'IMG_2411.JPG')
+        self.mod.GLib.filename_to_uri.side_effect = lambda f, h: 'file://' + f
+        metadata = self.mod.read_metadata(photo)
+        embedded = self.mod.GdkPixbuf.Pixbuf.new_from_stream.return_value
+        embedded.get_width.return_value = 160
+        embedded.get_height.return_value = 120
+        embedded.scale_simple.return_value.get_width.return_value = 128
+        embedded.scale_simple.return_value.get_height.return_value = 96
+        thumb = self.mod.fetch_thumbnail(photo, 100, metadata)
+        data = self.mod.Gio.MemoryInputStream.new_from_data.call_args[0][0]
+        self.assertEqual(len(data), 5129)
+        self.assertEqual(data[:2], b'\xff\xd8')
+        embedded.scale_simple.assert_called_once_with(
+            128, 96, self.mod.GdkPixbuf.InterpType.BILINEAR)
+        scaled = embedded.scale_simple.return_value
+        self.assertEqual(thumb, scaled.scale_simple.return_value)
+        self.assertEqual(
+            self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.mock_calls, [])
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+
+        # It's too small for bigger thumbnails, so the photo is decoded.
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
+        new.return_value.get_width.return_value = 256
+        new.return_value.get_height.return_value = 192
+        self.assertEqual(self.mod.fetch_thumbnail(photo, 256, metadata),
+                         new.return_value)
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+
+    def test_decode_photo_gerror(self):
+        """Ensure we fail to decode photos that have no metadata."""
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.GExiv2.Metadata.side_effect = self.mod.GObject.GError = GError
+        with self.assertRaisesRegexp(OSError, 'No metadata found.'):
+            self.mod.decode_photo('foo.jpg')
+
+    def test_mipmap(self):
+        """Ensure smaller thumbnails are scaled from the one in memory."""
+        source = pixbuf(500, 375)
+        self.mod.background = Mock()
+        mipmap = self.Mipmap('foo.jpg', source, 500)
+        then = Mock()
+        self.assertIs(mipmap.scale(500, then), source)
+        thumb = mipmap.scale(100, then)
+        self.assertEqual((thumb.width, thumb.height), (100, 75))
+        self.assertEqual(source.scaled, [thumb])
+        self.assertEqual(mipmap.scale(300, then).width, 300)
+        self.assertIs(mipmap.source, source)
+        self.assertEqual(self.mod.background.submit.mock_calls, [])
+        self.assertEqual(then.mock_calls, [])
+
+    def test_mipmap_grow(self):
+        """Ensure bigger thumbnails are fetched in the background."""
+        source = pixbuf(100, 75)
+        self.mod.background = Mock()
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = False
+        job.result.return_value = bigger = pixbuf(300, 225)
+        mipmap = self.Mipmap('foo.jpg', source, 100)
+        then = Mock()
+        self.assertIs(mipmap.scale(300, then), source)
+        self.mod.background.submit.assert_called_once_with(
+            self.mod.fetch_thumbnail, 'foo.jpg', 300)
+        job.add_done_callback.call_args[0][0](job)
+        grown, *args = self.mod.GLib.idle_add.call_args[0]
+        self.assertFalse(grown(*args))
+        then.assert_called_once_with(bigger)
+        self.assertIs(mipmap.source, bigger)
+        self.assertEqual(mipmap.limit, 300)
+        self.assertIsNone(mipmap.job)
+
+    def test_mipmap_grow_superseded(self):
+        """Ensure a bigger thumbnail isn't shown once it's no longer wanted."""
+        source = pixbuf(100, 75)
+        self.mod.background = Mock()
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = False
+        mipmap = self.Mipmap('foo.jpg', source, 100)
+        then = Mock()
+        mipmap.scale(300, then)
+        mipmap.scale(80, then)
+        job.cancel.assert_called_once_with()
+        job.add_done_callback.call_args[0][0](job)
+        grown, *args = self.mod.GLib.idle_add.call_args[0]
+        grown(*args)
+        self.assertEqual(then.mock_calls, [])
+        self.assertIs(mipmap.source, source)
+
+    def test_mipmap_fetch_error(self):
+        """Ensure the thumbnail survives failing to fetch it again."""
+        source = pixbuf(100, 75)
+        self.mod.background = Mock()
+        job = self.mod.background.submit.return_value
+        job.result.side_effect = OSError
+        mipmap = self.Mipmap('gone.jpg', source, 100)
+        then = Mock()
+        self.assertIs(mipmap.scale(200, then), source)
+        mipmap.grown(job, 200, then)
+        self.assertEqual(then.mock_calls, [])
+        self.assertIs(mipmap.source, source)
+
+    def test_mipmap_small(self):
+        """Ensure small thumbnails are never enlarged, or fetched again."""
+        source = pixbuf(80, 60)
+        self.mod.background = Mock()
+        mipmap = self.Mipmap('small.jpg', source, 100)
+        self.assertIs(mipmap.scale(200, None), source)
+        self.assertEqual(mipmap.scale(50, None).width, 50)
+        self.assertIs(mipmap.source, source)
+        self.assertEqual(self.mod.background.submit.mock_calls, [])
 
     def test_photograph_resize_all_photos(self):
         """Ensure we can resize all photos."""
@@ -166,10 +532,22 @@ class PhotosTestCase(BaseTestCase):
         self.mod.fetch_thumbnail = Mock()
         self.mod.Photograph.resize_all_photos(gst, 'size')
         gst.get_int.assert_called_once_with('size')
-        self.assertEqual(p.thumb, self.mod.fetch_thumbnail.return_value)
-        self.mod.fetch_thumbnail.assert_called_once_with(p.filename, 150)
+        p.show_thumbnail.assert_called_once_with(p.mipmap.scale.return_value)
+        p.mipmap.scale.assert_called_once_with(150, p.show_thumbnail)
+        self.assertEqual(self.mod.fetch_thumbnail.mock_calls, [])
+
+    def test_photograph_show_thumbnail(self):
+        """Ensure new thumbnails are shown in the photo pane."""
+        self.mod.fetch_thumbnail = Mock()
+        p = self.mod.Photograph('kappa.jpg')
+        p.show_thumbnail('small')
+        self.assertEqual(p.thumb, 'small')
+        self.assertEqual(self.mod.Widgets.loaded_photos.mock_calls, [])
+        p.iter = 'kappa'
+        p.show_thumbnail('big')
+        self.assertEqual(p.thumb, 'big')
         self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
-            p.iter, 2, p.thumb)
+            'kappa', 2, 'big')
 
     def test_photograph_load_from_file(self):
         """Ensure we can load photos from files."""
@@ -184,9 +562,9 @@ class PhotosTestCase(BaseTestCase):
         c.timezone_method = 'lookup'
         self.mod.Widgets = Mock()
         self.assertEqual(load('zing.jpg'), p)
-        self.mod.Photograph.assert_called_once_with('zing.jpg')
+        self.mod.Photograph.assert_called_once_with('zing.jpg', thumb=None)
         self.mod.Label.assert_called_once_with(p)
-        p.read.assert_called_once_with()
+        p.read.assert_called_once_with(None)
         self.mod.Widgets.empty_camera_list.hide.assert_called_once_with()
         self.mod.Camera.generate_id.assert_called_once_with(p.camera_info)
         self.mod.Camera.assert_called_once_with('Nikon')
@@ -199,15 +577,29 @@ class PhotosTestCase(BaseTestCase):
         """Ensure we can initialize Photograph object."""
         self.mod.Coordinates.__init__ = Mock()
         self.mod.fetch_thumbnail = Mock()
+        self.mod.Gst.get_int.return_value = 150
         p = self.mod.Photograph('grill.jpg')
         self.mod.Coordinates.__init__.assert_called_once_with(p)
-        self.assertEqual(p.thumb, self.mod.fetch_thumbnail.return_value)
+        self.mod.fetch_thumbnail.assert_called_once_with('grill.jpg', 150)
+        self.mod.Mipmap.assert_called_once_with(
+            'grill.jpg', self.mod.fetch_thumbnail.return_value, 150)
+        scale = self.mod.Mipmap.return_value.scale
+        self.assertEqual(p.thumb, scale.return_value)
+        scale.assert_called_once_with(150, p.show_thumbnail)
         self.assertEqual(p.filename, 'grill.jpg')
         self.assertEqual(
             p.connect.mock_calls,
             [call('notify::geoname', p.update_liststore_summary),
              call('notify::positioned', self.mod.Widgets.button_sensitivity)])
 
+    def test_photograph_init_decoded(self):
+        """Ensure we can initialize Photographs with a decoded thumbnail."""
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.Gst.get_int.return_value = 150
+        self.mod.Photograph('iota.jpg', thumb='thumb')
+        self.mod.Mipmap.assert_called_once_with('iota.jpg', 'thumb', 150)
+        self.assertEqual(self.mod.fetch_thumbnail.mock_calls, [])
+
     def test_photograph_str(self):
         """Ensure we can stringify Photograph objects."""
         self.mod.fetch_thumbnail = Mock()
@@ -255,6 +647,24 @@ class PhotosTestCase(BaseTestCase):
             dict(Make='hi', BodySerialNumber='hi',
                  CameraSerialNumber='hi', Model='hi'))
 
+    def test_photograph_read_decoded(self):
+        """Ensure we can read photo data that has already been decoded."""
+        self.mod.modified = Mock()
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.str = Mock(return_value='hola!')
+        exif = Mock()
+        metadata = self.mod.Metadata(exif, 1, None, (3, 5, 8),
+                                     dict(Make='Nikon', Model='D70'), None)
+        p = self.mod.Photograph('kappa.jpg')
+        p.calculate_timestamp = Mock()
+        p.read(metadata)
+        self.assertEqual(p.exif, exif)
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+        self.assertEqual(p.latitude, 5)
+        self.assertIsNone(p.orig_time)
+        self.assertEqual(p.camera_info, metadata.camera_info)
+        self.assertIsNot(p.camera_info, metadata.camera_info)
+
     def test_photograph_calculate_timestamp(self, time=1420341828, offset=0):
         """Ensure we can get the timestamp from a photo."""
         self.mod.mktime = Mock(return_value=time + 0.1)
@@ -311,6 +721,21 @@ class PhotosTestCase(BaseTestCase):
         self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
             p.iter, 1, self.mod.str.return_value)
 
+    def test_photograph_write_header_only(self):
+        """Ensure GExiv2 is only loaded for writing when it's needed."""
+        self.mod.modified = Mock()
+        self.mod.stat = Mock()
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.utime = Mock()
+        self.mod.GExiv2.Metadata.return_value.__setitem__ = Mock()
+        p = self.mod.Photograph('epsilon.jpg')
+        p.names = (None, None, None)
+        self.assertIsNone(p.exif)
+        p.write()
+        self.mod.GExiv2.Metadata.assert_called_once_with('epsilon.jpg')
+        self.assertIs(p.exif, self.mod.GExiv2.Metadata.return_value)
+        p.exif.save_file.assert_called_once_with()
+
     def test_photograph_disable_auto_position(self):
         """Ensure we mark photos as manual-positioned to preserve locations."""
         self.mod.fetch_thumbnail = Mock()
@@ -368,8 +793,11 @@ class PhotosTestCase(BaseTestCase):
         self.mod.Label.cache = [p]
         p.camera = Mock()
         p.iter = 'theta'
+        p.cancel_geodata = Mock()
         self.assertIn('theta.jpg', self.mod.Photograph.cache)
         p.destroy()
+        p.cancel_geodata.assert_called_once_with()
+        p.mipmap.cancel.assert_called_once_with()
         self.mod.Label.assert_called_once_with(p)
         self.mod.Label.return_value.destroy.assert_called_once_with()
         p.camera.remove_photo.assert_called_once_with(p)
@@ -1,7 +1,11 @@
 """Test the classes and functions defined by gg/search.py"""
 
 from mock import Mock, call
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
 
+from gg.geonames import GeoNames, write_database
 from tests import BaseTestCase
 
 
@@ -26,36 +30,101 @@ class SearchTestCase(BaseTestCase):
         entry.set_completion.assert_called_once_with(search)
         self.assertEqual(4, len(entry.connect.mock_calls))
 
-    def test_search_load_result(self):
-        """Ensure we can load results into the search db."""
-        searched = set()
-        append = Mock()
-        entry = Mock()
-        entry.get_text.return_value = 'Regina'
-        self.controller.load_results(entry, append, searched)
+    def test_search_find_places(self):
+        """Ensure we can find places in the real city database."""
+        rows = self.mod.find_places('Regina')
         # Exact match is there
         self.assertIn(
-            call(('Regina, Saskatchewan, Canada', 50.45008, -104.6178)),
-            append.mock_calls)
+            ('Regina, Saskatchewan, Canada', 50.45008, -104.6178), rows)
         # Substring match is there
         self.assertIn(
-            call(('Villa Regina, Rio Negro, Argentina', -39.1, -67.06667)),
-            append.mock_calls)
-        # Anything with 'reg' is also there
-        self.assertIn(
-            call(('Waregem, Flanders, Belgium', 50.88898, 3.42756)),
-            append.mock_calls)
-        self.assertEqual(len(append.mock_calls), 266)
-        self.assertEqual(searched, set(['reg']))
-
-    def test_search_load_result_cache(self):
-        """Ensure we can search against cached results."""
-        searched = set(['reg'])
-        append = Mock()
+            ('Villa Regina, Rio Negro, Argentina', -39.1, -67.06667), rows)
+
+    def test_search_find_places_database(self):
+        """Ensure search results come from the city database."""
+        data = mkdtemp()
+        self.addCleanup(rmtree, data)
+        with open(join(data, 'cities.db'), 'wb') as db:
+            write_database([
+                'Regina\t50.45008\t-104.6178\tCA\t11\tAmerica/Regina\n',
+                'Edmonton\t53.5\t-113.5\tCA\t01\tAmerica/Edmonton\n',
+                'Waregem\t50.88898\t3.42756\tBE\tVLG\tEurope/Brussels\n',
+            ], db)
+        self.mod.load_cities = Mock(
+            return_value=GeoNames(join(data, 'cities.db')))
+        self.assertEqual(self.mod.find_places('REG'), [
+            ('Regina, Saskatchewan, Canada', 50.45008, -104.6178),
+            ('Waregem, Flanders, Belgium', 50.88898, 3.42756),
+        ])
+
+    def test_search_load_results(self):
+        """Ensure searches wait for typing to pause, and then run in a worker.
+        """
+        glib = self.mod.GLib
+        self.mod.background = Mock()
         entry = Mock()
-        entry.get_text.return_value = 'Regina'
-        self.controller.load_results(entry, append, searched)
-        self.assertEqual(append.mock_calls, [])
+        entry.get_text.return_value = 'Reg'
+        self.controller.load_results(entry)
+        glib.timeout_add.assert_called_once_with(
+            self.mod.DELAY, self.controller.start_search, 'Reg')
+        self.assertIs(self.controller.timeout, glib.timeout_add.return_value)
+        self.assertEqual(self.mod.background.submit.mock_calls, [])
+
+        self.assertFalse(self.controller.start_search('Reg'))
+        self.assertIsNone(self.controller.timeout)
+        self.mod.background.submit.assert_called_once_with(
+            self.mod.find_places, 'Reg')
+        job = self.mod.background.submit.return_value
+        self.assertIs(self.controller.job, job)
+
+        job.cancelled.return_value = False
+        job.result.return_value = [('Regina', 1.0, 2.0), ('Waregem', 3.0, 4.0)]
+        job.add_done_callback.call_args[0][0](job)
+        self.mod.Gtk.ListStore.new.reset_mock()
+        self.assertFalse(glib.idle_add.call_args[0][0]())
+        self.mod.Gtk.ListStore.new.assert_called_once_with([str, float, float])
+        results = self.mod.Gtk.ListStore.new.return_value
+        self.assertEqual(results.append.mock_calls, [
+            call(('Regina', 1.0, 2.0)), call(('Waregem', 3.0, 4.0))])
+        self.assertIs(self.controller.results, results)
+        self.controller.completion.set_model.assert_called_with(results)
+        self.controller.completion.complete.assert_called_once_with()
+        self.assertIsNone(self.controller.job)
+
+    def test_search_load_results_superseded(self):
+        """Ensure more typing abandons searches for the older text."""
+        glib = self.mod.GLib
+        entry = Mock()
+        entry.get_text.return_value = 'Reg'
+        self.controller.load_results(entry)
+        timeout = self.controller.timeout
+        entry.get_text.return_value = 'Regi'
+        self.controller.load_results(entry)
+        glib.source_remove.assert_called_once_with(timeout)
+
+        job = self.controller.job = Mock()
+        entry.get_text.return_value = 'Re'
+        self.controller.load_results(entry)
+        job.cancel.assert_called_once_with()
+        self.assertIsNone(self.controller.job)
+        self.assertIsNone(self.controller.timeout)
+        self.assertEqual(glib.timeout_add.call_count, 2)
+        self.assertEqual(self.controller.search, 'Re')
+
+        # Results that arrive late are discarded.
+        self.mod.Gtk.ListStore.new.reset_mock()
+        self.assertFalse(self.controller.show_results('Regi', [('R', 1, 2)]))
+        self.assertEqual(self.mod.Gtk.ListStore.new.mock_calls, [])
+        self.assertEqual(self.controller.completion.complete.mock_calls, [])
+
+    def test_search_start_search_cancelled(self):
+        """Ensure cancelled searches deliver nothing."""
+        self.mod.background = Mock()
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = True
+        self.controller.start_search('Reg')
+        job.add_done_callback.call_args[0][0](job)
+        self.assertEqual(self.mod.GLib.idle_add.mock_calls, [])
 
     def test_search_search_completed(self):
         """Ensure we can jump to selected search results."""
@@ -69,13 +138,14 @@ class SearchTestCase(BaseTestCase):
         model.get.assert_called_once_with(
             itr, self.mod.LATITUDE, self.mod.LONGITUDE)
         self.mod.MapView.center_on.assert_called_once_with(1, 2)
+        self.assertEqual(self.controller.last_search, [1, 2])
 
     def test_search_repeat_last_search(self):
         """Ensure we can jump back to previous search results."""
         entry = Mock()
-        model = Mock()
-        self.controller.last_search = 'foo'
-        self.controller.search_completed = Mock()
-        self.controller.repeat_last_search(entry, model)
-        self.controller.search_completed.assert_called_once_with(
-            entry, model, 'foo')
+        self.controller.go_to = Mock()
+        self.controller.repeat_last_search(entry)
+        self.assertEqual(self.controller.go_to.mock_calls, [])
+        self.controller.last_search = (1, 2)
+        self.controller.repeat_last_search(entry)
+        self.controller.go_to.assert_called_once_with(1, 2)
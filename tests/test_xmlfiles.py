@@ -1,8 +1,13 @@
 """Test the classes and functions defined by gg/xmlfiles.py"""
 
 from mock import Mock, call
+from tempfile import mkdtemp
+from shutil import copy, rmtree
 from os.path import join
+from os import listdir, utime
 from xml.parsers.expat import ExpatError
+from gzip import open as gzip_open
+from zipfile import ZipFile
 
 from tests import BaseTestCase
 
@@ -16,7 +21,11 @@ class XmlFilesTestCase(BaseTestCase):
         self.mod.Gst = Mock()
         self.mod.GSettings = Mock()
         self.mod.MapView = Mock()
+        self.mod.Widgets = Mock()
         self.normal_kml = join(self.data_dir, 'normal.kml')
+        self.cache_dir = mkdtemp()
+        self.addCleanup(rmtree, self.cache_dir)
+        self.mod.track_cache = self.mod.TrackCache(self.cache_dir)
 
     def test_gtkclutter_init(self):
         """Ensure GtkClutter.__init__() has been called."""
@@ -46,31 +55,120 @@ class XmlFilesTestCase(BaseTestCase):
         p[0].set_stroke_color.assert_called_once_with(c)
         p[1].set_stroke_color.assert_called_once_with(c.lighten().lighten())
 
+    def test_segment_append_point(self):
+        """Ensure we can append points to Segments."""
+        s = self.mod.Segment()
+        s.append_point(10, 1, 2, 3)
+        self.assertEqual(list(s.times), [10])
+        self.assertEqual(list(s.lats), [1])
+        self.assertEqual(list(s.lons), [2])
+        self.assertEqual(list(s.eles), [3.0])
+        self.assertEqual(s.columns(), (s.times, s.lats, s.lons, s.eles))
+
+    def test_segment_append_point_invalid_elevation(self):
+        """Ensure we can append invalid elevation values."""
+        s = self.mod.Segment()
+        s.append_point(10, 1, 2, 'five')
+        self.assertEqual(list(s.lats), [1])
+        self.assertEqual(list(s.lons), [2])
+        self.assertEqual(list(s.eles), [0.0])
+
     def test_polygon_init(self):
         """Ensure we can create Polygons."""
-        p = self.mod.Polygon()
+        s = self.mod.Segment()
+        p = self.mod.Polygon(s)
         p.set_stroke_width.assert_called_once_with(4)
         self.mod.MapView.add_layer.assert_called_once_with(p)
-
-    def test_polygon_append_point(self):
-        """Ensure we can append points to Polygons."""
-        p = self.mod.Polygon()
-        coord = p.append_point(1, 2, 3)
-        self.mod.Champlain.Coordinate.new_full.assert_called_once_with(1, 2)
-        self.assertEqual(coord.lat, 1)
-        self.assertEqual(coord.lon, 2)
-        self.assertEqual(coord.ele, 3.0)
-        p.add_node.assert_called_once_with(coord)
-
-    def test_polygon_append_point_invalid_elevation(self):
-        """Ensure we can append invalid elevation values."""
-        p = self.mod.Polygon()
-        coord = p.append_point(1, 2, 'five')
-        self.mod.Champlain.Coordinate.new_full.assert_called_once_with(1, 2)
-        self.assertEqual(coord.lat, 1)
-        self.assertEqual(coord.lon, 2)
-        self.assertEqual(coord.ele, 0.0)
-        p.add_node.assert_called_once_with(coord)
+        self.assertIs(p.segment, s)
+        self.assertEqual(p.add_node.mock_calls, [])
+
+    def test_segment_simplify(self):
+        """Ensure Segments rank their points by Douglas-Peucker distance."""
+        s = self.mod.Segment()
+        for lat, lon in ((0, 0), (1, 1), (2, 2), (2, 3), (3, 3), (3, 3)):
+            s.append_point(10, lat, lon, 0)
+        s.simplify()
+        self.assertEqual([round(d, 4) for d in s.detail],
+                         [float('inf'), 0, 0.5547, 0.7071, 0, float('inf')])
+
+    def test_segment_simplify_empty(self):
+        """Ensure empty Segments can be simplified."""
+        s = self.mod.Segment()
+        s.simplify()
+        self.assertEqual(list(s.detail), [])
+
+    def test_polygon_draw(self):
+        """Ensure Polygons only create map coordinates when drawn."""
+        s = self.mod.Segment()
+        s.append_point(10, 1, 2, 3)
+        s.append_point(11, 4, 5, 6)
+        p = self.mod.Polygon(s)
+        new = self.mod.Champlain.Coordinate.new_full
+        self.assertEqual(new.mock_calls, [])
+        self.mod.MapView.get_zoom_level.return_value = 0
+        p.draw()
+        self.assertEqual(new.mock_calls, [call(1, 2), call(4, 5)])
+        p.remove_all.assert_called_once_with()
+        self.assertEqual(p.add_node.mock_calls,
+                         [call(new.return_value), call(new.return_value)])
+        self.assertEqual(p.zoom, 0)
+
+    def test_polygon_draw_zoom(self):
+        """Ensure Polygons only draw the detail visible at each zoom level."""
+        s = self.mod.Segment()
+        for lat, lon in ((0, 0), (0.5, 1), (0, 2), (0.001, 3), (0, 4)):
+            s.append_point(10, lat, lon, 0)
+        p = self.mod.Polygon(s)
+        new = self.mod.Champlain.Coordinate.new_full
+        new.side_effect = lambda lat, lon: (lat, lon)
+        p.draw(0)
+        self.assertEqual(p.add_node.mock_calls, [call((0, 0)), call((0, 4))])
+        p.add_node.reset_mock()
+        p.draw(4)
+        self.assertEqual(p.add_node.mock_calls, [
+            call((0, 0)), call((0.5, 1)), call((0, 2)), call((0, 4))])
+        p.add_node.reset_mock()
+        p.draw(4)
+        self.assertEqual(p.add_node.mock_calls, [])
+        new.reset_mock()
+        p.draw(16)
+        self.assertEqual(len(p.add_node.mock_calls), 5)
+        self.assertEqual(new.mock_calls, [call(0.001, 3)])
+
+        # Zooming in further can't show any more points.
+        p.add_node.reset_mock()
+        p.draw(20)
+        self.assertEqual(p.add_node.mock_calls, [])
+        self.assertEqual(len(p.remove_all.mock_calls), 3)
+
+        # Zooming out only keeps the nodes being drawn, which are reused.
+        new.reset_mock()
+        p.draw(0)
+        self.assertEqual(new.mock_calls, [])
+        self.assertEqual(len(p.remove_all.mock_calls), 4)
+        self.assertEqual(list(p.drawn.values()), [(0, 0), (0, 4)])
+
+    def test_polygon_get_bounding_box(self):
+        """Ensure Polygons are measured at full resolution."""
+        s = self.mod.Segment()
+        s.append_point(10, 1, 5, 0)
+        s.append_point(11, 4, 2, 0)
+        s.append_point(12, 3, 3, 0)
+        p = self.mod.Polygon(s)
+        bounds = p.get_bounding_box()
+        self.assertEqual(bounds, self.mod.Champlain.BoundingBox.new())
+        self.assertEqual(bounds.extend.mock_calls, [call(1, 2), call(4, 5)])
+
+    def test_level_of_detail(self):
+        """Ensure zooming redraws every loaded Polygon."""
+        polygons = [Mock(), Mock()]
+        tf = Mock(polygons=polygons)
+        self.mod.TrackFile.instances = set([tf])
+        view = Mock()
+        self.mod.level_of_detail(view, 'zoom-level')
+        for polygon in polygons:
+            polygon.draw.assert_called_once_with(
+                view.get_zoom_level.return_value)
 
     def test_xmlsimpleparser_init(self):
         """Ensure we can initialize the simple XML parser."""
@@ -188,7 +286,7 @@ class XmlFilesTestCase(BaseTestCase):
         """Ensure the TrackFile can update its range."""
         self.mod.TrackFile.range = [9, 10]
         self.mod.TrackFile.instances = ['something']
-        self.mod.points = [1, 2, 3]
+        self.mod.points = Mock(timeline=[1, 2, 3])
         self.mod.TrackFile.update_range()
         self.mod.Widgets.empty_trackfile_list.hide.assert_called_once_with()
         self.assertEqual(self.mod.TrackFile.range, [1, 3])
@@ -196,7 +294,7 @@ class XmlFilesTestCase(BaseTestCase):
     def test_trackfile_update_range_empty(self):
         """Ensure the TrackFile can update an empty range."""
         self.mod.TrackFile.range = [9, 10]
-        self.mod.points = [1, 2, 3]
+        self.mod.points = Mock(timeline=[1, 2, 3])
         self.mod.TrackFile.update_range()
         self.mod.Widgets.empty_trackfile_list.show.assert_called_once_with()
         self.assertEqual(self.mod.TrackFile.range, [])
@@ -247,15 +345,30 @@ class XmlFilesTestCase(BaseTestCase):
         self.mod.GPXFile = Mock()
         self.mod.GPXFile.return_value.tracks = [1, 2, 3]
         self.mod.Widgets = Mock()
+        self.mod.points = Mock()
         self.mod.TrackFile.get_bounding_box = Mock()
         self.mod.TrackFile.instances = Mock()
         self.mod.TrackFile.update_range = Mock()
+        self.mod.sniff = Mock(return_value='gpx')
+        self.mod.background = Mock()
         self.mod.TrackFile.load_from_file('foo.gpx')
-        self.mod.GPXFile.assert_called_once_with('foo.gpx')
+        self.mod.background.submit.assert_called_once_with(
+            self.mod.TrackFile.parse_file, 'foo.gpx')
+        self.assertEqual(self.mod.GPXFile.return_value.display.mock_calls, [])
+
+        # The parsed file is displayed from the main loop.
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = False
+        job.result.return_value = self.mod.GPXFile('foo.gpx')
+        job.add_done_callback.call_args[0][0](job)
+        idle, arg = self.mod.GLib.idle_add.call_args[0]
+        self.assertFalse(idle(arg))
         self.mod.Widgets.status_message.assert_called_once_with(
             '3 points loaded in 1.00s.', True)
+        self.mod.GPXFile.return_value.display.assert_called_once_with()
         self.mod.TrackFile.instances.add.assert_called_once_with(
             self.mod.GPXFile.return_value)
+        self.mod.points.update.assert_called_once_with([1, 2, 3])
         self.mod.MapView.emit.assert_called_once_with('realize')
         self.mod.MapView.get_max_zoom_level.assert_called_once_with()
         self.mod.MapView.set_zoom_level.assert_called_once_with(
@@ -267,50 +380,152 @@ class XmlFilesTestCase(BaseTestCase):
             self.mod.GPXFile.return_value.start.geotimezone)
 
     def test_trackfile_load_from_file_keyerror(self):
-        """Ensure the TrackFile raises OSError correctly."""
-        with self.assertRaises(OSError):
-            self.mod.TrackFile.load_from_file('foo.unsupported')
+        """Ensure the TrackFile reports files it can't parse."""
+        self.mod.background = Mock()
+        self.mod.TrackFile.load_from_file('foo.unsupported')
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = False
+        job.result.side_effect = OSError('foo.unsupported: Not a GPS track.')
+        job.add_done_callback.call_args[0][0](job)
+        idle, arg = self.mod.GLib.idle_add.call_args[0]
+        idle(arg)
+        self.mod.Widgets.status_message.assert_called_once_with(
+            'foo.unsupported: Not a GPS track.')
+
+    def test_trackfile_load_from_file_cancelled(self):
+        """Ensure cancelled parsers display nothing."""
+        self.mod.background = Mock()
+        self.mod.TrackFile.load_from_file('foo.gpx')
+        job = self.mod.background.submit.return_value
+        job.cancelled.return_value = True
+        job.add_done_callback.call_args[0][0](job)
+        self.assertEqual(self.mod.GLib.idle_add.mock_calls, [])
+
+    def test_trackfile_load_from_file_parsed(self):
+        """Ensure the TrackFile can display an already parsed file."""
+        gpx = Mock(tracks=[1, 2, 3])
+        self.mod.Camera = Mock()
+        self.mod.GPXFile = Mock()
+        self.mod.points = Mock()
+        self.mod.TrackFile.get_bounding_box = Mock()
+        self.mod.TrackFile.instances = Mock()
+        self.mod.TrackFile.update_range = Mock()
+        self.mod.TrackFile.load_from_file('foo.gpx', gpx)
+        self.assertEqual(self.mod.GPXFile.mock_calls, [])
+        gpx.display.assert_called_once_with()
+        self.mod.TrackFile.instances.add.assert_called_once_with(gpx)
+
+    def test_trackfile_parse_file(self):
+        """Ensure the TrackFile picks the right parser."""
+        self.mod.TCXFile = Mock()
+        self.mod.sniff = Mock(return_value='tcx')
+        self.assertEqual(self.mod.TrackFile.parse_file('foo.xml'),
+                         self.mod.TCXFile.return_value)
+        self.mod.TCXFile.assert_called_once_with('foo.xml')
+        self.mod.sniff.assert_called_once_with('foo.xml')
+
+        self.mod.TrackFile.parse_file('bar.gpx', 'tcx')
+        self.mod.TCXFile.assert_called_with('bar.gpx')
+        self.assertEqual(self.mod.sniff.call_count, 1)
+
+        with self.assertRaisesRegex(OSError, 'Not a GPS track'):
+            self.mod.TrackFile.parse_file('baz.jpg', 'photo')
+
+    def test_trackfile_parse_file_compressed(self):
+        """Ensure gzipped tracks and KMZ archives can be parsed."""
+        data = mkdtemp()
+        self.addCleanup(rmtree, data)
+        gpx = join(data, 'track.gpx.gz')
+        with open(join(self.data_dir, 'minimal.gpx'), 'rb') as source:
+            with gzip_open(gpx, 'wb') as target:
+                target.write(source.read())
+        kmz = join(data, 'track.zip')
+        with ZipFile(kmz, 'w') as archive:
+            archive.writestr('files/readme.txt', 'Hello')
+            archive.write(join(self.data_dir, 'normal.kml'), 'doc.kml')
+        csv = join(data, 'track.csv.gz')
+        with open(join(self.data_dir, 'mytracks.csv'), 'rb') as source:
+            with gzip_open(csv, 'wb') as target:
+                target.write(source.read())
+
+        self.assertEqual(len(self.mod.TrackFile.parse_file(gpx).tracks), 3)
+        self.assertEqual(len(self.mod.TrackFile.parse_file(kmz).tracks),
+                         len(self.mod.KMLFile(
+                             join(self.data_dir, 'normal.kml')).tracks))
+        self.assertEqual(len(self.mod.TrackFile.parse_file(csv).tracks),
+                         len(self.mod.CSVFile(
+                             join(self.data_dir, 'mytracks.csv')).tracks))
 
     def test_trackfile_load_from_file_no_tracks(self):
         """Ensure the TrackFile can load a file with no tracks."""
         self.mod.GPXFile = Mock()
         self.mod.GPXFile.return_value.tracks = [1]
         self.mod.TrackFile.update_range = Mock()
-        self.mod.TrackFile.load_from_file('foo.gpx')
+        self.mod.sniff = Mock(return_value='gpx')
+        self.mod.TrackFile.load_from_file('foo.gpx', self.mod.GPXFile())
+        self.assertEqual(self.mod.GPXFile.return_value.display.mock_calls, [])
         self.assertEqual(self.mod.MapView.emit.mock_calls, [])
         self.assertEqual(self.mod.MapView.ensure_visible.mock_calls, [])
         self.assertEqual(self.mod.TrackFile.update_range.mock_calls, [])
 
-    def test_trackfile_init_first_no_points(self):
+    def test_trackfile_init_no_points(self):
         """Ensure the TrackFile can load a track with no points."""
-        self.mod.GSettings.return_value.get_string.return_value = ''
         self.mod.TrackFile.parse = Mock()
         with self.assertRaisesRegexp(OSError, 'No points found'):
             self.mod.TrackFile('/path/to/foo.gpx', 'a', 'b')
+        self.assertEqual(self.mod.GSettings.mock_calls, [])
+        self.assertEqual(self.mod.Widgets.mock_calls, [])
+
+    def test_trackfile_display_first(self):
+        """Ensure the TrackFile displays a newly loaded track."""
+        self.mod.GSettings.return_value.get_string.return_value = ''
+        self.mod.Builder = Mock()
+        self.mod.Coordinates = Mock()
+        self.mod.TrackFile.__init__ = lambda s: None
+        tf = self.mod.TrackFile()
+        tf.filename = '/path/to/foo.gpx'
+        tf.segments = [self.mod.Segment(), self.mod.Segment()]
+        tf.polygons = set()
+        tf.tracks = self.mod.TrackPoints([1], [2], [3], [4])
+        tf.alpha = 1
+        self.mod.MapView.get_zoom_level.return_value = 12
+        tf.display()
         self.mod.GSettings.assert_called_once_with('trackfile', 'foo.gpx')
         self.mod.Gst.get_value.assert_called_once_with('track-color')
         self.mod.GSettings.return_value.set_value.assert_called_once_with(
             'track-color', self.mod.Gst.get_value.return_value)
+        self.assertEqual(len(tf.polygons), 2)
+        self.assertEqual(set(p.segment for p in tf.polygons),
+                         set(tf.segments))
+        self.assertEqual(set(p.zoom for p in tf.polygons), set([12]))
+        tf.widgets.colorpicker.emit.assert_called_once_with('color-set')
+        self.mod.Coordinates.assert_called_once_with(latitude=2, longitude=3)
+        self.mod.Widgets.trackfiles_view.add.assert_called_once_with(
+            tf.widgets.trackfile_settings)
+
+        # Displaying it again does nothing.
+        tf.display()
+        self.mod.Builder.assert_called_once_with('trackfile')
 
     def test_trackfile_element_end(self):
-        """Ensure the TrackFile can end tracks."""
-        events = [False, True, True]
-        self.mod.Gtk.events_pending = lambda: events.pop()
+        """Ensure the TrackFile reports progress while parsing."""
         self.mod.clock = Mock(return_value=5)
         self.mod.TrackFile.clock = 1
-        self.mod.TrackFile.progress = Mock()
         self.mod.TrackFile.__init__ = lambda s: None
         tf = self.mod.TrackFile()
+        tf.filename = 'foo.gpx'
         tf.element_end('foo', 'bar')
-        self.assertEqual(
-            self.mod.Gtk.main_iteration.mock_calls,
-            [call(), call()])
+        self.mod.GLib.idle_add.assert_called_once_with(
+            self.mod.Widgets.progressbar.pulse)
         self.assertEqual(tf.clock, 5)
+        tf.element_end('foo', 'bar')
+        self.assertEqual(len(self.mod.GLib.idle_add.mock_calls), 1)
 
     def test_trackfile_destroy(self):
         """Ensure the TrackFile can destroy itself."""
-        other_tf = Mock()
-        self.mod.points = Mock()
+        TrackPoints = self.mod.TrackPoints
+        other_tf = Mock(tracks=TrackPoints([3, 4], [3, 4], [3, 4], [3, 4]))
+        self.mod.points = TrackPoints()
         self.mod.TrackFile.__init__ = lambda s: None
         self.mod.TrackFile.update_range = Mock()
         tf = self.mod.TrackFile()
@@ -319,12 +534,30 @@ class XmlFilesTestCase(BaseTestCase):
         tf.polygons = set(['poly'])
         tf.filename = 'foo.gpx'
         tf.cache = {'foo.gpx': 'contents'}
+        tf.tracks = TrackPoints([1, 2, 3], [1, 2, 9], [1, 2, 9], [1, 2, 9])
+        tf.alpha, tf.omega = 1, 3
+        self.mod.points.update(other_tf.tracks)
+        self.mod.points.update(tf.tracks)
+        self.assertEqual(self.mod.points[3].lat, 9)
         tf.destroy()
-        self.mod.points.clear.assert_called_once_with()
-        self.mod.points.update.assert_called_once_with(other_tf.tracks)
+        self.assertEqual(list(self.mod.points), [3, 4])
+        self.assertEqual(self.mod.points[3].lat, 3)
         tf.widgets.trackfile_settings.destroy.assert_called_once_with()
         self.mod.TrackFile.update_range.assert_called_once_with()
 
+    def test_parse_timestamp(self):
+        """Ensure we can decode all kinds of timestamps."""
+        parse = self.mod.parse_timestamp
+        self.assertEqual(parse('2010-10-16T20:09:13Z'), 1287259753)
+        self.assertEqual(parse('2010-10-16T20:09:13.999Z'), 1287259753)
+        self.assertEqual(parse('2010-10-16T20:09:13'), 1287259753)
+        self.assertEqual(parse(' 2010-10-16 20:09:13Z\n'), 1287259753)
+        self.assertEqual(parse('2010-10-16T14:09:13-06:00'), 1287259753)
+        self.assertEqual(parse('2010-10-17T01:39:13+0530'), 1287259753)
+        self.assertEqual(parse('Oct 16, 2010 8:09:13 PM UTC'), 1287259753)
+        with self.assertRaises(ValueError):
+            parse('This is not a date!')
+
     def test_gpxfile(self, filename='minimal.gpx'):
         """Ensure the GPXFile can parse GPX data."""
         self.mod.Champlain.Coordinate.new_full = Mock
@@ -346,6 +579,65 @@ class XmlFilesTestCase(BaseTestCase):
         self.assertEqual(g.tracks[timestamps[2]].lon, -113.448985)
         self.assertEqual(g.tracks[timestamps[2]].ele, 671.307)
 
+    def test_trackcache_reload(self):
+        """Ensure parsed track files are loaded back from the cache."""
+        gpx = join(self.data_dir, 'minimal.gpx')
+        first = self.mod.GPXFile(gpx)
+        self.assertEqual(len(listdir(self.cache_dir)), 1)
+        self.mod.GPXFile.cache.clear()
+        self.mod.TrackFile.parse = Mock()
+        second = self.mod.GPXFile(gpx)
+        self.assertEqual(self.mod.TrackFile.parse.mock_calls, [])
+        self.assertEqual(len(second.segments), len(first.segments))
+        for old, new in zip(first.segments, second.segments):
+            self.assertIsInstance(new.lats, memoryview)
+            self.assertEqual(
+                [list(column) for column in old.columns()],
+                [list(column) for column in new.columns()])
+            self.assertEqual(list(old.detail), list(new.detail))
+        self.assertEqual(list(second.tracks), list(first.tracks))
+        for timestamp in first.tracks:
+            self.assertEqual(second.tracks[timestamp], first.tracks[timestamp])
+
+    def test_trackcache_save_temp(self):
+        """Ensure every save writes its own temporary file."""
+        gpx = join(self.data_dir, 'minimal.gpx')
+        parsed = self.mod.GPXFile(gpx)
+        self.mod.replace = Mock()
+        for i in range(2):
+            self.mod.track_cache.save(
+                gpx, 'GPXFile', parsed.tracks, parsed.segments)
+        first, second = [args[0] for args, kwargs in
+                         self.mod.replace.call_args_list]
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(listdir(self.cache_dir)), 3)
+
+    def test_trackcache_stale(self):
+        """Ensure modified track files are parsed again."""
+        gpx = join(self.cache_dir, 'minimal.gpx')
+        copy(join(self.data_dir, 'minimal.gpx'), gpx)
+        self.mod.GPXFile(gpx)
+        utime(gpx, (0, 0))
+        self.assertIsNone(self.mod.track_cache.load(gpx, 'GPXFile'))
+        self.assertIsNone(self.mod.track_cache.load(gpx, 'KMLFile'))
+        self.mod.GPXFile.cache.clear()
+        self.mod.GPXFile(gpx)
+        self.assertIsNotNone(self.mod.track_cache.load(gpx, 'GPXFile'))
+
+    def test_trackcache_corrupt(self):
+        """Ensure damaged cache entries are ignored."""
+        gpx = join(self.data_dir, 'minimal.gpx')
+        self.mod.GPXFile(gpx)
+        path = self.mod.track_cache.locate(gpx, 'GPXFile')[0]
+        with open(path, 'r+b') as cache:
+            cache.truncate(cache.seek(0, 2) - 8)
+        self.assertIsNone(self.mod.track_cache.load(gpx, 'GPXFile'))
+        with open(path, 'wb') as cache:
+            cache.write(b'GGTRACKS')
+        self.assertIsNone(self.mod.track_cache.load(gpx, 'GPXFile'))
+        self.mod.GPXFile.cache.clear()
+        self.assertEqual(len(self.mod.GPXFile(gpx).tracks), 3)
+
     def test_gpxfile_unusual(self):
         """Ensure the GPXFile can understand an unusual GPX variant."""
         self.test_gpxfile('unusual.gpx')
@@ -430,6 +722,8 @@ class XmlFilesTestCase(BaseTestCase):
         c = self.mod.CSVFile(csv)
         timestamps = sorted(c.tracks)
         self.assertEqual(len(timestamps), 100)
+        self.assertEqual([len(segment.times) for segment in c.segments],
+                         [50, 50])
         middle = len(timestamps) // 2
         self.assertEqual(timestamps[0], 1339795704)
         self.assertEqual(c.tracks[timestamps[0]].lat, 49.887554)
@@ -460,6 +754,7 @@ class XmlFilesTestCase(BaseTestCase):
         c = self.mod.CSVFile(csv)
         timestamps = sorted(c.tracks)
         self.assertEqual(len(timestamps), 10)
+        self.assertEqual(len(c.segments), 1)
         middle = len(timestamps) // 2
         self.assertEqual(timestamps[0], 1339795704)
         self.assertEqual(c.tracks[timestamps[0]].lat, 49.887554)
@@ -490,6 +785,7 @@ class XmlFilesTestCase(BaseTestCase):
         c = self.mod.CSVFile(csv)
         timestamps = sorted(c.tracks)
         self.assertEqual(len(timestamps), 3)
+        self.assertEqual(len(c.segments), 1)
         self.assertEqual(timestamps[0], 1339792700)
         self.assertEqual(c.tracks[timestamps[0]].lat, 49.885583)
         self.assertEqual(c.tracks[timestamps[0]].lon, -97.151421)
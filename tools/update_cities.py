@@ -1,14 +1,29 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 # This takes the cities1000.txt file from geonames.org and extracts just the
 # data we need for the cities.txt file. It's important to strip out the less
-# useful data because the file is truly prodigous in size.
+# useful data because the file is truly prodigous in size. If a second
+# filename is given, cities.txt is also compiled into the binary cities.db
+# database that GottenGeography memory-maps at runtime.
 
 # Usage:
-# ./update_cities.py cities1000.txt > cities.txt
+# ./update_cities.py cities1000.txt [cities.db] > cities.txt
 
-from fileinput import input
+from os.path import abspath, dirname
+from sys import argv, path
 
-for line in input():
-    col = line.split('\t')
-    print '\t'.join([col[1], col[4], col[5], col[8], col[10], col[17]])
+path.insert(0, dirname(dirname(abspath(__file__))))
+
+from gg.geonames import write_database
+
+lines = []
+with open(argv[1], encoding='utf-8') as geonames:
+    for line in geonames:
+        col = line.rstrip('\n').split('\t')
+        lines.append('\t'.join([col[1], col[4], col[5], col[8], col[10],
+                                col[17], col[14]]) + '\n')
+        print(lines[-1], end='')
+
+if len(argv) > 2:
+    with open(argv[2], 'wb') as database:
+        write_database(lines, database)